@@ -1,6 +1,8 @@
 import time
 import pandas as pd
 from noaastn import noaastn
+from station_catalog import write_catalog
+from station_changes import previous_snapshot, station_changes_path, write_station_changes
 from datetime import datetime
 
 
@@ -24,3 +26,16 @@ filename = f"station_data_{current_datetime}.csv"
 station_df.to_csv(filename, index=False)
 
 print(f"Data written to {filename}")
+
+# Write the binary station catalog alongside the CSV for the later stages, from the CSV as read back,
+# so the codes match the text stage 2 formats IDs from
+catalog_filename = write_catalog(pd.read_csv(filename), filename)
+
+print(f"Catalog written to {catalog_filename}")
+
+# Diff against the previous snapshot, so stage 2 only recomputes the counties near changed stations
+previous_filename = previous_snapshot(filename)
+if previous_filename is not None:
+    changes = write_station_changes(previous_filename, filename)
+    counts = changes["change"].value_counts()
+    print(f"Since {previous_filename}: {counts.get('added', 0)} stations added, {counts.get('removed', 0)} removed, {counts.get('moved', 0)} moved; written to {station_changes_path(filename)}")
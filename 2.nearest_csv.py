@@ -1,104 +1,175 @@
+import json
+import os
 import pandas as pd
 import numpy as np
-from geopy.distance import geodesic
+from station_catalog import open_or_build_catalog
+from station_changes import latest_snapshot, changes_since, changed_positions, statistics_source_path
+from station_index import StationIndex
+from station_groups import resolve_station_groups, station_groups_path, write_station_groups
+from centroid_distances import CentroidDistanceTable, distance_table_path
+from county_data import normalize_fips
+from metrics import metrics, start_stage
+from pipeline_logging import configure_logging
+
+logger = configure_logging("stage2")
+stage_run = start_stage("stage2")
+
+# Settings
+statistics_file_path = "county_station_statistics.csv"
+# Newest snapshot written by 1.getting_stationData.py
+station_file_path = latest_snapshot() or "station_data_2024-05-14_18-54-47.csv"
+# Radius of a county's nearby stations, in miles
+max_distance = 50
+# Recompute only the counties near stations that changed since the snapshot the statistics were
+# computed from (see station_changes); False always rebuilds the whole file
+patch_changes = True
+
+STATISTICS_HEADER = "State,County_FIPS,Average_Distance_to_Stations_(miles),Station_Identifiers_(USAF_WBAN),Nearest_Station,Nearest_Station_Distance,County_Name\n"
+
+
+def get_nearby_stations_count_avg_distance(row_county, station_index, max_distance=50, distance_table=None):
+    """
+    Calculate nearby stations count, average distance, nearest distance, and nearest station ID.
+
+    Args:
+    row_county (Series): Series containing information about the county centroid.
+    station_index (StationIndex): Spatial index over the weather stations.
+    max_distance (float): Maximum distance to consider a station as nearby (default: 50 miles).
+    distance_table (CentroidDistanceTable): If given, the county's station distances are recorded in it.
+
+    Returns:
+    int: Count of nearby stations.
+    float: Average distance to nearby stations.
+    float: Nearest distance to a station.
+    str: Station ID of the nearest station.
+    """
+
+    positions, distances = station_index.within_radius(row_county["Latitude"], row_county["Longitude"], max_distance)
+    nearby_station_ids = station_index.station_ids(positions)
+    nearby_stations_str = "|".join(nearby_station_ids)
+    if distance_table is not None:
+        distance_table.add_county(row_county["FIPS"], nearby_station_ids, station_index.latitudes[positions], station_index.longitudes[positions], distances)
+
+    nearby_stations_count = len(nearby_station_ids)
+    if nearby_stations_count == 0:
+        return 0, np.nan, np.nan, "nannan", nearby_stations_str
+
+    avg_distance = np.mean(distances)
+    nearest_index = int(np.argmin(distances))
+    nearest_distance = distances[nearest_index]
+
+    return nearby_stations_count, avg_distance, nearest_distance, nearby_station_ids[nearest_index], nearby_stations_str
+
+
+def county_statistics_line(row_county, station_index, distance_table):
+    """
+    The county's line of the statistics file.
+    """
+    logger.debug("Processing County: %s (%s) in %s", row_county['County_Name'], row_county['FIPS'], row_county['State'])
+
+    # Get nearby stations statistics
+    with metrics.timer("nearby_stations"):
+        nearby_stations_count, avg_distance, nearest_distance, nearest_station_id, nearby_stations_str = get_nearby_stations_count_avg_distance(row_county, station_index, max_distance, distance_table=distance_table)
+    metrics.count("counties")
+    metrics.count("nearby_stations_found", nearby_stations_count)
+
+    return "{},{},{},{},{},{},{}\n".format(
+        row_county['State'],
+        row_county['FIPS'],
+        avg_distance,
+        nearby_stations_str,
+        nearest_station_id,
+        nearest_distance,
+        row_county['County_Name']
+    )
+
+
+def counties_to_patch(county_centroids_df):
+    """
+    Counties within the search radius of a station that changed since the statistics were computed.
+
+    Returns:
+    list: Row positions in county_centroids_df, or None if the whole file has to be rebuilt (no
+        statistics yet, another county list, or a change set of the snapshot chain is missing).
+    """
+    source_path = statistics_source_path(statistics_file_path)
+    if not (os.path.exists(statistics_file_path) and os.path.exists(source_path)):
+        return None
+    with open(source_path, 'r') as source_file:
+        source = json.load(source_file)["station_file"]
+    changes = changes_since(source, station_file_path)
+    if changes is None:
+        logger.info("No change sets from %s to %s; rebuilding", source, station_file_path)
+        return None
+    with open(statistics_file_path, 'r') as csv_file:
+        written_fips = [line.split(",", 2)[1] for line in csv_file.readlines()[1:]]
+    if written_fips != county_centroids_df["FIPS"].astype(str).tolist():
+        logger.info("County list changed; rebuilding")
+        return None
+
+    positions = changed_positions(changes)
+    logger.info("%d station changes since %s at %d positions", len(changes), source, len(positions))
+    if positions.empty:
+        return []
+    # A county is affected if a changed position lies within its radius, before or after the change
+    changed_index = StationIndex(positions)
+    nearby = changed_index.within_radius_batch(county_centroids_df["Latitude"].to_numpy(), county_centroids_df["Longitude"].to_numpy(), max_distance)
+    return [row for row, (found, _) in enumerate(nearby) if len(found)]
+
+
+def write_statistics_source():
+    with open(statistics_source_path(statistics_file_path), 'w') as source_file:
+        json.dump({"station_file": os.path.basename(station_file_path)}, source_file)
+
 
 # Read the CSV file
 county_centroids_df = pd.read_csv("County Centroids.csv")
-station_informations_df = pd.read_csv("station_data_2024-05-14_18-54-47.csv")
-
-# Open the CSV file to write the information
-with open("county_station_statistics.csv", "w") as csv_file:
-
-    # Write headers to the CSV file
-    csv_file.write("State,County_FIPS,Average_Distance_to_Stations_(miles),Station_Identifiers_(USAF_WBAN),Nearest_Station,Nearest_Station_Distance,County_Name\n")
-
-    def get_stations_by_state(station_informations_df, state):
-        """
-        Extracts station information from a DataFrame containing weather station data,
-        filtered by state.
-
-        Args:
-        station_informations_df (DataFrame): DataFrame containing weather station data.
-        state (str): The state code for filtering station information.
-
-        Returns:
-        DataFrame: DataFrame containing station information filtered by the specified state.
-        """
-        if state == "":
-            return station_informations_df
-
-        # Filter the DataFrame for stations in the desired state or with an empty state
-        stations_in_state = station_informations_df[(station_informations_df['state'] == state) | (station_informations_df['state'].fillna('') == "")]
-
-        return stations_in_state
-
-    def get_nearby_stations_count_avg_distance(row_county, station_informations, max_distance=50):
-        """
-        Calculate nearby stations count, average distance, nearest distance, and nearest station ID.
-
-        Args:
-        row_county (Series): Series containing information about the county centroid.
-        station_informations (DataFrame): DataFrame containing weather station information.
-        max_distance (float): Maximum distance to consider a station as nearby (default: 50 miles).
-
-        Returns:
-        int: Count of nearby stations.
-        float: Average distance to nearby stations.
-        float: Nearest distance to a station.
-        str: Station ID of the nearest station.
-        """
-
-        nearby_stations = []
-        distances = []
-        nearby_stations_str = ""
-        for index, row in station_informations.iterrows():
-            latitude_station = row['latitude']
-            longitude_station = row['longitude']
-            if not pd.isnull(latitude_station) and not pd.isnull(longitude_station):
-                distance = geodesic((row_county["Latitude"], row_county["Longitude"]), (latitude_station, longitude_station)).miles
-                if distance < max_distance:
-                    nearby_stations.append((row['usaf'], row['wban']))
-                    distances.append(distance)
-                    if nearby_stations_str == "":
-                        nearby_stations_str = str(row['usaf']) + str(row['wban'])
-                    else:
-                        nearby_stations_str = nearby_stations_str + "|" + str(row['usaf']) + str(row['wban'])
-
-        nearby_stations_count = len(nearby_stations)
-        avg_distance = np.mean(distances) if distances else np.nan
-        nearest_distance = min(distances) if distances else np.nan
-        nearest_station = nearby_stations[distances.index(nearest_distance)] if nearby_stations else (np.nan, np.nan)
-
-        return nearby_stations_count, avg_distance, nearest_distance, f"{nearest_station[0]}{nearest_station[1]}", nearby_stations_str
-
-
-    # Iterate over each row in the county centroid DataFrame
-    for index, row_county in county_centroids_df.iterrows():
-        print(f"Processing County: {row_county['County_Name']} ({row_county['FIPS']}) in {row_county['State']}...")
-
-        # Filter stations by state
-        station_informations = get_stations_by_state(station_informations_df, row_county["State"])
-
-        # Get nearby stations statistics
-        nearby_stations_count, avg_distance, nearest_distance, nearest_station_id, nearby_stations_str = get_nearby_stations_count_avg_distance(row_county, station_informations)
-
-        # Write data for the current county to the CSV file
-        csv_file.write("{},{},{},{},{},{},{}\n".format(
-            row_county['State'],
-            row_county['FIPS'],
-            avg_distance,
-            nearby_stations_str,
-            nearest_station_id,
-            nearest_distance,
-            row_county['County_Name']
-        ))
-
-        # # Print data for the current county and nearest station
-        # print("State:", row_county['State'])
-        # print("County FIPS:", row_county['FIPS'])
-        # print("Average Distance to Stations (miles):", avg_distance)
-        # print("Station Identifiers (USAF WBAN):", nearby_stations_str)
-        # print("Nearest Station:", nearest_station_id)
-        # print("Nearest Station Distance:", nearest_distance)
-        # print("County Name:", row_county['County_Name'])
-        # print("="*50)
+station_catalog = open_or_build_catalog(station_file_path)
+
+# Build the station spatial index once for all counties
+station_index = StationIndex.from_catalog(station_catalog)
+
+affected = counties_to_patch(county_centroids_df) if patch_changes else None
+if affected is None:
+    # Distances measured here are kept for stage 5, which would otherwise recompute them per ISD row
+    distance_table = CentroidDistanceTable()
+
+    # Open the CSV file to write the information
+    with open(statistics_file_path, "w") as csv_file:
+
+        # Write headers to the CSV file
+        csv_file.write(STATISTICS_HEADER)
+
+        # Iterate over each row in the county centroid DataFrame
+        for index, row_county in county_centroids_df.iterrows():
+            # Write data for the current county to the CSV file
+            csv_file.write(county_statistics_line(row_county, station_index, distance_table))
+
+    logger.info("%d counties written", len(county_centroids_df))
+else:
+    # Only the affected counties' lines and distances are recomputed; the rest are kept as written
+    distance_table = CentroidDistanceTable.load(distance_table_path(statistics_file_path))
+    with open(statistics_file_path, 'r') as csv_file:
+        lines = csv_file.readlines()
+    for row in affected:
+        row_county = county_centroids_df.iloc[row]
+        distance_table.counties.pop(normalize_fips(row_county["FIPS"]), None)
+        lines[row + 1] = county_statistics_line(row_county, station_index, distance_table)
+
+    temporary_path = f"{statistics_file_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as csv_file:
+        csv_file.writelines(lines)
+    os.replace(temporary_path, statistics_file_path)
+    metrics.count("counties_patched", len(affected))
+    logger.info("%d of %d counties recomputed for station changes", len(affected), len(county_centroids_df))
+
+distance_table.save(distance_table_path(statistics_file_path))
+write_statistics_source()
+
+# Stations listed under several identifiers at one site, so stage 5 downloads only one of them
+with metrics.timer("station_groups"):
+    station_groups = resolve_station_groups(station_catalog.to_dataframe())
+write_station_groups(station_groups, station_groups_path(statistics_file_path))
+logger.info("%d stations in %d co-located groups", len(station_groups), station_groups["group"].nunique())
+
+stage_run.finish()
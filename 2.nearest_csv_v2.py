@@ -1,10 +1,23 @@
 import pandas as pd
 import numpy as np
-from geopy.distance import geodesic
+from station_catalog import open_or_build_catalog
+from station_index import StationIndex
+from centroid_distances import CentroidDistanceTable, distance_table_path
+from metrics import metrics, start_stage
+from pipeline_logging import configure_logging
+
+logger = configure_logging("stage2_v2")
+stage_run = start_stage("stage2_v2")
 
 # Read the CSV file
 county_centroids_df = pd.read_csv("County Centroids.csv")
-station_informations_df = pd.read_csv("station_data_2024-05-14_18-54-47.csv")
+station_catalog = open_or_build_catalog("station_data_2024-05-14_18-54-47.csv")
+
+# Build the station spatial index once for all counties
+station_index = StationIndex.from_catalog(station_catalog)
+
+# Distances measured here are kept for stage 5, which would otherwise recompute them per ISD row
+distance_table = CentroidDistanceTable()
 
 # Open the CSV file to write the information
 with open("county_station_statistics_v2.csv", "w") as csv_file:
@@ -12,34 +25,15 @@ with open("county_station_statistics_v2.csv", "w") as csv_file:
     # Write headers to the CSV file
     csv_file.write("State,County_FIPS,Nearby_Station_Identifiers_(USAF_WBAN),County_Name\n")
 
-    def get_stations_by_state(station_informations_df, state):
-        """
-        Extracts station information from a DataFrame containing weather station data,
-        filtered by state.
-
-        Args:
-        station_informations_df (DataFrame): DataFrame containing weather station data.
-        state (str): The state code for filtering station information.
-
-        Returns:
-        DataFrame: DataFrame containing station information filtered by the specified state.
-        """
-        if state == "":
-            return station_informations_df
-
-        # Filter the DataFrame for stations in the desired state or with an empty state
-        stations_in_state = station_informations_df[(station_informations_df['state'] == state) | (station_informations_df['state'].fillna('') == "")]
-
-        return stations_in_state
-
-    def get_nearby_stations_count_avg_distance(row_county, station_informations, max_distance=50):
+    def get_nearby_stations_count_avg_distance(row_county, station_index, max_distance=50, distance_table=None):
         """
         Calculate nearby stations count, average distance, nearest distance, and nearest station ID.
 
         Args:
         row_county (Series): Series containing information about the county centroid.
-        station_informations (DataFrame): DataFrame containing weather station information.
+        station_index (StationIndex): Spatial index over the weather stations.
         max_distance (float): Maximum distance to consider a station as nearby (default: 50 miles).
+        distance_table (CentroidDistanceTable): If given, the county's station distances are recorded in it.
 
         Returns:
         int: Count of nearby stations.
@@ -48,39 +42,32 @@ with open("county_station_statistics_v2.csv", "w") as csv_file:
         str: Station ID of the nearest station.
         """
 
-        nearby_stations = []
-        distances = []
-        nearby_stations_str = ""
-        for index, row in station_informations.iterrows():
-            latitude_station = row['latitude']
-            longitude_station = row['longitude']
-            if not pd.isnull(latitude_station) and not pd.isnull(longitude_station):
-                distance = geodesic((row_county["Latitude"], row_county["Longitude"]), (latitude_station, longitude_station)).miles
-                if distance < max_distance:
-                    nearby_stations.append((row['usaf'], row['wban']))
-                    distances.append(distance)
-                    if nearby_stations_str == "":
-                        nearby_stations_str = str(row['usaf']) + str(row['wban'])
-                    else:
-                        nearby_stations_str = nearby_stations_str + "|" + str(row['usaf']) + str(row['wban'])
-
-        nearby_stations_count = len(nearby_stations)
-        avg_distance = np.mean(distances) if distances else np.nan
-        nearest_distance = min(distances) if distances else np.nan
-        nearest_station = nearby_stations[distances.index(nearest_distance)] if nearby_stations else (np.nan, np.nan)
-
-        return nearby_stations_count, avg_distance, nearest_distance, f"{nearest_station[0]}{nearest_station[1]}", nearby_stations_str
+        positions, distances = station_index.within_radius(row_county["Latitude"], row_county["Longitude"], max_distance)
+        nearby_station_ids = station_index.station_ids(positions)
+        nearby_stations_str = "|".join(nearby_station_ids)
+        if distance_table is not None:
+            distance_table.add_county(row_county["FIPS"], nearby_station_ids, station_index.latitudes[positions], station_index.longitudes[positions], distances)
+
+        nearby_stations_count = len(nearby_station_ids)
+        if nearby_stations_count == 0:
+            return 0, np.nan, np.nan, "nannan", nearby_stations_str
+
+        avg_distance = np.mean(distances)
+        nearest_index = int(np.argmin(distances))
+        nearest_distance = distances[nearest_index]
+
+        return nearby_stations_count, avg_distance, nearest_distance, nearby_station_ids[nearest_index], nearby_stations_str
 
 
     # Iterate over each row in the county centroid DataFrame
     for index, row_county in county_centroids_df.iterrows():
-        print(f"Processing County: {row_county['County_Name']} ({row_county['FIPS']}) in {row_county['State']}...")
-
-        # Filter stations by state
-        station_informations = get_stations_by_state(station_informations_df, row_county["State"])
+        logger.debug("Processing County: %s (%s) in %s", row_county['County_Name'], row_county['FIPS'], row_county['State'])
 
         # Get nearby stations statistics
-        nearby_stations_count, avg_distance, nearest_distance, nearest_station_id, nearby_stations_str = get_nearby_stations_count_avg_distance(row_county, station_informations)
+        with metrics.timer("nearby_stations"):
+            nearby_stations_count, avg_distance, nearest_distance, nearest_station_id, nearby_stations_str = get_nearby_stations_count_avg_distance(row_county, station_index, distance_table=distance_table)
+        metrics.count("counties")
+        metrics.count("nearby_stations_found", nearby_stations_count)
 
         # Write data for the current county to the CSV file
         csv_file.write("{},{},{},{}\n".format(
@@ -90,3 +77,7 @@ with open("county_station_statistics_v2.csv", "w") as csv_file:
             row_county['County_Name']
         ))
 
+logger.info("%d counties written", len(county_centroids_df))
+distance_table.save(distance_table_path("county_station_statistics_v2.csv"))
+
+stage_run.finish()
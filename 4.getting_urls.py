@@ -1,6 +1,16 @@
 import json
-import time
 import csv
+import logging
+import os
+from county_data import load_county_statistics, normalize_fips
+from download_plan import station_year_url
+from work_manifest import write_work_manifest
+from delta_manifest import DELTA_MANIFEST, PendingWork
+from progress_journal import ProgressJournal, journal_path
+from metrics import metrics, start_stage
+from pipeline_logging import configure_logging
+
+logger = logging.getLogger("stage4")
 
 def get_formatted_date(year, month, day):
     return f"{month}-{day}"
@@ -8,52 +18,44 @@ def get_formatted_date(year, month, day):
 def process_csv_file(fips_file_path, station_file_path):
     data_dict = {}
     try:
-        # Open the CSV file containing FIPS data
+        # Index the county statistics by FIPS once instead of rescanning them for every date
+        county_statistics = load_county_statistics(station_file_path)
+
+        # (FIPS, year) -> set of (month, day), deduplicated while streaming the FIPS/date file once
+        dates = {}
+        missing_fips = set()
         with open(fips_file_path, mode='r') as fips_file:
-            # Create a CSV reader object
             fips_reader = csv.DictReader(fips_file)
 
-            # Iterate over each row in the FIPS CSV file
             for fips_row in fips_reader:
-                fips_code = fips_row["county_fips"]
-                year = fips_row["year"]
-                month = fips_row["month"]
-                day = fips_row["day"]
-
-                # Open the CSV file containing station data
-                with open(station_file_path, mode='r') as station_file:
-                    # Create a CSV reader object
-                    station_reader = csv.DictReader(station_file)
-
-                    # Iterate over each row in the station CSV file
-                    for station_row in station_reader:
-                        if station_row["County_FIPS"] == fips_code:
-                            nearby_station_ids = station_row["Station_Identifiers_(USAF_WBAN)"].split("|")
-                            nearest_station_id = station_row["Nearest_Station"]
-
-                            # Generate URLs for downloading CSV files for nearby stations
-                            urls = [f"https://www.ncei.noaa.gov/data/global-hourly/access/{year}/{station_id}.csv" for station_id in nearby_station_ids]
-
-                            # Generate URL for downloading CSV file for nearest station
-                            nearest_station_url = f"https://www.ncei.noaa.gov/data/global-hourly/access/{year}/{nearest_station_id}.csv"
-
-                            # Add data to the dictionary
-                            if fips_code not in data_dict:
-                                data_dict[fips_code] = {year: {"nearby_stations": urls, "nearest_station": nearest_station_url, "month-day": [(month, day)]}}
-                            else:
-                                if year not in data_dict[fips_code]:
-                                    data_dict[fips_code][year] = {"nearby_stations": urls, "nearest_station": nearest_station_url, "month-day": [(month, day)]}
-                                else:
-                                    # Append month-day data to existing year data
-                                    data_dict[fips_code][year]["month-day"].append((month, day))
-
-                # Print data for verification
-                print(fips_code)
-                print(data_dict[fips_code])
-                # time.sleep(100)
+                fips_code = normalize_fips(fips_row["county_fips"])
+                if fips_code not in county_statistics:
+                    missing_fips.add(fips_code)
+                    continue
+                year = str(int(fips_row["year"]))
+                dates.setdefault((fips_code, year), set()).add((int(fips_row["month"]), int(fips_row["day"])))
+
+        for (fips_code, year), month_days in dates.items():
+            nearby_station_ids, nearest_station_id = county_statistics[fips_code]
+
+            # Generate URLs for downloading CSV files for nearby stations
+            urls = [station_year_url(station_id, year) for station_id in nearby_station_ids]
+
+            # Generate URL for downloading CSV file for nearest station
+            nearest_station_url = station_year_url(nearest_station_id, year)
+
+            data_dict.setdefault(fips_code, {})[year] = {
+                "nearby_stations": urls,
+                "nearest_station": nearest_station_url,
+                "month-day": [(str(month), str(day)) for month, day in sorted(month_days)]
+            }
+
+        logger.info("%d counties, %d county-years", len(data_dict), len(dates))
+        if missing_fips:
+            logger.warning("No station statistics for FIPS: %s", ', '.join(sorted(missing_fips)))
 
     except FileNotFoundError:
-        print("One of the files does not exist.")
+        logger.error("One of the files does not exist.")
 
     return data_dict
 
@@ -63,9 +65,48 @@ def save_dict_to_json(dictionary, file_path):
         json.dump(dictionary, json_file)
 
 # Example usage
+configure_logging("stage4")
+stage_run = start_stage("stage4")
 fips_file_path = 'necessaryFIPS.csv'
 station_file_path = 'county_station_statistics.csv'
-formatted_data = process_csv_file(fips_file_path, station_file_path)
+# Also write the dates the stage-5 output does not hold yet as a delta manifest, for stage 5's
+# incremental mode; the stage-5 CSV is named after the first FIPS unless set here
+incremental = False
+output_csv_filename = None
+with metrics.timer("build_work"):
+    formatted_data = process_csv_file(fips_file_path, station_file_path)
+metrics.count("counties", len(formatted_data))
+metrics.count("county_years", sum(len(years) for years in formatted_data.values()))
+
+# Save the formatted data as the compact binary manifest read by stage 5
+with metrics.timer("write"):
+    write_work_manifest(formatted_data, 'formatted_data.manifest')
+
+if incremental and formatted_data:
+    output_csv_filename = output_csv_filename or f"{next(iter(formatted_data))}_data.csv"
+    # Dates stage 5 recorded in its progress journal; without a journal everything is new. The journal
+    # is only read: cutting the CSV back to its last unit is left to stage 5, which may be writing it
+    produced = {}
+    if os.path.exists(journal_path(output_csv_filename)):
+        with ProgressJournal(journal_path(output_csv_filename)) as journal:
+            try:
+                output_size = os.path.getsize(output_csv_filename)
+            except OSError:
+                output_size = 0
+            # A CSV deleted or cut short since makes stage 5 reset the journal, so every date is new again
+            if output_size < journal.committed_offset():
+                logger.warning("%s no longer holds the journaled rows; every date is new", output_csv_filename)
+            else:
+                produced = journal.produced_days()
+    pending = PendingWork(formatted_data, produced)
+    with metrics.timer("write_delta"):
+        write_work_manifest(pending.to_dict(), DELTA_MANIFEST)
+    metrics.count("delta_dates", pending.date_count())
+    logger.info("Delta: %d new dates in %d counties not yet in %s", pending.date_count(), len(pending), output_csv_filename)
+
+# The JSON form is only needed for inspection or older scripts
+write_json = False
+if write_json:
+    save_dict_to_json(formatted_data, 'formatted_data.json')
 
-# Save the formatted data to a JSON file
-save_dict_to_json(formatted_data, 'formatted_data.json')
+stage_run.finish()
@@ -1,48 +1,16 @@
-import json
 import time
+from collections.abc import Mapping
 def get_fips_level_keys(json_data):
-    if isinstance(json_data, dict):
+    if isinstance(json_data, Mapping):
         return json_data.keys()
     return []
-import os
-import requests
-
-def download_csv(url):
-    """
-    Download a CSV file from the given URL and save it with the filename extracted from the URL.
-    
-    Args:
-        url (str): The URL of the CSV file.
-        
-    Returns:
-        bool: True if the file was downloaded successfully, False otherwise.
-    """
-    try:
-        # Send a GET request to the URL
-        response = requests.get(url)
-        
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Extract filename from the URL
-            filename = os.path.basename(url)
-            
-            # Save the content of the response (CSV file) to a local file
-            with open(filename, "wb") as f:
-                f.write(response.content)
-            print("File downloaded successfully.")
-            return True
-        else:
-            print("Failed to download the file. Status code:", response.status_code)
-            return False
-    except Exception as e:
-        print("An error occurred:", e)
-        return False
-
+from downloader import download_all
+from work_manifest import WorkManifest
 
 def main():
-    file_path = 'formatted_data.json'  # Replace 'your_json_file_path.json' with your actual file path
-    with open(file_path, 'r') as file:
-        json_data = json.load(file)
+    file_path = 'formatted_data.manifest'
+    # Counties are decoded from the memory-mapped manifest only when they are looked up
+    json_data = WorkManifest(file_path)
     
     fips_level_keys = get_fips_level_keys(json_data)
     print(len(fips_level_keys))
@@ -58,10 +26,10 @@ def main():
             print(json_data[f"{key}"][key1])
             print(key1)
             time.sleep(2)
-            for value1 in json_data[f"{key}"][key1]["nearby_stations"]:
-                print(value1)
-                download_csv(value1)
-                time.sleep(2)
+            # Download the year's stations concurrently over one pooled session
+            urls = json_data[f"{key}"][key1]["nearby_stations"]
+            downloaded_files = download_all(urls)
+            print(f"{sum(1 for file in downloaded_files.values() if file)} of {len(urls)} files downloaded successfully.")
             print("rrrrrrrrrrrrrrrrrr", json_data[f"{key}"][key1]["nearest_station"])
             time.sleep(2)
         time.sleep(10)
@@ -1,49 +1,46 @@
-from geopy.distance import geodesic
-import json
+import logging
 import time
 import os
-import requests
 import pandas as pd
-import csv
-from collections import Counter
+from collections.abc import Mapping
+from observation_cache import ObservationCache, DownloadFailedError
+from downloader import download_all
+from download_plan import plan_downloads, estimate_plan_bytes, format_plan, execute_plan
+from county_data import load_county_centroids, normalize_fips
+from station_major import run_station_major
+from work_manifest import WorkManifest
+from delta_manifest import load_pending_work, unit_days
+from columnar_output import open_row_writer
+from progress_journal import open_journal
+from metrics import metrics, instrumented_stage
+from pipeline_logging import configure_logging, ProgressLog
+from hourly_aggregation import OUTPUT_FIELDNAMES, hourly_rows
+from centroid_distances import CentroidDistanceTable, distance_table_path
+from station_groups import StationGroups, station_groups_path
+
+logger = logging.getLogger("stage5")
 
 def get_keys(json_data):
-    if isinstance(json_data, dict):
+    if isinstance(json_data, Mapping):
         return json_data.keys()
     return []
 
-def download_csv(url):
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            filename = os.path.basename(url)
-            with open(filename, "wb") as f:
-                f.write(response.content)
-            print("File downloaded successfully.")
-            return filename
-        else:
-            print("Failed to download the file. Status code:", response.status_code)
-            return None
-    except Exception as e:
-        print("An error occurred:", e)
-        return None
-
 def remove_files(file_paths):
     for file_path in file_paths:
         try:
             os.remove(file_path)
-            print(f"File {file_path} removed successfully.")
+            logger.debug("Removed %s", file_path)
         except Exception as e:
-            print(f"An error occurred while removing {file_path}: {e}")
+            logger.warning("Could not remove %s: %s", file_path, e)
 
 def get_county_info(file_path, fips):
     data = pd.read_csv(file_path)
-    print(f"CSV columns: {data.columns.tolist()}")
+    logger.debug("CSV columns: %s", data.columns.tolist())
     
     data['FIPS'] = data['FIPS'].astype(str)
     
     filtered_data = data[data['FIPS'] == fips]
-    print(f"Filtered data: {filtered_data}")
+    logger.debug("Filtered data: %s", filtered_data)
     
     if not filtered_data.empty:
         county_name = filtered_data['County_Name'].values[0]
@@ -54,190 +51,153 @@ def get_county_info(file_path, fips):
     else:
         return None, None, None, None
 
-def get_avg_and_nearest_station_data(file_paths, year, month, day, hour, county_centroid):
-    year = int(year)
-    month = int(month)
-    day = int(day)
-    hour = int(hour)
-    
-    date_str = f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}"
-    winds = []
-    temperatures = []
-    temperatures_qualities = []
-    precipitations = []
-    
-    distances = []
-
-    nearest_station_id = None
-    nearest_station_distance = float('inf')
-    nearest_station_data = {}
-
-    for file_path in file_paths:
-        station_id = file_path.split('.')[0]
-        with open(file_path, mode='r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            headers = reader.fieldnames
-            has_lat = 'LATITUDE' in headers
-            has_lon = 'LONGITUDE' in headers
-            has_wnd = 'WND' in headers
-            has_tmp = 'TMP' in headers
-            has_aa1 = 'AA1' in headers
-
-            for row in reader:
-                if date_str in row['DATE']:
-                    station_lat = float(row['LATITUDE']) if has_lat and row['LATITUDE'] and row['LATITUDE'] != "999" else None
-                    station_lon = float(row['LONGITUDE']) if has_lon and row['LONGITUDE'] and row['LONGITUDE'] != "999" else None
-                    
-                    if station_lat and station_lon:
-                        distance_to_centroid = geodesic((station_lat, station_lon), county_centroid).miles
-                        distances.append(distance_to_centroid)
-
-                        if distance_to_centroid < nearest_station_distance:
-                            nearest_station_distance = distance_to_centroid
-                            nearest_station_id = station_id
-                            nearest_station_data = {
-                                "wind": None,
-                                "temp": None,
-                                "temp_quality": None,
-                                "precip": None
-                            }
-
-                    if has_wnd and row['WND'] and row['WND'] != "999,9,9,9999,9":
-                        wnd_parts = row['WND'].split(',')
-                        if len(wnd_parts) >= 4:
-                            wind_speed = float(wnd_parts[3])
-                            winds.append(wind_speed)
-                            if nearest_station_id == station_id:
-                                nearest_station_data["wind"] = wind_speed
-
-                    if has_tmp and row['TMP'] and row['TMP'] != "+9999,9":
-                        tmp_parts = row['TMP'].split(',')
-                        if len(tmp_parts) >= 1:
-                            temperature = float(tmp_parts[0])
-                            temperature_quality = tmp_parts[1]
-                            temperatures.append(temperature)
-                            temperatures_qualities.append(temperature_quality)
-                            if nearest_station_id == station_id:
-                                nearest_station_data["temp"] = temperature
-                                nearest_station_data["temp_quality"] = temperature_quality
-
-                    if has_aa1 and row['AA1']:
-                        aa1_parts = row['AA1'].split(',')
-                        if len(aa1_parts) >= 3 and aa1_parts[0] == "01":
-                            precipitation = float(aa1_parts[1])
-                            precipitations.append(precipitation)
-                            if nearest_station_id == station_id:
-                                nearest_station_data["precip"] = precipitation
-
-    wind_avg = round(sum(winds) / len(winds), 2) if winds else None
-    temp_avg = round(sum(temperatures) / len(temperatures), 2) if temperatures else None
-    precip_avg = round(sum(precipitations) / len(precipitations), 2) if precipitations else None
-    
-    avg_distance = round(sum(distances) / len(distances), 2) if distances else None
-
-    return {
-        "Average Wind": wind_avg,
-        "Average Temperature": temp_avg,
-        "Average Precipitation": precip_avg,
-        "Nearest Station Wind": nearest_station_data.get("wind"),
-        "Nearest Station Temperature": nearest_station_data.get("temp"),
-        "Nearest Station Temperature Quality": nearest_station_data.get("temp_quality"),
-        "Nearest Station Precipitation": nearest_station_data.get("precip"),
-        "Average Distance from Centroid": avg_distance,
-        "Nearest Station Distance from Centroid": nearest_station_distance,
-        "Nearest Station ID": nearest_station_id
-    }
+def write_county_year_rows(writer, state, fips, county_name, county_centroid, year, month_days, stations, aggregation_mode, county_distances=None, match_window=None):
+    logger.debug("FIPS %s %s: %d stations, %d days", fips, year, len(stations), len(month_days))
+    rows = hourly_rows(state, fips, county_name, county_centroid, year, month_days, stations, aggregation_mode, county_distances, match_window)
+    with metrics.timer("write"):
+        for row in rows:
+            writer.writerow(row)
+    metrics.count("rows_written", len(rows))
+    return len(rows)
 
+@instrumented_stage("stage5")
 def main():
-    file_path = 'formatted_data.json'
+    configure_logging("stage5")
+    file_path = 'formatted_data.manifest'
     csv_file_path = 'County Centroids.csv'
-
-    with open(file_path, 'r') as file:
-        json_data = json.load(file)
+    statistics_file_path = 'county_station_statistics.csv'
+    observation_cache = ObservationCache()
+    # "csv" keeps the flat file; "parquet" writes a typed dataset partitioned by state/year
+    output_format = "csv"
+    # Print the plan's download size; costs a HEAD request per planned station-year
+    estimate_download_size = False
+    # Continue after the last county-year an earlier run finished; False rewrites the output
+    resume = True
+    # "county" walks counties one by one; "station" parses each station file once for all counties
+    execution_mode = "county"
+    # "avg+nearest" adds cross-station averages to the nearest-station columns; "nearest" omits them
+    aggregation_mode = "avg+nearest"
+    # Match each output hour to the reports closest to HH:00 within this many minutes; None uses the
+    # reports made during the hour
+    match_window = None
+    # Append only the dates of stage 4's delta manifest (incremental = True there) that the CSV does
+    # not hold yet, instead of processing the whole manifest
+    incremental = False
+    # Fetch one station of each co-located group stage 2 found (the one with data for the year);
+    # False fetches every listed station
+    deduplicate_stations = True
+
+    # Counties are decoded from the memory-mapped manifest only when they are looked up
+    json_data = WorkManifest(file_path)
+    # Station-to-centroid distances from stage 2, extended with positions reported by ISD rows
+    distance_table_file = distance_table_path(statistics_file_path)
+    distance_table = CentroidDistanceTable.load(distance_table_file)
+    # Co-located station groups from stage 2; without the file every station is its own group
+    station_groups = StationGroups.load(station_groups_path(statistics_file_path)) if deduplicate_stations else StationGroups()
     
     fips_level_keys = get_keys(json_data)
-    print(len(fips_level_keys))
+    logger.info("%d counties selected", len(fips_level_keys))
     # time.sleep(2)
     
     # Initialize the output CSV file using the first FIPS code
     first_fips = list(fips_level_keys)[0]
     output_csv_filename = f"{first_fips}_data.csv"
-    with open(output_csv_filename, mode='w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = [
-            "state", "county_fips", "average distance to stations (miles)", "station identifiers (USAF WBAN)", 
-            "nearest station", "nearest station distance", "county_name", "average wind", "nearest wind", 
-            "average temperature", "nearest temperature", "nearest temperature quality", "average precipitation", 
-            "nearest precipitation", "hour", "day", "month", "year", "date"
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',')
-        writer.writeheader()
-
-        print("FIPS level keys in the JSON file:")
+    fieldnames = OUTPUT_FIELDNAMES[aggregation_mode]
+    # County-years already in the CSV, recorded once their rows were on disk (CSV output only)
+    journal = open_journal(output_csv_filename, resume or incremental) if output_format == "csv" else None
+    # Incremental runs skip by date (PendingWork) rather than by county-year
+    skip_journal = None if incremental else journal
+    if incremental:
+        if journal is None:
+            raise ValueError("Incremental mode needs CSV output, whose progress journal records the dates written")
+        json_data = load_pending_work(journal)
+        fips_level_keys = get_keys(json_data)
+        logger.info("Incremental: %d new dates in %d counties", json_data.date_count(), len(fips_level_keys))
+    with open_row_writer(output_csv_filename, fieldnames, output_format, journal) as writer:
+        if execution_mode == "station":
+            centroids = load_county_centroids(csv_file_path)
+
+            progress = ProgressLog(logger, sum(len(json_data[f"{fips}"]) for fips in fips_level_keys), unit="county-years")
+
+            def finalize(fips, year, stations):
+                if skip_journal is not None and skip_journal.is_done(fips, year):
+                    progress.skip()
+                    return
+                county_start = time.perf_counter()
+                if normalize_fips(fips) not in centroids:
+                    logger.warning("No data found for FIPS: %s", fips)
+                    progress.skip()
+                    return
+                county_name, state, county_lat, county_lon = centroids[normalize_fips(fips)]
+                county_distances = distance_table.county(fips, (county_lat, county_lon))
+                month_days = json_data[f"{fips}"][year]["month-day"]
+                rows = write_county_year_rows(writer, state, fips, county_name, (county_lat, county_lon), year, month_days, stations, aggregation_mode, county_distances, match_window)
+                writer.commit(fips, year, unit_days(year, month_days))
+                distance_table.merge(county_distances)
+                metrics.add_time("county", time.perf_counter() - county_start, fips=fips)
+                progress.done(fips, rows, time.perf_counter() - county_start, year=year)
+
+            run_station_major(json_data, fips_level_keys, statistics_file_path, centroids, observation_cache, finalize, match_window=match_window, station_groups=station_groups)
+            distance_table.save(distance_table_file)
+            return
+
+        # Fetch every station-year of the selected counties once, before the per-county work
+        plan = plan_downloads(json_data, fips_level_keys, observation_cache, skip_journal.completed() if skip_journal is not None else None, station_groups)
+        expected_bytes = estimate_plan_bytes(plan)[0] if estimate_download_size else None
+        logger.info("%s", format_plan(plan, expected_bytes))
+        execute_plan(plan, observation_cache)
+
+        progress = ProgressLog(logger, len(fips_level_keys))
         for fips in fips_level_keys:
-            print(f"Processing FIPS: {fips}")
-            print(json_data[f"{fips}"])
+            logger.debug("Processing FIPS %s", fips)
+            county_start = time.perf_counter()
+            done_years = skip_journal.completed_years(fips) if skip_journal is not None else set()
+            year_level_keys = [year for year in get_keys(json_data[f"{fips}"]) if str(year) not in done_years]
+            if not year_level_keys:
+                logger.debug("FIPS %s already written", fips)
+                progress.skip()
+                continue
             county_name, state, county_lat, county_lon = get_county_info(csv_file_path, str(fips))
-            print(f"County Name: {county_name}, State: {state}, Latitude: {county_lat}, Longitude: {county_lon}")
-            county_centroid =  (float(county_lat), float(county_lon))
+            logger.debug("County Name: %s, State: %s, Latitude: %s, Longitude: %s", county_name, state, county_lat, county_lon)
             if county_name is None:
-                print(f"No data found for FIPS: {fips}")
+                logger.warning("No data found for FIPS: %s", fips)
+                progress.skip()
                 continue
+            county_centroid =  (float(county_lat), float(county_lon))
+            county_rows = 0
+            county_distances = distance_table.county(fips, county_centroid)
             
-            year_level_keys = get_keys(json_data[f"{fips}"])
             # time.sleep(2)
             for year in year_level_keys:
-                print(json_data[f"{fips}"][year])
-                print(year)
                 # time.sleep(2)
                 downloaded_files = []
-                for nearby_station in json_data[f"{fips}"][year]["nearby_stations"]:
-                    print(nearby_station)
-                    downloaded_file = download_csv(nearby_station)
+                stations = []
+                # Cached station-years skip both the download and the parse; the rest download concurrently
+                try:
+                    fetched = station_groups.source(observation_cache).fetch_many(json_data[f"{fips}"][year]["nearby_stations"], year, download_all)
+                except DownloadFailedError as e:
+                    # Not committed, so the next run tries the county-year again
+                    logger.warning("FIPS %s %s left for the next run: %s", fips, year, e)
+                    remove_files([downloaded_file for _, downloaded_file in e.results if downloaded_file])
+                    continue
+                for station, downloaded_file in fetched:
+                    if station is not None:
+                        stations.append(station)
                     if downloaded_file:
                         downloaded_files.append(downloaded_file)
-                    # time.sleep(2)
-
-                for month_day in json_data[f"{fips}"][year]["month-day"]:
-                    for hour in range(24):
-                        print(downloaded_files, year, int(month_day[0]), int(month_day[1]))
-                        avg_data = get_avg_and_nearest_station_data(downloaded_files, year, int(month_day[0]), int(month_day[1]), hour, county_centroid)
-
-                        date_str = f"{year}-{int(month_day[0]):02d}-{int(month_day[1]):02d}T{hour:02d}"
-
-                        nearest_temperature = avg_data.get('Nearest Station Temperature')
-                        nearest_temperature_quality = avg_data.get('Nearest Station Temperature Quality')
-
-                        row = {
-                            "state": state,
-                            "county_fips": fips,
-                            "average distance to stations (miles)": avg_data.get("Average Distance from Centroid"),
-                            "station identifiers (USAF WBAN)": "|".join([file.split('.')[0] for file in downloaded_files]),
-                            "nearest station": avg_data.get("Nearest Station ID"),
-                            "nearest station distance": round(avg_data.get("Nearest Station Distance from Centroid"), 2),
-                            "county_name": county_name,
-                            "average wind": avg_data.get("Average Wind"),
-                            "nearest wind": avg_data.get("Nearest Station Wind"),
-                            "average temperature": avg_data.get("Average Temperature"),
-                            "nearest temperature": nearest_temperature,
-                            "nearest temperature quality": nearest_temperature_quality,
-                            "average precipitation": avg_data.get("Average Precipitation"),
-                            "nearest precipitation": avg_data.get("Nearest Station Precipitation"),
-                            "hour": hour,
-                            "day": int(month_day[1]),
-                            "month": int(month_day[0]),
-                            "year": year,
-                            "date": date_str
-                        }
-                        
-                        writer.writerow(row)
-
-                        print(f"For {date_str}:")
-                        for key, value in avg_data.items():
-                            print(f"{key}: {value}")
-                        # time.sleep(2)
+
+                month_days = json_data[f"{fips}"][year]["month-day"]
+                county_rows += write_county_year_rows(writer, state, fips, county_name, county_centroid, year, month_days, stations, aggregation_mode, county_distances, match_window)
+                writer.commit(fips, year, unit_days(year, month_days))
 
                 # time.sleep(10)
                 remove_files(downloaded_files)
 
+            distance_table.merge(county_distances)
+            metrics.add_time("county", time.perf_counter() - county_start, fips=fips)
+            progress.done(fips, county_rows, time.perf_counter() - county_start)
+
+        distance_table.save(distance_table_file)
+
 if __name__ == "__main__":
     main()
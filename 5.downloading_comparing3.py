@@ -1,37 +1,46 @@
+import logging
 import os
 import json
 import time
-import requests
 import pandas as pd
-import csv
-from geopy.distance import geodesic
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
-from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Queue, cpu_count
+from collections.abc import Mapping
+from observation_cache import ObservationCache, DownloadFailedError
+from shared_observations import SharedObservationStore
+from downloader import download_all
+from download_plan import plan_downloads, estimate_plan_bytes, format_plan, execute_plan
+from work_manifest import WorkManifest
+from delta_manifest import load_pending_work, unit_days
+from batch_writer import SingleWriter, send_done, send_rows
+from progress_journal import open_journal
+from metrics import metrics, instrumented_stage
+from pipeline_logging import configure_logging, ProgressLog
+from hourly_aggregation import OUTPUT_FIELDNAMES, hourly_rows
+from centroid_distances import CentroidDistanceTable, CountyDistances, distance_table_path
+from station_groups import StationGroups, station_groups_path
+from county_data import normalize_fips
+
+logger = logging.getLogger("stage5_3")
+
+# "nearest" writes the nearest-station columns only; "avg+nearest" adds cross-station averages
+AGGREGATION_MODE = "nearest"
+# Match each output hour to the reports closest to HH:00 within this many minutes; None uses the
+# reports made during the hour
+MATCH_WINDOW = None
+FIELDNAMES = OUTPUT_FIELDNAMES[AGGREGATION_MODE]
 
 def get_keys(json_data):
-    if isinstance(json_data, dict):
+    if isinstance(json_data, Mapping):
         return json_data.keys()
     return []
 
-def download_csv(url):
-    try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            filename = os.path.basename(url)
-            with open(filename, "wb") as f:
-                f.write(response.content)
-            return filename
-        else:
-            return None
-    except Exception as e:
-        return None
-
 def remove_files(file_paths):
     for file_path in file_paths:
         try:
             os.remove(file_path)
         except Exception as e:
-            print(f"An error occurred while removing {file_path}: {e}")
+            logger.warning("Could not remove %s: %s", file_path, e)
 
 def get_county_info(file_path, fips):
     data = pd.read_csv(file_path)
@@ -46,175 +55,197 @@ def get_county_info(file_path, fips):
     else:
         return None, None, None, None
 
-def get_nearest_station_data(file_paths, year, month, day, hour, county_centroid):
-    year = int(year)
-    month = int(month)
-    day = int(day)
-    hour = int(hour)
-    
-    date_str = f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}"
-    
-    nearest_station_id = None
-    nearest_station_distance = float('inf')
-    nearest_station_data = {}
-
-    for file_path in file_paths:
-        station_id = file_path.split('.')[0]
-        with open(file_path, mode='r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            headers = reader.fieldnames
-            has_lat = 'LATITUDE' in headers
-            has_lon = 'LONGITUDE' in headers
-            has_wnd = 'WND' in headers
-            has_tmp = 'TMP' in headers
-            has_aa1 = 'AA1' in headers
-
-            for row in reader:
-                if date_str in row['DATE']:
-                    station_lat = float(row['LATITUDE']) if has_lat and row['LATITUDE'] and row['LATITUDE'] != "999" else None
-                    station_lon = float(row['LONGITUDE']) if has_lon and row['LONGITUDE'] and row['LONGITUDE'] != "999" else None
-                    
-                    if station_lat and station_lon:
-                        distance_to_centroid = geodesic((station_lat, station_lon), county_centroid).miles
-
-                        if distance_to_centroid < nearest_station_distance:
-                            nearest_station_distance = distance_to_centroid
-                            nearest_station_id = station_id
-                            nearest_station_data = {
-                                "wind": None,
-                                "temp": None,
-                                "temp_quality": None,
-                                "precip": None
-                            }
-
-                    if has_wnd and row['WND'] and row['WND'] != "999,9,9,9999,9":
-                        wnd_parts = row['WND'].split(',')
-                        if len(wnd_parts) >= 4:
-                            wind_speed = float(wnd_parts[3])
-                            if nearest_station_id == station_id:
-                                nearest_station_data["wind"] = wind_speed
-
-                    if has_tmp and row['TMP'] and row['TMP'] != "+9999,9":
-                        tmp_parts = row['TMP'].split(',')
-                        if len(tmp_parts) >= 1:
-                            temperature = float(tmp_parts[0])
-                            temperature_quality = tmp_parts[1]
-                            if nearest_station_id == station_id:
-                                nearest_station_data["temp"] = temperature
-                                nearest_station_data["temp_quality"] = temperature_quality
-
-                    if has_aa1 and row['AA1']:
-                        aa1_parts = row['AA1'].split(',')
-                        if len(aa1_parts) >= 3 and aa1_parts[0] == "01":
-                            precipitation = float(aa1_parts[1])
-                            if nearest_station_id == station_id:
-                                nearest_station_data["precip"] = precipitation
-
-    return {
-        "Nearest Station Wind": nearest_station_data.get("wind"),
-        "Nearest Station Temperature": nearest_station_data.get("temp"),
-        "Nearest Station Temperature Quality": nearest_station_data.get("temp_quality"),
-        "Nearest Station Precipitation": nearest_station_data.get("precip"),
-        "Nearest Station Distance from Centroid": nearest_station_distance,
-        "Nearest Station ID": nearest_station_id
-    }
-
 def get_keys_between_from_json(lst, filename):
+    lst = list(lst)
+    # Without a range file the run covers every key; the progress journal makes manual shards optional
+    if not os.path.exists(filename):
+        return lst
+
     try:
-        lst = list(lst)
         with open(filename, 'r') as file:
             data = json.load(file)
             start_key = data["start_key"]
             end_key = data["end_key"]
-        
-        start_index = lst.index(start_key)
-        end_index = lst.index(end_key)
-        return lst[start_index:end_index+1]
-    except ValueError as e:
-        return str(e)
-    except (FileNotFoundError, KeyError, json.JSONDecodeError) as e:
-        return str(e)
-
-def process_fips(fips, json_data, csv_file_path, output_csv_filename):
+    except (KeyError, json.JSONDecodeError) as e:
+        raise ValueError(f"{filename} must hold a start_key and an end_key: {e}") from e
+
+    for key in (start_key, end_key):
+        if key not in lst:
+            raise ValueError(f"{key} from {filename} is not a FIPS code of the manifest")
+    start_index = lst.index(start_key)
+    end_index = lst.index(end_key)
+    return lst[start_index:end_index+1]
+
+# Queue of the single output writer, the shared observations (or None) and the co-located station
+# groups, set in each worker process by init_worker
+output_queue = None
+shared_store = None
+station_groups = StationGroups()
+
+def init_worker(queue, store=None, groups=None):
+    global output_queue, shared_store, station_groups
+    output_queue = queue
+    shared_store = store
+    station_groups = groups if groups is not None else StationGroups()
+    # A forked worker starts with a copy of the parent's metrics; report only its own
+    metrics.reset()
+
+def process_fips(fips, county_work, csv_file_path, observation_cache, distance_entries, done_years=()):
+    try:
+        start_time = time.perf_counter()
+        county_distances, rows = write_fips_rows(fips, county_work, csv_file_path, observation_cache, distance_entries, done_years)
+        seconds = time.perf_counter() - start_time
+        metrics.add_time("county", seconds, fips=fips)
+        # The worker's metrics of this county travel back with its result
+        return county_distances, rows, seconds, metrics.take()
+    finally:
+        # Always release the county, or an ordered writer would hold back every later county
+        send_done(output_queue, fips)
+
+def write_fips_rows(fips, county_work, csv_file_path, observation_cache, distance_entries, done_years=()):
     county_name, state, county_lat, county_lon = get_county_info(csv_file_path, str(fips))
     if county_name is None:
-        return
+        return None, 0
     
     county_centroid = (float(county_lat), float(county_lon))
+    county_distances = CountyDistances(fips, county_centroid, distance_entries)
     
-    year_level_keys = get_keys(json_data[f"{fips}"])
+    # Years an earlier run already wrote are in the output
+    year_level_keys = [year for year in get_keys(county_work) if str(year) not in done_years]
+    county_rows = 0
     
     for year in year_level_keys:
         downloaded_files = []
+        stations = []
         
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            future_to_url = {executor.submit(download_csv, url): url for url in json_data[f"{fips}"][year]["nearby_stations"]}
-            for future in as_completed(future_to_url):
-                downloaded_file = future.result()
-                if downloaded_file:
-                    downloaded_files.append(downloaded_file)
-
-        for month_day in json_data[f"{fips}"][year]["month-day"]:
-            for hour in range(24):
-                nearest_data = get_nearest_station_data(downloaded_files, year, int(month_day[0]), int(month_day[1]), hour, county_centroid)
-                date_str = f"{year}-{int(month_day[0]):02d}-{int(month_day[1]):02d}T{hour:02d}"
-                
-                nearest_temperature = nearest_data.get('Nearest Station Temperature')
-                nearest_temperature_quality = nearest_data.get('Nearest Station Temperature Quality')
-
-                row = {
-                    "state": state,
-                    "county_fips": fips,
-                    "station identifiers (USAF WBAN)": "|".join([file.split('.')[0] for file in downloaded_files]),
-                    "nearest station": nearest_data.get("Nearest Station ID"),
-                    "nearest station distance": round(nearest_data.get("Nearest Station Distance from Centroid"), 2),
-                    "county_name": county_name,
-                    "nearest wind": nearest_data.get("Nearest Station Wind"),
-                    "nearest temperature": nearest_temperature,
-                    "nearest temperature quality": nearest_temperature_quality,
-                    "nearest precipitation": nearest_data.get("Nearest Station Precipitation"),
-                    "hour": hour,
-                    "day": int(month_day[1]),
-                    "month": int(month_day[0]),
-                    "year": year,
-                    "date": date_str
-                }
-
-                with open(output_csv_filename, mode='a', newline='', encoding='utf-8') as csvfile:
-                    writer = csv.DictWriter(csvfile, fieldnames=row.keys(), delimiter=',')
-                    writer.writerow(row)
-
+        # Shared or cached station-years skip both the download and the parse; the rest download concurrently
+        source = station_groups.source(shared_store if shared_store is not None else observation_cache)
+        try:
+            fetched = source.fetch_many(county_work[year]["nearby_stations"], year, download_all)
+        except DownloadFailedError as e:
+            # Not sent, so the county-year is not journaled and the next run tries it again
+            logger.warning("FIPS %s %s left for the next run: %s", fips, year, e)
+            remove_files([downloaded_file for _, downloaded_file in e.results if downloaded_file])
+            continue
+        for station, downloaded_file in fetched:
+            if station is not None:
+                stations.append(station)
+            if downloaded_file:
+                downloaded_files.append(downloaded_file)
+
+        # Rows of the county-year go to the writer as one batch, journaled as one unit
+        month_days = county_work[year]["month-day"]
+        rows = [
+            [row[fieldname] for fieldname in FIELDNAMES]
+            for row in hourly_rows(state, fips, county_name, county_centroid, year, month_days, stations, AGGREGATION_MODE, county_distances, MATCH_WINDOW)
+        ]
+        send_rows(output_queue, fips, rows, unit=(fips, year, unit_days(year, month_days)))
+        county_rows += len(rows)
         remove_files(downloaded_files)
 
+    # Returned so the parent can keep the positions this worker measured
+    return county_distances, county_rows
+
+@instrumented_stage("stage5_3")
 def main():
-    file_path = 'formatted_data.json'
+    configure_logging("stage5_3")
+    file_path = 'formatted_data.manifest'
     csv_file_path = 'County Centroids.csv'
+    statistics_file_path = 'county_station_statistics.csv'
     start_end_path = "start_end.json"
-
-    with open(file_path, 'r') as file:
-        json_data = json.load(file)
+    observation_cache = ObservationCache()
+    # Print the plan's download size; costs a HEAD request per planned station-year
+    estimate_download_size = False
+    # "csv" keeps the flat file; "parquet" writes a typed dataset partitioned by state/year
+    output_format = "csv"
+    # Write counties in manifest order instead of completion order; the writer then holds every
+    # later county's rows in memory while an earlier one is still running
+    ordered_output = False
+    # Continue after the last county-year an earlier run finished; False rewrites the output
+    resume = True
+    # Publish the parsed station-years once in shared memory instead of each worker loading its own
+    # copies from the cache; needs room in /dev/shm for every station-year of the run
+    share_observations = False
+    # Append only the dates of stage 4's delta manifest (incremental = True there) that the CSV does
+    # not hold yet, instead of processing the whole manifest
+    incremental = False
+    # Fetch one station of each co-located group stage 2 found (the one with data for the year);
+    # False fetches every listed station
+    deduplicate_stations = True
+
+    # Counties are decoded from the memory-mapped manifest only when they are looked up
+    json_data = WorkManifest(file_path)
+    # Station-to-centroid distances from stage 2, extended with positions reported by ISD rows
+    distance_table_file = distance_table_path(statistics_file_path)
+    distance_table = CentroidDistanceTable.load(distance_table_file)
+    # Co-located station groups from stage 2; without the file every station is its own group
+    groups = StationGroups.load(station_groups_path(statistics_file_path)) if deduplicate_stations else StationGroups()
     
     fips_level_keys = get_keys(json_data)
     fips_level_keys = get_keys_between_from_json(fips_level_keys, start_end_path)
-    
+
     first_fips = list(fips_level_keys)[0]
     output_csv_filename = f"{first_fips}_data.csv"
+    # County-years already in the CSV, recorded by the writer once their rows were on disk (CSV output only)
+    journal = open_journal(output_csv_filename, resume or incremental) if output_format == "csv" else None
+    if incremental:
+        if journal is None:
+            raise ValueError("Incremental mode needs CSV output, whose progress journal records the dates written")
+        json_data = load_pending_work(journal)
+        fips_level_keys = [fips for fips in fips_level_keys if fips in json_data]
+        logger.info("Incremental: %d new dates in %d counties", json_data.date_count(), len(fips_level_keys))
+    # Incremental runs skip by date (PendingWork) rather than by county-year
+    done_units = journal.completed() if journal is not None and not incremental else set()
+    done_years = {}
+    for unit_fips, year in done_units:
+        done_years.setdefault(unit_fips, set()).add(year)
+    # Counties with every year written are not submitted at all
+    fips_level_keys = [
+        fips for fips in fips_level_keys
+        if any(str(year) not in done_years.get(normalize_fips(fips), ()) for year in get_keys(json_data[fips]))
+    ]
     
-    with open(output_csv_filename, mode='w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = [
-            "state", "county_fips", "station identifiers (USAF WBAN)", 
-            "nearest station", "nearest station distance", "county_name", "nearest wind", 
-            "nearest temperature", "nearest temperature quality", "nearest precipitation", 
-            "hour", "day", "month", "year", "date"
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',')
-        writer.writeheader()
+    # Fetch every station-year of the selected counties once, before the per-county work
+    plan = plan_downloads(json_data, fips_level_keys, observation_cache, done_units, groups)
+    expected_bytes = estimate_plan_bytes(plan)[0] if estimate_download_size else None
+    logger.info("%s", format_plan(plan, expected_bytes))
+    execute_plan(plan, observation_cache)
+
+    store = None
+    if share_observations:
+        try:
+            store = SharedObservationStore.publish(observation_cache, plan["referenced_by_year"])
+        except OSError as e:
+            logger.warning("Could not share observations, workers read the cache instead: %s", e)
 
     num_cores = cpu_count()
-    with ProcessPoolExecutor(max_workers=num_cores) as executor:
-        futures = [executor.submit(process_fips, fips, json_data, csv_file_path, output_csv_filename) for fips in fips_level_keys]
-        for future in as_completed(futures):
-            future.result()
+    # Bounded, so workers wait instead of piling up rows if the disk falls behind
+    queue = Queue(maxsize=num_cores * 4)
+    key_order = fips_level_keys if ordered_output else None
+
+    try:
+        with SingleWriter(output_csv_filename, FIELDNAMES, queue, key_order=key_order, output_format=output_format, journal=journal):
+            # Each task carries only its county's slice of the manifest
+            with ProcessPoolExecutor(max_workers=num_cores, initializer=init_worker, initargs=(queue, store, groups)) as executor:
+                progress = ProgressLog(logger, len(fips_level_keys))
+                futures = {executor.submit(process_fips, fips, json_data.county(fips), csv_file_path, observation_cache, distance_table.county_entries(fips), done_years.get(normalize_fips(fips), set())): fips for fips in fips_level_keys}
+                for future in as_completed(futures):
+                    county_distances, rows, seconds, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                    if county_distances is None:
+                        logger.warning("No data found for FIPS: %s", futures[future])
+                        progress.skip()
+                        continue
+                    distance_table.merge(county_distances)
+                    progress.done(futures[future], rows, seconds)
+    finally:
+        # Frees the shared block
+        if store is not None:
+            store.close()
+    distance_table.save(distance_table_file)
+
+    if journal is not None:
+        journal.close()
 
 if __name__ == "__main__":
     main()
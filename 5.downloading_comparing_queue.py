@@ -0,0 +1,133 @@
+import logging
+import os
+import socket
+import time
+from observation_cache import ObservationCache, DownloadFailedError
+from downloader import download_all
+from county_data import load_county_centroids, normalize_fips
+from work_manifest import WorkManifest
+from hourly_aggregation import OUTPUT_FIELDNAMES, hourly_rows
+from centroid_distances import CentroidDistanceTable, distance_table_path
+from station_groups import StationGroups, station_groups_path
+from task_queue import TaskQueue, write_unit_rows, merge_unit_outputs
+from metrics import metrics, start_stage
+from pipeline_logging import configure_logging, ProgressLog
+
+logger = logging.getLogger("stage5_queue")
+
+# Run this script on as many hosts (and as many times per host) as wanted; every copy leases
+# (FIPS, year) tasks from the shared queue until none are left, largest counties first.
+
+def remove_files(file_paths):
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except Exception as e:
+            logger.warning("Could not remove %s: %s", file_path, e)
+
+def run_task(task, json_data, centroids, observation_cache, distance_table, aggregation_mode, match_window, unit_directory, station_groups):
+    county_work = json_data[task.fips]
+    year = task.year
+    county_name, state, county_lat, county_lon = centroids[normalize_fips(task.fips)]
+    county_centroid = (county_lat, county_lon)
+    county_distances = distance_table.county(task.fips, county_centroid)
+
+    downloaded_files = []
+    stations = []
+    # Cached station-years skip both the download and the parse; the rest download concurrently
+    try:
+        fetched = station_groups.source(observation_cache).fetch_many(county_work[year]["nearby_stations"], year, download_all)
+    except DownloadFailedError as e:
+        # The task fails and is retried; the files that did download are cached already
+        remove_files([downloaded_file for _, downloaded_file in e.results if downloaded_file])
+        raise
+    for station, downloaded_file in fetched:
+        if station is not None:
+            stations.append(station)
+        if downloaded_file:
+            downloaded_files.append(downloaded_file)
+
+    try:
+        rows = hourly_rows(state, task.fips, county_name, county_centroid, year, county_work[year]["month-day"], stations, aggregation_mode, county_distances, match_window)
+        write_unit_rows(unit_directory, task.fips, year, OUTPUT_FIELDNAMES[aggregation_mode], rows)
+    finally:
+        # Also when the task fails, so a retried task does not leave its files behind
+        remove_files(downloaded_files)
+    distance_table.merge(county_distances)
+    return len(rows)
+
+def main():
+    file_path = 'formatted_data.manifest'
+    csv_file_path = 'County Centroids.csv'
+    statistics_file_path = 'county_station_statistics.csv'
+    # Shared by all workers: the queue database and the directory of finished (FIPS, year) units
+    queue_path = 'stage5_tasks.sqlite'
+    unit_directory = 'stage5_units'
+    # A task whose worker stops renewing its lease for this long is handed to another worker
+    lease_seconds = 15 * 60
+    # "avg+nearest" adds cross-station averages to the nearest-station columns; "nearest" omits them
+    aggregation_mode = "avg+nearest"
+    # Match each output hour to the reports closest to HH:00 within this many minutes; None uses the
+    # reports made during the hour
+    match_window = None
+    # Fetch one station of each co-located group stage 2 found (the one with data for the year);
+    # False fetches every listed station
+    deduplicate_stations = True
+    observation_cache = ObservationCache()
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    configure_logging(f"stage5_queue-{worker}")
+    # One metrics file per worker, since workers may share the metrics directory
+    stage_run = start_stage(f"stage5_queue-{worker}")
+
+    # Counties are decoded from the memory-mapped manifest only when they are looked up
+    json_data = WorkManifest(file_path)
+    centroids = load_county_centroids(csv_file_path)
+    # Station-to-centroid distances from stage 2; positions measured here stay with this worker,
+    # since concurrent workers saving the shared table would overwrite each other
+    distance_table = CentroidDistanceTable.load(distance_table_path(statistics_file_path))
+    # Co-located station groups from stage 2; without the file every station is its own group
+    station_groups = StationGroups.load(station_groups_path(statistics_file_path)) if deduplicate_stations else StationGroups()
+
+    # Counties without a centroid have nothing to write
+    fips_level_keys = [fips for fips in json_data if normalize_fips(fips) in centroids]
+    os.makedirs(unit_directory, exist_ok=True)
+
+    with TaskQueue(queue_path, lease_seconds=lease_seconds) as task_queue:
+        # Every worker may seed the queue; tasks already queued by another worker are kept
+        added = task_queue.add_tasks(json_data, fips_level_keys)
+        counts = task_queue.counts()
+        logger.info("%s: %d tasks added, %s", worker, added, counts)
+        # Other workers share the queue, so this worker's total is unknown
+        progress = ProgressLog(logger, None, unit="tasks")
+
+        while True:
+            task = task_queue.lease(worker)
+            if task is None:
+                break
+            start_time = time.time()
+            try:
+                with task_queue.heartbeat(task, worker) as heartbeat:
+                    rows = run_task(task, json_data, centroids, observation_cache, distance_table, aggregation_mode, match_window, unit_directory, station_groups)
+            except Exception as e:
+                logger.exception("%s: %s %s failed", worker, task.fips, task.year)
+                task_queue.fail(task, worker, e)
+                continue
+            if heartbeat.lost:
+                logger.warning("%s: lease of %s %s was taken over; its output is the same", worker, task.fips, task.year)
+            task_queue.complete(task, worker)
+            metrics.add_time("county", time.time() - start_time, fips=task.fips)
+            progress.done(task.fips, rows, time.time() - start_time, year=task.year, cost=task.cost, worker=worker)
+
+        counts = task_queue.counts()
+        logger.info("%s: no task left to lease, %s", worker, counts)
+
+        # The worker that finds the whole queue done writes the combined CSV
+        if task_queue.is_finished():
+            output_csv_filename = f"{fips_level_keys[0]}_data.csv"
+            missing = merge_unit_outputs(unit_directory, json_data, fips_level_keys, output_csv_filename, OUTPUT_FIELDNAMES[aggregation_mode])
+            logger.info("Wrote %s; %d county-years without output (%d failed tasks)", output_csv_filename, len(missing), counts['failed'][0])
+
+    stage_run.finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import csv
+import os
+import threading
+
+from columnar_output import ParquetDatasetWriter, output_path
+from metrics import metrics
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+# Message that stops the writer thread
+_STOP = None
+
+
+def send_rows(queue, key, rows, unit=None):
+    """
+    Hand a batch of rows (lists in fieldnames order) for `key` to the writer.
+
+    If `unit` (a (FIPS, year) or (FIPS, year, days) tuple) is given, the batch holds all rows of that
+    unit and the writer records it, with the days of the year it covers, in its progress journal once
+    the rows are on disk.
+    """
+    if rows or unit is not None:
+        queue.put((key, (rows, unit)))
+
+
+def send_done(queue, key):
+    """
+    Tell the writer that no more rows will come for `key`.
+    """
+    queue.put((key, None))
+
+
+class SingleWriter:
+    """
+    The only writer of a stage-5 output CSV.
+
+    Workers put batches of rows for a key on a multiprocessing queue, then a done message once a key is
+    complete (see send_rows and send_done). A background thread in the parent process writes the
+    batches through one large buffer, so rows of different workers never interleave and each batch
+    costs one queue transfer instead of an open/write/close per row.
+
+    With `key_order`, output follows that order: batches of a key wait in memory until every earlier
+    key is done, so the file does not depend on worker scheduling. Rows within a key keep the order
+    they were sent in. The waiting batches are not bounded, so one slow early key can hold most of
+    the output in memory.
+
+    With output_format="parquet" the rows go to a ParquetDatasetWriter in the directory named after
+    file_path instead.
+
+    With a `journal` (CSV only, from open_journal, which already cut the file back to the last
+    committed unit), the file is appended to, and every batch sent with a unit is flushed, fsynced
+    and recorded after it is written.
+    """
+
+    def __init__(self, file_path, fieldnames, queue, key_order=None, buffer_size=DEFAULT_BUFFER_SIZE, output_format="csv", journal=None):
+        if journal is not None and output_format != "csv":
+            raise ValueError("Resuming from a progress journal requires CSV output")
+        self.file_path = file_path
+        self.journal = journal
+        self._csvfile = None
+        self.output_format = output_format
+        self.fieldnames = list(fieldnames)
+        self.queue = queue
+        self.key_order = list(key_order) if key_order is not None else None
+        self.buffer_size = buffer_size
+        self.rows_written = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        """
+        Write everything still queued, close the file and re-raise any error of the writer thread.
+        """
+        self.queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            if self.output_format == "parquet":
+                with ParquetDatasetWriter(output_path(self.file_path, self.output_format), self.fieldnames) as writer:
+                    self._drain(writer)
+            else:
+                offset = self.journal.committed_offset() if self.journal is not None else 0
+                with open(self.file_path, mode='a' if offset else 'w', newline='', encoding='utf-8', buffering=self.buffer_size) as csvfile:
+                    self._csvfile = csvfile
+                    writer = csv.writer(csvfile, delimiter=',')
+                    if not offset:
+                        writer.writerow(self.fieldnames)
+                    self._drain(writer)
+        except Exception as e:
+            self._error = e
+            # Keep draining so workers blocked on a full queue can finish
+            while self.queue.get() is not _STOP:
+                pass
+
+    def _drain(self, writer):
+        if self.key_order is None:
+            self._write_as_received(writer)
+        else:
+            self._write_in_order(writer)
+
+    def _write_rows(self, writer, batch):
+        rows, unit = batch
+        with metrics.timer("write"):
+            writer.writerows(rows)
+            if unit is not None and self.journal is not None:
+                self._csvfile.flush()
+                os.fsync(self._csvfile.fileno())
+                self.journal.record(unit[0], unit[1], self._csvfile.tell(), len(rows), days=unit[2] if len(unit) > 2 else ())
+        self.rows_written += len(rows)
+        metrics.count("rows_written", len(rows))
+
+    def _write_as_received(self, writer):
+        while True:
+            message = self.queue.get()
+            if message is _STOP:
+                return
+            _, batch = message
+            if batch is not None:
+                self._write_rows(writer, batch)
+
+    def _write_in_order(self, writer):
+        position = 0
+        pending = {}
+        done = set()
+
+        while True:
+            message = self.queue.get()
+            if message is _STOP:
+                break
+            key, batch = message
+            current = self.key_order[position] if position < len(self.key_order) else None
+
+            if batch is not None:
+                if key == current:
+                    self._write_rows(writer, batch)
+                else:
+                    pending.setdefault(key, []).append(batch)
+                continue
+
+            done.add(key)
+            # Move past every finished key, writing the batches that were waiting on it
+            while position < len(self.key_order) and self.key_order[position] in done:
+                position += 1
+                if position < len(self.key_order):
+                    for batch in pending.pop(self.key_order[position], []):
+                        self._write_rows(writer, batch)
+
+        # Keys that never finished (a failed worker) or were not in key_order go last
+        for key in self.key_order[position:] + [key for key in pending if key not in self.key_order]:
+            for batch in pending.pop(key, []):
+                self._write_rows(writer, batch)
@@ -0,0 +1,176 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from benchmarks.synthetic import generate_workload
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(REPOSITORY, "benchmarks", "baseline.json")
+
+# A stage regresses when its time or peak RSS exceeds the baseline by more than this share
+DEFAULT_TOLERANCE = 0.25
+
+
+def run_stage(command, work_directory):
+    """
+    Run one stage in its own process and measure it.
+
+    Peak RSS comes from wait4, which reports the largest of the process and the children it
+    waited for (e.g. a ProcessPoolExecutor's workers); it is None where wait4 is not available.
+
+    Returns:
+    tuple: (seconds, peak RSS in bytes or None, combined stdout and stderr)
+    """
+    environment = dict(os.environ, PYTHONPATH=REPOSITORY)
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, cwd=work_directory, env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read().decode("utf-8", errors="replace")
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # Kilobytes on Linux, bytes on macOS
+        peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    else:
+        process.wait()
+        peak_rss = None
+    seconds = time.perf_counter() - start_time
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed with exit code {process.returncode}:\n{output[-2000:]}")
+    return seconds, peak_rss, output
+
+
+def script(name):
+    return [sys.executable, os.path.join(REPOSITORY, name)]
+
+
+def count_csv_rows(path):
+    with open(path, mode='r', newline='', encoding='utf-8') as file:
+        return max(sum(1 for _ in file) - 1, 0)
+
+
+def run_benchmarks(scale="small", work_directory=None, stage5_script="5.downloading_comparing3.py", seed=0):
+    """
+    Generate a synthetic workload and time every stage on it, each in a fresh process, in pipeline
+    order: stage 2 builds the county statistics, stage 4 the work manifest, "isd_parse" parses the
+    station-year files into the observation cache (what stage 5 does after downloading), and
+    stage 5 aggregates from the warm cache, so no stage touches the network.
+
+    Returns:
+    dict: Results per stage ("seconds", "peak_rss_bytes", "items", "unit", "throughput") plus an
+        "end_to_end" total and the workload sizes.
+    """
+    work_directory = work_directory or os.path.join(REPOSITORY, "benchmarks", "work", scale)
+    if os.path.exists(work_directory):
+        shutil.rmtree(work_directory)
+
+    start_time = time.perf_counter()
+    workload = generate_workload(work_directory, scale, seed=seed)
+    generation_seconds = time.perf_counter() - start_time
+    year = workload["year"]
+
+    parse_command = [
+        sys.executable, "-c",
+        "import json, sys; from benchmarks.synthetic import fill_observation_cache; "
+        "print(json.dumps(fill_observation_cache('.', int(sys.argv[1]), json.loads(sys.argv[2]))))",
+        str(year), json.dumps(workload["missing_stations"]),
+    ]
+    stages = [
+        ("stage2", script("2.nearest_csv.py"), lambda output: (workload["counties"], "counties")),
+        ("stage4", script("4.getting_urls.py"), lambda output: (workload["necessary_fips_rows"], "FIPS-date rows")),
+        ("isd_parse", parse_command, lambda output: (int(output.strip().splitlines()[-1]), "ISD rows")),
+        ("stage5", script(stage5_script), lambda output: (count_csv_rows(os.path.join(work_directory, "6001_data.csv")), "hourly rows")),
+    ]
+
+    results = {}
+    for name, command, measure in stages:
+        seconds, peak_rss, output = run_stage(command, work_directory)
+        items, unit = measure(output)
+        results[name] = {
+            "seconds": round(seconds, 3),
+            "peak_rss_bytes": peak_rss,
+            "items": items,
+            "unit": unit,
+            "throughput": round(items / seconds, 1) if seconds else None,
+        }
+        print(format_result(name, results[name]))
+
+    rss_values = [result["peak_rss_bytes"] for result in results.values() if result["peak_rss_bytes"] is not None]
+    results["end_to_end"] = {
+        "seconds": round(sum(result["seconds"] for result in results.values()), 3),
+        "peak_rss_bytes": max(rss_values) if rss_values else None,
+        "items": workload["counties"],
+        "unit": "counties",
+    }
+    results["end_to_end"]["throughput"] = round(workload["counties"] / results["end_to_end"]["seconds"], 1)
+    print(format_result("end_to_end", results["end_to_end"]))
+
+    return {
+        "scale": scale,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "generation_seconds": round(generation_seconds, 3),
+        "workload": {key: value for key, value in workload.items() if key != "missing_stations"},
+        "stages": results,
+    }
+
+
+def format_result(name, result):
+    rss = f"{result['peak_rss_bytes'] / 1024 ** 2:8.1f} MiB" if result["peak_rss_bytes"] is not None else "      n/a"
+    return f"{name:<11} {result['seconds']:9.3f}s {rss}  {result['throughput']:>12,.1f} {result['unit']}/s"
+
+
+def compare_to_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Stages slower or larger than the baseline of the same scale by more than `tolerance`.
+
+    Returns:
+    list: Messages describing each regression (empty if none).
+    """
+    regressions = []
+    for name, result in report["stages"].items():
+        reference = baseline["stages"].get(name)
+        if reference is None:
+            continue
+        for metric in ("seconds", "peak_rss_bytes"):
+            if result[metric] is None or not reference.get(metric):
+                continue
+            ratio = result[metric] / reference[metric]
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name} {metric}: {result[metric]} vs baseline {reference[metric]} ({ratio:.2f}x)")
+    return regressions
+
+
+def main():
+    # "small", "medium" or "large" (see benchmarks.synthetic.SCALES)
+    scale = "small"
+    # Record this run as the new baseline instead of comparing against it
+    update_baseline = False
+    tolerance = DEFAULT_TOLERANCE
+
+    report = run_benchmarks(scale)
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as baseline_file:
+            baselines = json.load(baseline_file)
+
+    if update_baseline or scale not in baselines:
+        baselines[scale] = report
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2)
+        print(f"Baseline for {scale} written to {BASELINE_FILE}")
+        return
+
+    regressions = compare_to_baseline(report, baselines[scale], tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"No regression beyond {tolerance:.0%} of the {scale} baseline")
+
+if __name__ == "__main__":
+    main()
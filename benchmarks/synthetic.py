@@ -0,0 +1,282 @@
+import csv
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from isd_observations import MISSING_TMP, MISSING_WND, load_station_observations
+from observation_cache import ObservationCache
+
+# File names the pipeline scripts read from their working directory
+STATION_FILE = "station_data_2024-05-14_18-54-47.csv"
+CENTROIDS_FILE = "County Centroids.csv"
+NECESSARY_FIPS_FILE = "necessaryFIPS.csv"
+ISD_DIRECTORY = "isd"
+
+# Columns of a global-hourly access file, in NOAA's order
+ISD_COLUMNS = [
+    "STATION", "DATE", "SOURCE", "LATITUDE", "LONGITUDE", "ELEVATION", "NAME", "REPORT_TYPE",
+    "CALL_SIGN", "QUALITY_CONTROL", "WND", "CIG", "VIS", "TMP", "DEW", "SLP", "AA1",
+]
+
+# California-sized region: dense enough that a 50-mile radius finds several stations
+DEFAULT_REGION = (32.5, 42.0, -124.4, -114.1)
+
+# Workload sizes; "days" is the span of every station-year file and of the requested dates
+SCALES = {
+    "small": {"counties": 40, "stations": 120, "metros": 3, "days": 31, "dates_per_county": 10},
+    "medium": {"counties": 200, "stations": 600, "metros": 6, "days": 120, "dates_per_county": 40},
+    "large": {"counties": 1000, "stations": 2500, "metros": 12, "days": 366, "dates_per_county": 120},
+}
+
+
+def station_id(usaf, wban):
+    # The pipeline joins USAF and WBAN without padding (see StationIndex.station_ids)
+    return f"{usaf}{wban}"
+
+
+def generate_stations(count, metros, rng, region=DEFAULT_REGION):
+    """
+    Synthetic station list in the columns of 1.getting_stationData.py's CSV.
+
+    Half of the stations cluster around a few metro centers, so some counties have dozens of nearby
+    stations and rural ones only a couple, as in the real catalog.
+
+    Returns:
+    DataFrame: One row per station.
+    """
+    south, north, west, east = region
+    centers = np.column_stack((rng.uniform(south, north, metros), rng.uniform(west, east, metros)))
+    clustered = count // 2
+    metro = rng.integers(0, metros, clustered)
+    latitudes = np.concatenate((centers[metro, 0] + rng.normal(0, 0.25, clustered), rng.uniform(south, north, count - clustered)))
+    longitudes = np.concatenate((centers[metro, 1] + rng.normal(0, 0.25, clustered), rng.uniform(west, east, count - clustered)))
+
+    usaf = 720000 + np.arange(count)
+    # Most stations have no WBAN number (99999), like ISD
+    wban = np.where(rng.random(count) < 0.7, 99999, rng.integers(10000, 99999, count))
+    return pd.DataFrame({
+        "usaf": usaf,
+        "wban": wban,
+        "station_name": [f"SYNTHETIC STATION {number}" for number in range(count)],
+        "country": "US",
+        "state": "CA",
+        "latitude": np.round(latitudes, 3),
+        "longitude": np.round(longitudes, 3),
+        "elevation": np.round(rng.uniform(0, 2000, count), 1),
+        "start": 19730101,
+        "end": 20240501,
+    })
+
+
+def generate_centroids(count, stations, rng, region=DEFAULT_REGION):
+    """
+    Synthetic county centroids in the columns of County Centroids.csv, a fifth of them placed next
+    to station clusters.
+
+    Returns:
+    DataFrame: One row per county, FIPS zero-padded to five digits.
+    """
+    south, north, west, east = region
+    near_stations = count // 5
+    picked = rng.integers(0, len(stations), near_stations)
+    latitudes = np.concatenate((stations["latitude"].to_numpy()[picked] + rng.normal(0, 0.1, near_stations), rng.uniform(south, north, count - near_stations)))
+    longitudes = np.concatenate((stations["longitude"].to_numpy()[picked] + rng.normal(0, 0.1, near_stations), rng.uniform(west, east, count - near_stations)))
+    fips = 6001 + 2 * np.arange(count)
+    return pd.DataFrame({
+        "County_Name": [f"Synthetic {number} County" for number in range(count)],
+        "FIPS": [f"{code:05d}" for code in fips],
+        "State": "CA",
+        "Latitude": np.round(latitudes, 8),
+        "Longitude": np.round(longitudes, 8),
+    })
+
+
+def generate_necessary_fips(centroids, year, days, dates_per_county, rng):
+    """
+    Synthetic necessaryFIPS.csv: random dates per county within the first `days` of the year, with
+    some dates listed twice as in the real file.
+
+    Returns:
+    DataFrame: Columns county_fips, year, month, day.
+    """
+    first = date(year, 1, 1)
+    rows = []
+    for fips in centroids["FIPS"]:
+        offsets = rng.integers(0, days, dates_per_county)
+        for offset in offsets.tolist():
+            day = first + timedelta(days=offset)
+            rows.append((int(fips), year, day.month, day.day))
+    return pd.DataFrame(rows, columns=["county_fips", "year", "month", "day"])
+
+
+def _pick(rng, count, probability, values, otherwise):
+    return np.where(rng.random(count) < probability, values, otherwise)
+
+
+def generate_isd_frame(station, year, days, rng, specials_per_day=4, missing_rate=0.05):
+    """
+    Synthetic global-hourly rows of one station-year.
+
+    Rows are the hourly FM-15 reports at minute 53 plus random special reports, in time order.
+    Every field stage 5 decodes carries the real format and its sentinels: WND "999,9,9,9999,9",
+    TMP "+9999,9", LATITUDE/LONGITUDE "999", blank AA1 and non-hourly AA1 periods. A few stations
+    report a move part-way through the year.
+
+    Args:
+    station (Series): Row of generate_stations.
+    year (int): Year of the file.
+    days (int): Number of days covered from January 1st.
+    rng (Generator): Random source.
+    specials_per_day (int): Average number of non-hourly reports per day.
+    missing_rate (float): Share of rows where each measurement is missing.
+
+    Returns:
+    DataFrame: Rows with ISD_COLUMNS.
+    """
+    hourly = np.arange(days * 24) * 60 + 53
+    specials = rng.integers(0, days * 24 * 60, days * specials_per_day)
+    minutes = np.sort(np.concatenate((hourly, specials)))
+    count = len(minutes)
+    timestamps = pd.Timestamp(year=year, month=1, day=1) + pd.to_timedelta(minutes, unit="m")
+
+    latitude = float(station["latitude"])
+    longitude = float(station["longitude"])
+    if rng.random() < 0.1:
+        moved = np.arange(count) >= count // 2
+        latitudes = np.where(moved, latitude + 0.01, latitude)
+        longitudes = np.where(moved, longitude - 0.01, longitude)
+    else:
+        latitudes = np.full(count, latitude)
+        longitudes = np.full(count, longitude)
+    latitude_text = _pick(rng, count, missing_rate / 5, "999", np.char.mod("%.5f", latitudes))
+    longitude_text = _pick(rng, count, missing_rate / 5, "999", np.char.mod("%.5f", longitudes))
+
+    speeds = rng.integers(0, 150, count)
+    directions = rng.integers(1, 37, count) * 10
+    wind = np.char.add(np.char.add(np.char.mod("%03d", directions), ",1,N,"), np.char.add(np.char.mod("%04d", speeds), ",1"))
+    wind = _pick(rng, count, missing_rate, MISSING_WND, wind)
+
+    temperatures = np.round(150 + 80 * np.sin(minutes / (24 * 60) * 2 * np.pi) + rng.normal(0, 20, count)).astype(int)
+    qualities = np.where(rng.random(count) < 0.95, "1", "5")
+    temperature = np.char.add(np.char.mod("%+05d", temperatures), np.char.add(",", qualities))
+    temperature = _pick(rng, count, missing_rate, MISSING_TMP, temperature)
+
+    depths = np.where(rng.random(count) < 0.8, 0, rng.integers(1, 120, count))
+    periods = np.where(rng.random(count) < 0.9, "01", "06")
+    precipitation = np.char.add(np.char.add(periods, ","), np.char.add(np.char.mod("%04d", depths), ",9,1"))
+    # Most reports carry no AA1 group at all
+    precipitation = _pick(rng, count, 0.6, "", precipitation)
+
+    identifier = station_id(station["usaf"], station["wban"])
+    return pd.DataFrame({
+        "STATION": identifier,
+        "DATE": timestamps.strftime("%Y-%m-%dT%H:%M:%S"),
+        "SOURCE": "4",
+        "LATITUDE": latitude_text,
+        "LONGITUDE": longitude_text,
+        "ELEVATION": str(station["elevation"]),
+        "NAME": station["station_name"],
+        "REPORT_TYPE": np.where(minutes % 60 == 53, "FM-15", "FM-16"),
+        "CALL_SIGN": "99999",
+        "QUALITY_CONTROL": "V020",
+        "WND": wind,
+        "CIG": "22000,1,9,N",
+        "VIS": "016093,1,9,9",
+        "TMP": temperature,
+        "DEW": "+9999,9",
+        "SLP": "99999,9",
+        "AA1": precipitation,
+    }, columns=ISD_COLUMNS)
+
+
+def write_isd_file(directory, station, year, days, rng, **kwargs):
+    """
+    Write one station-year as NOAA serves it (every value quoted), named <station ID>.csv.
+
+    A tenth of the files omit the AA1 column, as files of stations without precipitation do.
+
+    Returns:
+    tuple: (path, number of rows)
+    """
+    frame = generate_isd_frame(station, year, days, rng, **kwargs)
+    if rng.random() < 0.1:
+        frame = frame.drop(columns=["AA1"])
+    path = os.path.join(directory, f"{station_id(station['usaf'], station['wban'])}.csv")
+    frame.to_csv(path, index=False, quoting=csv.QUOTE_ALL)
+    return path, len(frame)
+
+
+def generate_workload(directory, scale="small", year=2020, seed=0, missing_station_rate=0.05):
+    """
+    Write a complete synthetic stage-1 to stage-4 input set into `directory`.
+
+    Writes the station CSV, County Centroids.csv, necessaryFIPS.csv and one global-hourly file per
+    station under isd/<year>/. A share of the stations get no file, like station-years NOAA does
+    not have.
+
+    Args:
+    directory (str): Working directory of the benchmark run.
+    scale (str or dict): Name in SCALES, or a dict with the same keys.
+    year (int): Year of the observations.
+    seed (int): Seed of the random generator, so runs of one scale see the same data.
+    missing_station_rate (float): Share of stations without an observation file.
+
+    Returns:
+    dict: Sizes of the generated workload.
+    """
+    settings = SCALES[scale] if isinstance(scale, str) else scale
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    stations = generate_stations(settings["stations"], settings["metros"], rng)
+    stations.to_csv(os.path.join(directory, STATION_FILE), index=False)
+    centroids = generate_centroids(settings["counties"], stations, rng)
+    centroids.to_csv(os.path.join(directory, CENTROIDS_FILE), index=False)
+    necessary_fips = generate_necessary_fips(centroids, year, settings["days"], settings["dates_per_county"], rng)
+    necessary_fips.to_csv(os.path.join(directory, NECESSARY_FIPS_FILE), index=False)
+
+    isd_directory = os.path.join(directory, ISD_DIRECTORY, str(year))
+    os.makedirs(isd_directory, exist_ok=True)
+    isd_rows = 0
+    isd_bytes = 0
+    missing = []
+    for _, station in stations.iterrows():
+        if rng.random() < missing_station_rate:
+            missing.append(station_id(station["usaf"], station["wban"]))
+            continue
+        path, rows = write_isd_file(isd_directory, station, year, settings["days"], rng)
+        isd_rows += rows
+        isd_bytes += os.path.getsize(path)
+
+    return {
+        "year": year,
+        "counties": len(centroids),
+        "stations": len(stations),
+        "necessary_fips_rows": len(necessary_fips),
+        "isd_files": len(stations) - len(missing),
+        "isd_rows": isd_rows,
+        "isd_bytes": isd_bytes,
+        "missing_stations": missing,
+    }
+
+
+def fill_observation_cache(directory, year, missing_stations, cache_directory="observation_cache"):
+    """
+    Parse every synthetic station-year into the stage-5 observation cache, as a stage-5 run does
+    after downloading, and mark the stations without a file as missing so no run tries NOAA.
+
+    Returns:
+    int: Number of parsed rows.
+    """
+    observation_cache = ObservationCache(os.path.join(directory, cache_directory))
+    isd_directory = os.path.join(directory, ISD_DIRECTORY, str(year))
+    rows = 0
+    for file_name in sorted(os.listdir(isd_directory)):
+        observations = load_station_observations(os.path.join(isd_directory, file_name))
+        observation_cache.put(observations, year)
+        rows += len(observations)
+    for missing in missing_stations:
+        observation_cache.mark_missing(missing, year)
+    return rows
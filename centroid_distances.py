@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+
+from county_data import normalize_fips
+from metrics import metrics
+from station_distance import distances_miles
+
+# Positions are matched after rounding to 3 decimals (about 100 m), the precision of the station
+# catalog, so the catalog positions stage 2 measures match the positions ISD rows report
+COORDINATE_DECIMALS = 3
+
+TABLE_DTYPE = np.dtype([
+    ("fips", np.int32),
+    ("station", "S16"),
+    ("latitude", np.float64),
+    ("longitude", np.float64),
+    ("miles", np.float64),
+])
+
+
+def distance_table_path(statistics_file_path):
+    """
+    File of the distance table written next to a county_station_statistics*.csv file.
+    """
+    stem, _ = os.path.splitext(statistics_file_path)
+    return f"{stem}.distances.npy"
+
+
+def _round_coordinates(values):
+    return np.round(np.asarray(values, dtype=np.float64), COORDINATE_DECIMALS)
+
+
+class CountyDistances:
+    """
+    Memoized distances from one county centroid to the positions its stations report.
+
+    Keys are (station ID, rounded latitude, rounded longitude). A position that is not in the table
+    yet (a new station, or a station reporting a move) is computed once with station_distance and
+    added, so every later row at that position is a dictionary lookup. The object only holds the
+    county's own entries, so it is cheap to send to a worker process.
+    """
+
+    def __init__(self, fips, county_centroid, entries=None, distance_method="vincenty"):
+        self.fips = normalize_fips(fips) if fips is not None else None
+        self.county_centroid = county_centroid
+        self.entries = dict(entries or {})
+        self.distance_method = distance_method
+        # Entries computed here rather than loaded, for merging back into the table
+        self.new_entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def distances(self, station_ids, latitudes, longitudes):
+        """
+        Distance in miles from the centroid to each row's reported position.
+
+        Args:
+        station_ids (list): Station ID of each row.
+        latitudes (ndarray): Reported latitude of each row.
+        longitudes (ndarray): Reported longitude of each row.
+
+        Returns:
+        ndarray: Distances in miles, one per row.
+        """
+        if not len(station_ids):
+            return np.empty(0, dtype=np.float64)
+        with metrics.timer("distance"):
+            return self._distances(station_ids, latitudes, longitudes)
+
+    def _distances(self, station_ids, latitudes, longitudes):
+        # Look up each distinct (station, position) once
+        station_names, station_codes = np.unique(np.asarray(station_ids, dtype=np.str_), return_inverse=True)
+        keys = np.column_stack((station_codes.reshape(-1), _round_coordinates(latitudes), _round_coordinates(longitudes)))
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+
+        lookup_keys = [
+            (str(station_names[int(code)]), latitude, longitude)
+            for code, latitude, longitude in unique_keys.tolist()
+        ]
+        miles = np.array([self.entries.get(key, np.nan) for key in lookup_keys], dtype=np.float64)
+
+        missing = np.flatnonzero(np.isnan(miles))
+        metrics.count("distance_memo_hits", len(miles) - len(missing))
+        metrics.count("distance_memo_misses", len(missing))
+        if len(missing):
+            origin_latitude, origin_longitude = self.county_centroid
+            miles[missing] = distances_miles(
+                origin_latitude,
+                origin_longitude,
+                unique_keys[missing, 1],
+                unique_keys[missing, 2],
+                method=self.distance_method,
+            )
+            for position in missing.tolist():
+                self.entries[lookup_keys[position]] = self.new_entries[lookup_keys[position]] = float(miles[position])
+
+        return miles[inverse.reshape(-1)]
+
+
+class CentroidDistanceTable:
+    """
+    Station-to-centroid distances for every county, keyed by (FIPS, station, rounded position).
+
+    Stage 2 fills the table from the station catalog positions it already measured; stage 5 takes
+    a CountyDistances per county, which adds the positions ISD rows report that the catalog did not
+    (stations that moved), and merges them back so the next run finds them too.
+    """
+
+    def __init__(self, distance_method="vincenty"):
+        self.distance_method = distance_method
+        # FIPS -> {(station, latitude, longitude): miles}
+        self.counties = {}
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.counties.values())
+
+    def add_county(self, fips, station_ids, latitudes, longitudes, miles):
+        """
+        Record the distances of one county's stations at the given positions.
+        """
+        entries = self.counties.setdefault(normalize_fips(fips), {})
+        for station_id, latitude, longitude, distance in zip(
+            station_ids,
+            _round_coordinates(latitudes).tolist(),
+            _round_coordinates(longitudes).tolist(),
+            np.asarray(miles, dtype=np.float64).tolist(),
+        ):
+            entries[(str(station_id), latitude, longitude)] = distance
+
+    def county_entries(self, fips):
+        """
+        Known entries of one county, e.g. to build its CountyDistances in a worker process.
+        """
+        return dict(self.counties.get(normalize_fips(fips), {}))
+
+    def county(self, fips, county_centroid):
+        """
+        Distances of one county, as a CountyDistances that memoizes new positions.
+        """
+        return CountyDistances(
+            normalize_fips(fips),
+            county_centroid,
+            self.counties.get(normalize_fips(fips)),
+            distance_method=self.distance_method,
+        )
+
+    def merge(self, county_distances):
+        """
+        Fold positions a CountyDistances computed back into the table.
+
+        Returns:
+        int: Number of entries added or refreshed.
+        """
+        self.counties.setdefault(county_distances.fips, {}).update(county_distances.new_entries)
+        return len(county_distances.new_entries)
+
+    def save(self, path):
+        records = [
+            (int(fips), station_id, latitude, longitude, miles)
+            for fips, entries in self.counties.items()
+            for (station_id, latitude, longitude), miles in entries.items()
+        ]
+        temporary_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(temporary_path, np.array(records, dtype=TABLE_DTYPE))
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, distance_method="vincenty"):
+        """
+        Read a table written by save; a missing file gives an empty table.
+
+        Entries whose position is not rounded to COORDINATE_DECIMALS come from an older table and
+        are dropped; they are measured again when needed.
+        """
+        table = cls(distance_method=distance_method)
+        if not os.path.exists(path):
+            return table
+        records = np.load(path)
+        records = records[
+            (_round_coordinates(records["latitude"]) == records["latitude"])
+            & (_round_coordinates(records["longitude"]) == records["longitude"])
+        ]
+        for fips, station_id, latitude, longitude, miles in records.tolist():
+            table.counties.setdefault(str(fips), {})[(station_id.decode(), latitude, longitude)] = miles
+        return table
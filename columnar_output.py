@@ -0,0 +1,230 @@
+import csv
+import os
+import shutil
+from contextlib import contextmanager
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+OUTPUT_FORMATS = ("csv", "parquet")
+
+# Hive-style directories: {root}/state=CA/year=2020/part-0.parquet
+PARTITION_COLUMNS = ("state", "year")
+
+DEFAULT_ROW_GROUP_SIZE = 128 * 1024
+
+DATE_FORMAT = "%Y-%m-%dT%H"
+
+# Columns of the stage-5 CSV schemas stored as dictionary-encoded strings, since every hourly row of
+# a county repeats them
+DICTIONARY_COLUMNS = {
+    "state",
+    "county_name",
+    "station identifiers (USAF WBAN)",
+    "nearest station",
+    "nearest temperature quality",
+}
+
+SMALL_INTEGER_COLUMNS = {"hour", "day", "month"}
+
+
+def column_type(name):
+    """
+    Arrow type a stage-5 output column is stored as.
+
+    Measurements and distances are float32, "date" becomes a timestamp and the repeated string
+    columns are dictionary-encoded.
+    """
+    if name in DICTIONARY_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    if name in SMALL_INTEGER_COLUMNS:
+        return pa.int8()
+    if name == "year":
+        return pa.int16()
+    if name == "county_fips":
+        return pa.int32()
+    if name == "date":
+        return pa.timestamp("s")
+    return pa.float32()
+
+
+def _to_array(values, arrow_type):
+    if pa.types.is_timestamp(arrow_type):
+        return pc.strptime(pa.array(values, pa.string()), format=DATE_FORMAT, unit="s")
+    if pa.types.is_dictionary(arrow_type):
+        return pa.array([None if value is None else str(value) for value in values], pa.string()).dictionary_encode()
+    if pa.types.is_integer(arrow_type):
+        return pa.array([None if value is None or value == "" else int(value) for value in values], arrow_type)
+    return pa.array([None if value is None or value == "" else float(value) for value in values], arrow_type)
+
+
+class ParquetDatasetWriter:
+    """
+    Writes stage-5 rows as a typed Parquet dataset partitioned by state and year.
+
+    Accepts the same calls as the csv.DictWriter it replaces (writeheader, writerow with a dict) and
+    writerows with dicts or lists in fieldnames order, so it can stand in for either CSV writer.
+    Rows are buffered per partition and written as one row group every `row_group_size` rows; each
+    partition is a single file. Partition columns live in the directory names, not in the files.
+
+    Read back with pyarrow.parquet.read_table(root_path) or pandas.read_parquet(root_path).
+    """
+
+    def __init__(self, root_path, fieldnames, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        if pa is None:
+            raise ImportError("Parquet output requires pyarrow (pip install pyarrow)")
+        missing = [column for column in PARTITION_COLUMNS if column not in fieldnames]
+        if missing:
+            raise ValueError(f"Partition columns missing from fieldnames: {missing}")
+
+        self.root_path = root_path
+        self.fieldnames = list(fieldnames)
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+
+        self._partition_positions = [self.fieldnames.index(column) for column in PARTITION_COLUMNS]
+        self._data_columns = [
+            (position, name) for position, name in enumerate(self.fieldnames) if name not in PARTITION_COLUMNS
+        ]
+        self.schema = pa.schema([pa.field(name, column_type(name)) for _, name in self._data_columns])
+
+        # partition values -> buffered rows, and -> open ParquetWriter
+        self._buffers = {}
+        self._writers = {}
+
+        # Same as opening the CSV with mode 'w': a rerun replaces the previous output
+        shutil.rmtree(root_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def writeheader(self):
+        # The schema is stored in every file
+        pass
+
+    def commit(self, fips, year, days=()):
+        # Parquet output is rewritten on every run, so there is no progress to record
+        pass
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        for row in rows:
+            values = [row[name] for name in self.fieldnames] if isinstance(row, dict) else row
+            partition = tuple(str(values[position]) for position in self._partition_positions)
+            buffer = self._buffers.setdefault(partition, [])
+            buffer.append(values)
+            if len(buffer) >= self.row_group_size:
+                self._flush(partition)
+
+    def _flush(self, partition):
+        rows = self._buffers.pop(partition, None)
+        if not rows:
+            return
+
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays(
+            [_to_array(columns[position], self.schema.field(name).type) for position, name in self._data_columns],
+            schema=self.schema,
+        )
+
+        writer = self._writers.get(partition)
+        if writer is None:
+            directory = os.path.join(
+                self.root_path,
+                *(f"{column}={value}" for column, value in zip(PARTITION_COLUMNS, partition)),
+            )
+            os.makedirs(directory, exist_ok=True)
+            writer = pq.ParquetWriter(os.path.join(directory, "part-0.parquet"), self.schema)
+            self._writers[partition] = writer
+
+        writer.write_table(table)
+        self.rows_written += len(rows)
+
+    def close(self):
+        for partition in list(self._buffers):
+            self._flush(partition)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+class JournaledDictWriter(csv.DictWriter):
+    """
+    csv.DictWriter that can mark a (FIPS, year) unit as durably written in a ProgressJournal.
+    """
+
+    def __init__(self, csvfile, fieldnames, journal=None, **kwargs):
+        super().__init__(csvfile, fieldnames=fieldnames, **kwargs)
+        self.csvfile = csvfile
+        self.journal = journal
+        self._unit_rows = 0
+
+    def writerow(self, rowdict):
+        self._unit_rows += 1
+        return super().writerow(rowdict)
+
+    def commit(self, fips, year, days=()):
+        """
+        Flush and fsync the rows written since the last commit and record them as one unit covering
+        `days` (days of the year).
+        """
+        if self.journal is None:
+            return
+        self.csvfile.flush()
+        os.fsync(self.csvfile.fileno())
+        self.journal.record(fips, year, self.csvfile.tell(), self._unit_rows, days=days)
+        self._unit_rows = 0
+
+
+def output_path(csv_path, output_format):
+    """
+    Where output goes for a format: the CSV file itself, or a dataset directory named after it.
+    """
+    if output_format == "parquet":
+        return os.path.splitext(csv_path)[0]
+    return csv_path
+
+
+@contextmanager
+def open_row_writer(csv_path, fieldnames, output_format="csv", journal=None):
+    """
+    Open the stage-5 output in the selected format.
+
+    Args:
+    csv_path (str): Output CSV file name; Parquet output goes to a directory of the same name
+        without the extension.
+    fieldnames (list): Output columns, in CSV order.
+    output_format (str): "csv" (default) or "parquet".
+    journal (ProgressJournal): If given (from open_journal, which already cut the CSV back to the
+        last committed unit), the CSV is appended to and writer.commit(fips, year) records finished
+        units.
+
+    Yields:
+    A writer with DictWriter's writerow(dict) and commit(fips, year); the CSV header is already
+    written.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    if journal is not None and output_format != "csv":
+        raise ValueError("Resuming from a progress journal requires CSV output")
+
+    if output_format == "parquet":
+        with ParquetDatasetWriter(output_path(csv_path, output_format), fieldnames) as writer:
+            yield writer
+        return
+
+    offset = journal.committed_offset() if journal is not None else 0
+    with open(csv_path, mode='a' if offset else 'w', newline='', encoding='utf-8') as csvfile:
+        writer = JournaledDictWriter(csvfile, fieldnames, journal, delimiter=',')
+        if not offset:
+            writer.writeheader()
+        yield writer
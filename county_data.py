@@ -0,0 +1,47 @@
+import csv
+
+
+def normalize_fips(fips):
+    """
+    FIPS code without zero padding, so "06037" and "6037" compare equal.
+    """
+    return str(int(fips))
+
+
+def load_county_centroids(file_path):
+    """
+    Read County Centroids.csv once.
+
+    Returns:
+    dict: Normalized FIPS -> (county_name, state, latitude, longitude).
+    """
+    centroids = {}
+    with open(file_path, mode='r', newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            centroids[normalize_fips(row["FIPS"])] = (
+                row["County_Name"],
+                row["State"],
+                float(row["Latitude"]),
+                float(row["Longitude"]),
+            )
+    return centroids
+
+
+def load_county_statistics(file_path):
+    """
+    Read county_station_statistics.csv once into a hash index.
+
+    Returns:
+    dict: Normalized FIPS -> (nearby station IDs, nearest station ID).
+    """
+    statistics = {}
+    # The statistics file is written with the platform encoding (cp1252 on Windows); only ASCII
+    # columns are read here, and latin-1 decodes any byte, so either encoding is accepted
+    with open(file_path, mode='r', newline='', encoding='latin-1') as file:
+        for row in csv.DictReader(file):
+            station_ids = row["Station_Identifiers_(USAF_WBAN)"]
+            statistics[normalize_fips(row["County_FIPS"])] = (
+                station_ids.split("|") if station_ids else [],
+                row["Nearest_Station"],
+            )
+    return statistics
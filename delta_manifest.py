@@ -0,0 +1,89 @@
+from collections.abc import Mapping
+
+from county_data import normalize_fips
+from work_manifest import WorkManifest, day_of_year
+
+# Work of the dates the stage-5 output does not hold yet, written by stage 4 in incremental mode
+DELTA_MANIFEST = "formatted_data.delta.manifest"
+
+
+def unit_days(year, month_days):
+    """
+    Day-of-year numbers of a county-year's (month, day) pairs, as the progress journal stores them.
+    """
+    return [day_of_year(year, month, day) for month, day in month_days]
+
+
+class PendingWork(Mapping):
+    """
+    View of a work list without the dates already in the stage-5 output.
+
+    Maps FIPS codes to {year: year_data} like formatted_data.json, where each year's "month-day"
+    keeps only the dates missing from `produced` (ProgressJournal.produced_days()). Years with no
+    date left are dropped, and so are counties with no year left, so the stage-5 loops only meet
+    new work. A unit the journal recorded without its days counts as complete.
+
+    county() returns a plain dict, so the view can feed ProcessPoolExecutor workers like a
+    WorkManifest.
+    """
+
+    def __init__(self, json_data, produced):
+        self.json_data = json_data
+        self.produced = produced
+        self._pending = {}
+        for fips in json_data:
+            county = self._county(fips)
+            if county:
+                self._pending[normalize_fips(fips)] = county
+
+    def _county(self, fips):
+        county = {}
+        for year, year_data in self.json_data[fips].items():
+            done = self.produced.get((normalize_fips(fips), str(year)), set())
+            if done is None:
+                continue
+            month_days = [
+                month_day for month_day, day in zip(year_data["month-day"], unit_days(year, year_data["month-day"]))
+                if day not in done
+            ]
+            if month_days:
+                county[year] = {**year_data, "month-day": month_days}
+        return county
+
+    def __getitem__(self, fips):
+        return self._pending[normalize_fips(fips)]
+
+    def __iter__(self):
+        return iter(self._pending)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, fips):
+        try:
+            return normalize_fips(fips) in self._pending
+        except (TypeError, ValueError):
+            return False
+
+    def county(self, fips):
+        return self._pending[normalize_fips(fips)]
+
+    def date_count(self):
+        """
+        Number of (FIPS, year, day) dates left.
+        """
+        return sum(len(year_data["month-day"]) for county in self._pending.values() for year_data in county.values())
+
+    def to_dict(self):
+        """
+        The pending work as a formatted_data.json-shaped dict, e.g. for write_work_manifest.
+        """
+        return dict(self._pending)
+
+
+def load_pending_work(journal, manifest_path=DELTA_MANIFEST):
+    """
+    Stage 4's delta manifest (at `manifest_path`) less the dates the journal recorded since, so
+    rerunning an interrupted incremental run only adds what is still missing.
+    """
+    return PendingWork(WorkManifest(manifest_path), journal.produced_days())
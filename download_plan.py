@@ -0,0 +1,157 @@
+import logging
+import os
+from collections import defaultdict
+
+from county_data import normalize_fips
+from downloader import content_lengths, download_all
+from observation_cache import DownloadFailedError
+
+logger = logging.getLogger(__name__)
+
+ACCESS_URL_TEMPLATE = "https://www.ncei.noaa.gov/data/global-hourly/access/{year}/{station_id}.csv"
+
+
+def station_year_url(station_id, year):
+    return ACCESS_URL_TEMPLATE.format(year=year, station_id=station_id)
+
+
+def station_id_from_url(url):
+    return os.path.basename(url).split('.')[0]
+
+
+def plan_downloads(json_data, fips_keys, observation_cache=None, skip_units=None, station_groups=None):
+    """
+    Compute the unique station-year files needed for a set of counties.
+
+    formatted_data.json lists the same station URL under every county that is near it; the plan
+    collapses those references so every file is fetched once.
+
+    Args:
+    json_data (dict): Contents of formatted_data.json.
+    fips_keys (iterable): FIPS codes selected for this run.
+    observation_cache (ObservationCache): If given, station-years already cached are not planned
+        for download.
+    skip_units (set): (FIPS, year) units already written (ProgressJournal.completed()), whose
+        stations are not needed.
+    station_groups (StationGroups): If given, only the preferred member of each co-located group
+        is planned; the per-county fetch falls back to another member if it has no data.
+
+    Returns:
+    dict: Plan with keys
+        "urls_by_year" (dict): year -> sorted list of URLs that still have to be downloaded,
+        "referenced_by_year" (dict): year -> sorted list of every URL the counties reference,
+        "county_requests" (int): requests a county-by-county run would make,
+        "unique_requests" (int): distinct station-year files referenced,
+        "colocated" (int): referenced files left out as co-located duplicates,
+        "cached" (int): distinct files already cached (or recently found missing),
+        "download_requests" (int): files left to download.
+    """
+    unique_urls = defaultdict(set)
+    county_requests = 0
+    for fips in fips_keys:
+        for year, year_data in json_data[f"{fips}"].items():
+            if skip_units and (normalize_fips(fips), str(year)) in skip_units:
+                continue
+            county_requests += len(year_data["nearby_stations"])
+            unique_urls[year].update(year_data["nearby_stations"])
+
+    colocated = 0
+    if station_groups is not None:
+        for year, urls in unique_urls.items():
+            preferred = set(station_groups.preferred_urls(sorted(urls), year))
+            colocated += len(urls) - len(preferred)
+            unique_urls[year] = preferred
+
+    urls_by_year = {}
+    unique_requests = 0
+    cached = 0
+    for year, urls in sorted(unique_urls.items()):
+        unique_requests += len(urls)
+        pending = sorted(
+            url for url in urls
+            if observation_cache is None or not (
+                observation_cache.has(station_id_from_url(url), year)
+                or observation_cache.is_missing(station_id_from_url(url), year)
+            )
+        )
+        cached += len(urls) - len(pending)
+        if pending:
+            urls_by_year[year] = pending
+
+    return {
+        "urls_by_year": urls_by_year,
+        "referenced_by_year": {year: sorted(urls) for year, urls in sorted(unique_urls.items())},
+        "county_requests": county_requests,
+        "unique_requests": unique_requests,
+        "colocated": colocated,
+        "cached": cached,
+        "download_requests": unique_requests - cached,
+    }
+
+
+def estimate_plan_bytes(plan):
+    """
+    Total size of the files left to download, from HEAD requests.
+
+    Returns:
+    int: Bytes to download (files reporting no size count as 0).
+    int: Number of planned files that do not exist on the server.
+    """
+    urls = [url for urls in plan["urls_by_year"].values() for url in urls]
+    lengths = content_lengths(urls)
+    missing = sum(1 for length in lengths.values() if length is None)
+    return sum(length for length in lengths.values() if length), missing
+
+
+def format_plan(plan, expected_bytes=None):
+    """
+    One-line human readable summary of a download plan.
+    """
+    summary = (
+        f"Download plan: {plan['county_requests']} county-level requests, "
+        f"{plan['unique_requests']} unique station-years, "
+        f"{plan['cached']} already cached, "
+        f"{plan['colocated']} co-located duplicates skipped, "
+        f"{plan['download_requests']} to download"
+    )
+    if expected_bytes is not None:
+        summary += f" ({expected_bytes / 1024 ** 2:.1f} MiB)"
+    return summary
+
+
+def execute_plan(plan, observation_cache, download_many=download_all, batch_size=256):
+    """
+    Download every planned station-year once and store the parsed observations in the cache.
+
+    The per-county computation afterwards reads these station-years from the cache. The cache
+    budget should be large enough to hold the whole plan, otherwise evicted files are fetched again.
+    Files are downloaded in batches and each raw CSV is deleted once it is cached, so disk usage for
+    raw files stays at one batch.
+
+    Args:
+    plan (dict): Plan returned by plan_downloads.
+    observation_cache (ObservationCache): Cache the parsed observations are stored in.
+    download_many (callable): Function that downloads a list of URLs (default: download_all).
+    batch_size (int): Number of files downloaded per batch (default: 256).
+
+    Returns:
+    int: Number of files downloaded.
+    """
+    downloaded_count = 0
+    for year, urls in plan["urls_by_year"].items():
+        for start in range(0, len(urls), batch_size):
+            batch = urls[start:start + batch_size]
+            try:
+                results = observation_cache.fetch_many(batch, year, download_many)
+            except DownloadFailedError as e:
+                # The per-county pass downloads these again; the rest of the batch is cached
+                logger.warning("Prefetch of %s: %s", year, e)
+                results = e.results
+            for _, downloaded_file in results:
+                if downloaded_file:
+                    downloaded_count += 1
+                    try:
+                        os.remove(downloaded_file)
+                    except OSError as e:
+                        logger.warning("Could not remove %s: %s", downloaded_file, e)
+    return downloaded_count
@@ -0,0 +1,239 @@
+import asyncio
+import atexit
+import logging
+import os
+import random
+import threading
+
+import aiohttp
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PER_HOST = 8
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+# Statuses worth retrying; anything else is final
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# The only status that means NOAA has no file for the station-year
+MISSING_STATUS = 404
+
+# Result of a download that failed without showing the file is missing; left out of the results
+_FAILED = object()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RetryableDownloadError(DownloadError):
+    pass
+
+
+async def _stream_to_file(session, url, file_path, chunk_size):
+    async with session.get(url) as response:
+        metrics.count("http_responses", status=response.status)
+        if response.status in RETRY_STATUSES:
+            raise RetryableDownloadError(f"Status code: {response.status}")
+        if response.status == MISSING_STATUS:
+            logger.warning("Failed to download %s: status %s", url, response.status, extra={"fields": {"url": url, "status": response.status}})
+            return None
+        if response.status != 200:
+            raise DownloadError(f"Status code: {response.status}")
+
+        # Stream into a temporary file so a failed transfer never leaves a truncated CSV behind
+        temporary_path = f"{file_path}.part"
+        try:
+            with open(temporary_path, "wb") as f:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    f.write(chunk)
+                    metrics.count("bytes_fetched", len(chunk))
+            os.replace(temporary_path, file_path)
+        except BaseException:
+            # Includes cancellation; a retry starts a new .part file
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            raise
+        return file_path
+
+
+async def _download_one(session, semaphore, url, directory, retries, backoff, chunk_size):
+    file_path = os.path.join(directory, os.path.basename(url))
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                return await _stream_to_file(session, url, file_path, chunk_size)
+            except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == retries or not isinstance(e, (RetryableDownloadError, aiohttp.ClientError, asyncio.TimeoutError)):
+                    logger.error("Giving up on %s after %d attempts: %r", url, attempt + 1, e, extra={"fields": {"url": url}})
+                    metrics.count("download_failures")
+                    return _FAILED
+                metrics.count("download_retries")
+                # Exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, backoff * 2 ** attempt))
+    return _FAILED
+
+
+def _open_session(concurrency, per_host, timeout):
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+async def download_all_async(
+    urls,
+    directory="",
+    concurrency=DEFAULT_CONCURRENCY,
+    per_host=DEFAULT_PER_HOST,
+    timeout=DEFAULT_TIMEOUT,
+    retries=DEFAULT_RETRIES,
+    backoff=DEFAULT_BACKOFF,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    session=None,
+):
+    """
+    Download many files concurrently over one pooled keep-alive session.
+
+    Args:
+    urls (list): URLs to download; each is saved under its base name.
+    directory (str): Directory to save the files in (default: current directory).
+    concurrency (int): Maximum number of downloads in flight (default: 16).
+    per_host (int): Maximum open connections per host (default: 8).
+    timeout (float): Total timeout per request in seconds (default: 60).
+    retries (int): Retries after a timeout, connection error or retryable status (default: 3).
+    backoff (float): Base delay in seconds for the jittered exponential backoff (default: 1.0).
+    chunk_size (int): Bytes written to disk per chunk (default: 64 KiB).
+    session (ClientSession): Session to download with, kept open afterwards; by default one is
+        opened for this call (per_host and timeout only apply then).
+
+    Returns:
+    dict: URL -> local file path, or None if the file does not exist (status 404). URLs whose
+        download failed otherwise (retries exhausted, other statuses) are left out, so callers do
+        not take a transient failure for a missing file.
+    """
+    if session is None:
+        async with _open_session(concurrency, per_host, timeout) as session:
+            return await download_all_async(urls, directory, concurrency, retries=retries, backoff=backoff, chunk_size=chunk_size, session=session)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    file_paths = await asyncio.gather(*[
+        _download_one(session, semaphore, url, directory, retries, backoff, chunk_size)
+        for url in urls
+    ])
+    return {url: file_path for url, file_path in zip(urls, file_paths) if file_path is not _FAILED}
+
+
+class Downloader:
+    """
+    Pooled client for synchronous code that lives as long as the process: one event loop in a
+    background thread and one keep-alive session, so consecutive download_all calls (one per
+    FIPS-year in stage 5) reuse the open connections instead of reconnecting every time.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT):
+        self.concurrency = concurrency
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="downloader", daemon=True)
+        self._thread.start()
+        self.session = self._run(self._open(per_host, timeout))
+
+    async def _open(self, per_host, timeout):
+        # The session belongs to the loop it is created on
+        return _open_session(self.concurrency, per_host, timeout)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def download(self, urls, **kwargs):
+        """
+        Download URLs over the shared session; options as for download_all_async.
+        """
+        return self._run(download_all_async(list(urls), concurrency=self.concurrency, session=self.session, **kwargs))
+
+    def content_lengths(self, urls):
+        return self._run(content_lengths_async(list(urls), concurrency=self.concurrency, session=self.session))
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+# The process's Downloader; a forked worker process opens its own, as the loop thread is not copied
+_downloader = None
+_downloader_lock = threading.Lock()
+
+
+def get_downloader():
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None or _downloader.pid != os.getpid():
+            _downloader = Downloader()
+            atexit.register(_downloader.close)
+        return _downloader
+
+
+def download_all(urls, **kwargs):
+    """
+    Blocking download for synchronous code, over the process's pooled Downloader.
+
+    Args:
+    urls (list): URLs to download.
+    **kwargs: Per-call options of download_all_async (directory, retries, backoff, chunk_size).
+
+    Returns:
+    dict: URL -> local file path, or None if the file does not exist; URLs that failed otherwise
+        are left out.
+    """
+    if not urls:
+        return {}
+    with metrics.timer("download"):
+        file_paths = get_downloader().download(urls, **kwargs)
+    metrics.count("files_downloaded", sum(1 for file_path in file_paths.values() if file_path))
+    return file_paths
+
+
+async def _content_length(session, semaphore, url):
+    async with semaphore:
+        try:
+            async with session.head(url, allow_redirects=True) as response:
+                if response.status != 200:
+                    return None
+                return response.content_length
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+
+async def content_lengths_async(urls, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT, session=None):
+    """
+    Sizes of many remote files from concurrent HEAD requests.
+
+    Returns:
+    dict: URL -> size in bytes, or None if the file is missing or reports no length.
+    """
+    if session is None:
+        async with _open_session(concurrency, per_host, timeout) as session:
+            return await content_lengths_async(urls, concurrency, session=session)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    lengths = await asyncio.gather(*[_content_length(session, semaphore, url) for url in urls])
+    return dict(zip(urls, lengths))
+
+
+def content_lengths(urls):
+    """
+    Blocking content_lengths_async over the process's pooled Downloader.
+    """
+    if not urls:
+        return {}
+    return get_downloader().content_lengths(urls)
@@ -0,0 +1,316 @@
+import numpy as np
+
+from centroid_distances import CountyDistances
+from isd_observations import epoch_hour
+from metrics import metrics
+
+# Output columns per aggregation mode, in the order the stage-5 scripts have always written them
+OUTPUT_FIELDNAMES = {
+    "avg+nearest": [
+        "state", "county_fips", "average distance to stations (miles)", "station identifiers (USAF WBAN)",
+        "nearest station", "nearest station distance", "county_name", "average wind", "nearest wind",
+        "average temperature", "nearest temperature", "nearest temperature quality", "average precipitation",
+        "nearest precipitation", "hour", "day", "month", "year", "date"
+    ],
+    "nearest": [
+        "state", "county_fips", "station identifiers (USAF WBAN)",
+        "nearest station", "nearest station distance", "county_name", "nearest wind",
+        "nearest temperature", "nearest temperature quality", "nearest precipitation",
+        "hour", "day", "month", "year", "date"
+    ],
+}
+
+AGGREGATION_MODES = tuple(OUTPUT_FIELDNAMES)
+
+MEASUREMENTS = ("wind", "temperature", "precipitation")
+
+
+def window_hours(hours, match_window):
+    """
+    Epoch hours whose observations can be matched to the given hours within `match_window` minutes
+    (the hours themselves when match_window is None).
+    """
+    if match_window is None:
+        return set(hours)
+    reach = -(-match_window // 60)
+    return {hour + offset for hour in hours for offset in range(-reach, reach + 1)}
+
+
+def _group_means(values, groups, mask, group_count):
+    counts = np.bincount(groups[mask], minlength=group_count)
+    # bincount adds the weights in row order, the same order the per-hour loops summed them in
+    sums = np.bincount(groups[mask], weights=values[mask], minlength=group_count)
+    return [round(total / count, 2) if count else None for total, count in zip(sums.tolist(), counts.tolist())]
+
+
+def _last_rows(groups, mask, group_count):
+    last = np.full(group_count, -1, dtype=np.int64)
+    np.maximum.at(last, groups[mask], np.flatnonzero(mask))
+    return last
+
+
+def aggregate_hours(stations, hours, county_centroid, mode="avg+nearest", county_distances=None, match_window=None):
+    """
+    Per-hour nearest-station values (and cross-station averages) for many hours at once.
+
+    By default all stations' rows for the requested hours are concatenated, station after station
+    in file order, and reduced per hour in one pass. The results are those of the former per-hour
+    loops: the nearest station is the first row with the smallest centroid distance among rows
+    with non-zero coordinates, its values are the last non-missing ones that station reports from
+    that row on, and averages cover every non-missing value of the hour.
+
+    With `match_window`, each hour is matched to the observations closest to HH:00 instead (see
+    _aggregate_windowed), so an 00:53 report can stand for 01:00.
+
+    Args:
+    stations (list): StationObservations of the county's nearby stations, in nearby-list order.
+    hours (list): Epoch hours to aggregate.
+    county_centroid (tuple): (latitude, longitude) of the county centroid.
+    mode (str): "avg+nearest" or "nearest".
+    county_distances (CountyDistances): Memoized centroid distances of the county; a fresh one is
+        used if omitted.
+    match_window (int): Minutes either side of HH:00 within which observations are matched to the
+        hour, or None to aggregate the reports of the hour itself.
+
+    Returns:
+    dict: Epoch hour -> dict with the keys the former get_avg_and_nearest_station_data returned
+        ("Average ..." keys only in "avg+nearest" mode).
+    """
+    if mode not in OUTPUT_FIELDNAMES:
+        raise ValueError(f"Unknown aggregation mode: {mode}")
+    with metrics.timer("aggregate"):
+        if match_window is None:
+            results = _aggregate_hours(stations, hours, county_centroid, mode, county_distances)
+        else:
+            results = _aggregate_windowed(stations, hours, county_centroid, mode, county_distances, match_window)
+    metrics.count("hours_aggregated", len(results))
+    return results
+
+
+def _aggregate_hours(stations, hours, county_centroid, mode, county_distances):
+    if county_distances is None:
+        county_distances = CountyDistances(None, county_centroid)
+
+    unique_hours = np.unique(np.asarray(hours, dtype=np.int64))
+    group_count = len(unique_hours)
+
+    station_codes = {}
+    station_ids = []
+    parts = []
+    codes = []
+    for station in stations:
+        selected = station.select_hours(unique_hours.tolist())
+        code = station_codes.setdefault(station.station_id, len(station_codes))
+        if code == len(station_ids):
+            station_ids.append(station.station_id)
+        parts.append(selected)
+        codes.append(np.full(len(selected), code, dtype=np.int64))
+
+    def column(name, dtype):
+        if not parts:
+            return np.empty(0, dtype=dtype)
+        return np.concatenate([getattr(part, name) for part in parts])
+
+    row_hours = column("hours", np.int64)
+    latitudes = column("latitude", np.float64)
+    longitudes = column("longitude", np.float64)
+    measurements = {name: column(name, np.float64) for name in MEASUREMENTS}
+    qualities = column("temperature_quality", np.str_)
+    row_codes = np.concatenate(codes) if codes else np.empty(0, dtype=np.int64)
+    groups = np.searchsorted(unique_hours, row_hours)
+    row_numbers = np.arange(len(groups))
+
+    # Rows the former loops took a distance for: `if station_lat and station_lon`
+    located = ~np.isnan(latitudes) & ~np.isnan(longitudes) & (latitudes != 0) & (longitudes != 0)
+    distances = np.full(len(groups), np.nan)
+    if located.any():
+        located_station_ids = [station_ids[code] for code in row_codes[located].tolist()]
+        distances[located] = county_distances.distances(located_station_ids, latitudes[located], longitudes[located])
+
+    # Nearest row per hour: smallest distance, earliest row on ties
+    located_rows = row_numbers[located]
+    order = np.lexsort((located_rows, distances[located_rows], groups[located_rows]))
+    ordered_rows = located_rows[order]
+    first = np.ones(len(ordered_rows), dtype=bool)
+    first[1:] = groups[ordered_rows][1:] != groups[ordered_rows][:-1]
+    nearest_rows = np.full(group_count, -1, dtype=np.int64)
+    nearest_rows[groups[ordered_rows[first]]] = ordered_rows[first]
+
+    # Rows that update the nearest station's values: same station, at or after the nearest row
+    has_nearest = nearest_rows[groups] >= 0
+    row_nearest = nearest_rows[groups]
+    from_nearest = has_nearest & (row_codes == row_codes[np.maximum(row_nearest, 0)]) & (row_numbers >= row_nearest)
+    nearest_values = {}
+    for name, values in measurements.items():
+        nearest_values[name] = _last_rows(groups, from_nearest & ~np.isnan(values), group_count)
+
+    if mode == "avg+nearest":
+        averages = {name: _group_means(values, groups, ~np.isnan(values), group_count) for name, values in measurements.items()}
+        average_distances = _group_means(distances, groups, located, group_count)
+
+    def value(name, row):
+        return measurements[name][row].item() if row >= 0 else None
+
+    results = {}
+    for group, hour in enumerate(unique_hours.tolist()):
+        nearest_row = nearest_rows[group]
+        temperature_row = nearest_values["temperature"][group]
+        result = {}
+        if mode == "avg+nearest":
+            result["Average Wind"] = averages["wind"][group]
+            result["Average Temperature"] = averages["temperature"][group]
+            result["Average Precipitation"] = averages["precipitation"][group]
+        result["Nearest Station Wind"] = value("wind", nearest_values["wind"][group])
+        result["Nearest Station Temperature"] = value("temperature", temperature_row)
+        result["Nearest Station Temperature Quality"] = (str(qualities[temperature_row]) or None) if temperature_row >= 0 else None
+        result["Nearest Station Precipitation"] = value("precipitation", nearest_values["precipitation"][group])
+        if mode == "avg+nearest":
+            result["Average Distance from Centroid"] = average_distances[group]
+        result["Nearest Station Distance from Centroid"] = distances[nearest_row].item() if nearest_row >= 0 else float('inf')
+        result["Nearest Station ID"] = station_ids[row_codes[nearest_row]] if nearest_row >= 0 else None
+        results[hour] = result
+    return results
+
+
+def _round_means(values):
+    # Mean over stations (axis 0) of the non-missing values, rounded like _group_means
+    present = ~np.isnan(values)
+    counts = present.sum(axis=0)
+    sums = np.where(present, values, 0.0).sum(axis=0)
+    return [round(total / count, 2) if count else None for total, count in zip(sums.tolist(), counts.tolist())]
+
+
+def _aggregate_windowed(stations, hours, county_centroid, mode, county_distances, match_window):
+    """
+    Per-hour values from the observations closest in time to HH:00 within `match_window` minutes.
+
+    Every station is matched to all hours at once with one searchsorted per column
+    (StationObservations.nearest_rows): its position comes from its closest located report, and
+    each measurement from its closest report where that measurement is present. The nearest
+    station of an hour is the matched station closest to the centroid (earliest in the nearby list
+    on ties); averages take one value per matched station.
+    """
+    if county_distances is None:
+        county_distances = CountyDistances(None, county_centroid)
+
+    unique_hours = np.unique(np.asarray(hours, dtype=np.int64))
+    targets = unique_hours * 60
+    shape = (len(stations), len(unique_hours))
+    distances = np.full(shape, np.nan)
+    matched = {name: np.full(shape, np.nan) for name in MEASUREMENTS}
+    qualities = np.full(shape, "", dtype=object)
+
+    for index, station in enumerate(stations):
+        located = ~np.isnan(station.latitude) & ~np.isnan(station.longitude) & (station.latitude != 0) & (station.longitude != 0)
+        rows = station.nearest_rows(targets, match_window, located)
+        found = rows >= 0
+        if found.any():
+            distances[index, found] = county_distances.distances(
+                [station.station_id] * int(found.sum()), station.latitude[rows[found]], station.longitude[rows[found]]
+            )
+        for name in MEASUREMENTS:
+            values = getattr(station, name)
+            rows = station.nearest_rows(targets, match_window, ~np.isnan(values))
+            found = rows >= 0
+            matched[name][index, found] = values[rows[found]]
+            if name == "temperature":
+                qualities[index, found] = station.temperature_quality[rows[found]]
+
+    # argmin takes the first station on ties; hours without a located station keep -1
+    nearest = np.argmin(np.where(np.isnan(distances), np.inf, distances), axis=0) if len(stations) else np.zeros(len(unique_hours), dtype=np.int64)
+    has_nearest = ~np.isnan(distances).all(axis=0) if len(stations) else np.zeros(len(unique_hours), dtype=bool)
+
+    if mode == "avg+nearest":
+        averages = {name: _round_means(values) for name, values in matched.items()}
+        average_distances = _round_means(distances)
+
+    def nearest_value(values, group):
+        value = values[nearest[group], group].item()
+        return None if value != value else value
+
+    results = {}
+    for group, hour in enumerate(unique_hours.tolist()):
+        result = {}
+        if mode == "avg+nearest":
+            result["Average Wind"] = averages["wind"][group]
+            result["Average Temperature"] = averages["temperature"][group]
+            result["Average Precipitation"] = averages["precipitation"][group]
+        if has_nearest[group]:
+            result["Nearest Station Wind"] = nearest_value(matched["wind"], group)
+            result["Nearest Station Temperature"] = nearest_value(matched["temperature"], group)
+            result["Nearest Station Temperature Quality"] = str(qualities[nearest[group], group]) or None
+            result["Nearest Station Precipitation"] = nearest_value(matched["precipitation"], group)
+        else:
+            result["Nearest Station Wind"] = None
+            result["Nearest Station Temperature"] = None
+            result["Nearest Station Temperature Quality"] = None
+            result["Nearest Station Precipitation"] = None
+        if mode == "avg+nearest":
+            result["Average Distance from Centroid"] = average_distances[group]
+        result["Nearest Station Distance from Centroid"] = distances[nearest[group], group].item() if has_nearest[group] else float('inf')
+        result["Nearest Station ID"] = stations[nearest[group]].station_id if has_nearest[group] else None
+        results[hour] = result
+    return results
+
+
+def hourly_rows(state, fips, county_name, county_centroid, year, month_days, stations, mode="avg+nearest", county_distances=None, match_window=None):
+    """
+    Output rows of one county-year, 24 per month-day, with the columns of OUTPUT_FIELDNAMES[mode].
+
+    Args:
+    state (str): County state.
+    fips (str): County FIPS code, written as given.
+    county_name (str): County name.
+    county_centroid (tuple): (latitude, longitude) of the county centroid.
+    year (str): Year, written as given.
+    month_days (list): (month, day) pairs from the manifest.
+    stations (list): StationObservations of the county's nearby stations.
+    mode (str): "avg+nearest" or "nearest".
+    county_distances (CountyDistances): Memoized centroid distances of the county (optional).
+    match_window (int): Minutes either side of HH:00 to match observations within, or None to use
+        the reports of each hour (see aggregate_hours).
+
+    Returns:
+    list: Row dicts in month-day, hour order.
+    """
+    requested = [
+        (int(month_day[0]), int(month_day[1]), hour)
+        for month_day in month_days
+        for hour in range(24)
+    ]
+    results = aggregate_hours(
+        stations,
+        [epoch_hour(year, month, day, hour) for month, day, hour in requested],
+        county_centroid,
+        mode,
+        county_distances,
+        match_window,
+    )
+    station_identifiers = "|".join([station.station_id for station in stations])
+
+    rows = []
+    for month, day, hour in requested:
+        data = results[epoch_hour(year, month, day, hour)]
+        row = {
+            "state": state,
+            "county_fips": fips,
+            "average distance to stations (miles)": data.get("Average Distance from Centroid"),
+            "station identifiers (USAF WBAN)": station_identifiers,
+            "nearest station": data.get("Nearest Station ID"),
+            "nearest station distance": round(data.get("Nearest Station Distance from Centroid"), 2),
+            "county_name": county_name,
+            "average wind": data.get("Average Wind"),
+            "nearest wind": data.get("Nearest Station Wind"),
+            "average temperature": data.get("Average Temperature"),
+            "nearest temperature": data.get("Nearest Station Temperature"),
+            "nearest temperature quality": data.get("Nearest Station Temperature Quality"),
+            "average precipitation": data.get("Average Precipitation"),
+            "nearest precipitation": data.get("Nearest Station Precipitation"),
+            "hour": hour,
+            "day": day,
+            "month": month,
+            "year": year,
+            "date": f"{year}-{month:02d}-{day:02d}T{hour:02d}",
+        }
+        rows.append({fieldname: row[fieldname] for fieldname in OUTPUT_FIELDNAMES[mode]})
+    return rows
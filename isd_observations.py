@@ -0,0 +1,381 @@
+import csv
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+from metrics import metrics
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Sentinels used by the global-hourly format for missing values
+MISSING_COORDINATE = "999"
+MISSING_WND = "999,9,9,9999,9"
+MISSING_TMP = "+9999,9"
+
+# Width of the stored temperature quality codes (single characters in practice)
+QUALITY_DTYPE = "<U4"
+
+# The only columns stage 5 decodes; the rest of a global-hourly file (REM, EQD, the additional-data
+# groups) is skipped by the CSV engine without being turned into Python strings
+USED_COLUMNS = ("DATE", "LATITUDE", "LONGITUDE", "WND", "TMP", "AA1")
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def epoch_hour(year, month, day, hour):
+    """
+    Number of whole hours between 1970-01-01T00 and the given hour.
+    """
+    return (date(int(year), int(month), int(day)).toordinal() - EPOCH_ORDINAL) * 24 + int(hour)
+
+
+def parse_epoch_minute(date_value):
+    """
+    Epoch minute of an ISD DATE value such as "2020-01-01T00:53:00", or None if it cannot be parsed.
+    """
+    try:
+        hour = epoch_hour(date_value[0:4], date_value[5:7], date_value[8:10], date_value[11:13])
+        return hour * 60 + int(date_value[14:16] or 0)
+    except ValueError:
+        return None
+
+
+def decode_coordinate(value):
+    if value and value != MISSING_COORDINATE:
+        return float(value)
+    return None
+
+
+def decode_wind(wnd):
+    """
+    Wind speed (4th WND subfield) or None if the field is missing.
+    """
+    if wnd and wnd != MISSING_WND:
+        wnd_parts = wnd.split(',')
+        if len(wnd_parts) >= 4:
+            return float(wnd_parts[3])
+    return None
+
+
+def decode_temperature(tmp):
+    """
+    (temperature, quality code) from a TMP field, or (None, None) if the field is missing.
+    """
+    if tmp and tmp != MISSING_TMP:
+        tmp_parts = tmp.split(',')
+        if len(tmp_parts) >= 2:
+            return float(tmp_parts[0]), tmp_parts[1]
+    return None, None
+
+
+def decode_precipitation(aa1):
+    """
+    One-hour precipitation depth from an AA1 field, or None if the field is missing or not hourly.
+    """
+    if aa1:
+        aa1_parts = aa1.split(',')
+        if len(aa1_parts) >= 3 and aa1_parts[0] == "01":
+            return float(aa1_parts[1])
+    return None
+
+
+def _none_to_nan(values):
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def _nan_to_none(values):
+    return [None if value != value else value for value in values.tolist()]
+
+
+class StationObservations:
+    """
+    Decoded observations of one station-year file, indexed by hour.
+
+    Columns are NumPy arrays: `minutes` (int64 epoch minutes of DATE), `latitude`, `longitude`,
+    `wind`, `temperature`, `precipitation` (float64, NaN when missing) and `temperature_quality`
+    (strings, empty when missing). Rows are grouped by hour in file order, so the rows of any hour
+    come back in the same order a full scan of the file would have produced them. `time_order`
+    sorts them by minute for nearest_rows.
+    """
+
+    COLUMNS = ("minutes", "latitude", "longitude", "wind", "temperature", "temperature_quality", "precipitation")
+
+    def __init__(self, station_id, minutes, latitude, longitude, wind, temperature, temperature_quality, precipitation, presorted=False):
+        self.station_id = station_id
+        columns = {
+            "minutes": np.asarray(minutes, dtype=np.int64),
+            "latitude": np.asarray(latitude, dtype=np.float64),
+            "longitude": np.asarray(longitude, dtype=np.float64),
+            "wind": np.asarray(wind, dtype=np.float64),
+            "temperature": np.asarray(temperature, dtype=np.float64),
+            "temperature_quality": np.asarray(temperature_quality, dtype=QUALITY_DTYPE),
+            "precipitation": np.asarray(precipitation, dtype=np.float64),
+        }
+
+        if not presorted:
+            # Stable sort keeps file order inside each hour
+            order = np.argsort(columns["minutes"] // 60, kind='stable')
+            columns = {name: values[order] for name, values in columns.items()}
+
+        for name, values in columns.items():
+            setattr(self, name, values)
+        self.hours = self.minutes // 60
+        self._time_order = None
+
+        # hour -> (start, stop) range into the columns
+        self.hour_ranges = {}
+        if len(self.hours):
+            boundaries = np.flatnonzero(np.diff(self.hours)) + 1
+            starts = np.concatenate(([0], boundaries))
+            stops = np.concatenate((boundaries, [len(self.hours)]))
+            for start, stop in zip(starts.tolist(), stops.tolist()):
+                self.hour_ranges[int(self.hours[start])] = (start, stop)
+
+    def __len__(self):
+        return len(self.minutes)
+
+    def to_arrays(self):
+        """
+        Columns as a name -> array dict, in storage order.
+        """
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    @classmethod
+    def from_arrays(cls, station_id, arrays):
+        """
+        Rebuild observations from the dict returned by to_arrays.
+        """
+        return cls(station_id, *(arrays[name] for name in cls.COLUMNS), presorted=True)
+
+    def select_hours(self, hours):
+        """
+        Copy of these observations restricted to the given epoch hours.
+
+        Args:
+        hours (iterable): Epoch hours to keep.
+
+        Returns:
+        StationObservations: Observations holding only the rows of those hours, in the same order.
+        """
+        ranges = sorted(self.hour_ranges[hour] for hour in set(hours) if hour in self.hour_ranges)
+        if ranges:
+            rows = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+        else:
+            rows = np.empty(0, dtype=np.intp)
+        return StationObservations.from_arrays(
+            self.station_id,
+            {name: values[rows] for name, values in self.to_arrays().items()},
+        )
+
+    @property
+    def time_order(self):
+        """
+        Row indices that sort the observations by minute (file order within a minute), built on
+        first use.
+        """
+        if self._time_order is None:
+            self._time_order = np.argsort(self.minutes, kind='stable')
+        return self._time_order
+
+    def nearest_rows(self, minutes, window, mask=None):
+        """
+        For each target minute, the row closest to it in time within `window` minutes either side.
+
+        One searchsorted over the time-sorted rows serves all targets. When an earlier and a later
+        row are equally close, the earlier one is taken; among rows of the same minute, the last in
+        file order.
+
+        Args:
+        minutes (array): Target epoch minutes.
+        window (int): Largest accepted distance in minutes.
+        mask (array): Boolean per row; only rows where it is set are candidates (default: all rows).
+
+        Returns:
+        ndarray: Row index per target, -1 where no candidate is within the window.
+        """
+        targets = np.asarray(minutes, dtype=np.int64)
+        order = self.time_order if mask is None else self.time_order[mask[self.time_order]]
+        if not len(order):
+            return np.full(len(targets), -1, dtype=np.int64)
+        times = self.minutes[order]
+
+        after = np.searchsorted(times, targets)
+        before = after - 1
+        after_index = np.minimum(after, len(times) - 1)
+        # Last of the rows sharing the later candidate's minute
+        after_index = np.searchsorted(times, times[after_index], side='right') - 1
+        before_index = np.maximum(before, 0)
+        unreachable = window + 1
+        before_gap = np.where(before >= 0, targets - times[before_index], unreachable)
+        after_gap = np.where(after < len(times), times[after_index] - targets, unreachable)
+
+        chosen = np.where(after_gap < before_gap, after_index, before_index)
+        return np.where(np.minimum(before_gap, after_gap) <= window, order[chosen], -1)
+
+    def rows_for_hour(self, year, month, day, hour):
+        """
+        Rows whose DATE falls in the given hour, in file order.
+
+        Returns:
+        list: Tuples (latitude, longitude, wind, temperature, temperature_quality, precipitation)
+            with None for missing values.
+        """
+        hour_range = self.hour_ranges.get(epoch_hour(year, month, day, hour))
+        if hour_range is None:
+            return []
+        start, stop = hour_range
+        qualities = [quality or None for quality in self.temperature_quality[start:stop].tolist()]
+        return list(zip(
+            _nan_to_none(self.latitude[start:stop]),
+            _nan_to_none(self.longitude[start:stop]),
+            _nan_to_none(self.wind[start:stop]),
+            _nan_to_none(self.temperature[start:stop]),
+            qualities,
+            _nan_to_none(self.precipitation[start:stop]),
+        ))
+
+
+def load_station_observations(file_path):
+    """
+    Read a downloaded global-hourly CSV once, decode the fields stage 5 uses and index them by hour.
+
+    Args:
+    file_path (str): Path of the station-year CSV; the station ID is the file name without extension.
+
+    Returns:
+    StationObservations: Parsed observations of the file.
+    """
+    with metrics.timer("parse"):
+        observations = _parse_station_file(file_path)
+    metrics.count("files_parsed")
+    metrics.count("rows_parsed", len(observations))
+    return observations
+
+
+def _read_used_columns(file_path):
+    """
+    The USED_COLUMNS present in a global-hourly CSV, as strings ("" for empty or absent fields).
+
+    Uses pyarrow's CSV reader when pyarrow is installed, and the pandas C engine otherwise or for
+    files pyarrow rejects (rows with fewer fields than the header, which the C engine pads).
+    """
+    if pa is not None:
+        # pyarrow wants the columns to read to exist, so take them from the header
+        with open(file_path, mode='r', newline='', encoding='utf-8') as file:
+            headers = next(csv.reader(file), [])
+        columns = [column for column in USED_COLUMNS if column in headers]
+        if not columns:
+            return pd.DataFrame()
+        try:
+            table = pa_csv.read_csv(
+                file_path,
+                convert_options=pa_csv.ConvertOptions(
+                    include_columns=columns,
+                    column_types={column: pa.string() for column in columns},
+                    strings_can_be_null=False,
+                    quoted_strings_can_be_null=False,
+                ),
+            )
+            return table.to_pandas()
+        except pa.ArrowInvalid:
+            pass
+    try:
+        return pd.read_csv(
+            file_path,
+            engine="c",
+            usecols=lambda column: column in USED_COLUMNS,
+            dtype=str,
+            keep_default_na=False,
+            na_filter=False,
+            encoding="utf-8",
+        )
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
+
+def _epoch_minutes(dates):
+    """
+    Epoch minutes of DATE values, as parse_epoch_minute would give them (None where it gives None).
+
+    Values in NOAA's fixed format are converted in one pass; anything else goes through
+    parse_epoch_minute one by one.
+    """
+    parsed = pd.to_datetime(dates, format=DATE_FORMAT, errors="coerce")
+    irregular = (parsed.isna() | (dates.str.len() != 19)).to_numpy()
+    minutes = np.where(irregular, 0, parsed.to_numpy().astype("datetime64[m]").astype(np.int64))
+    valid = ~irregular
+    for row in np.flatnonzero(irregular).tolist():
+        minute = parse_epoch_minute(dates.iat[row])
+        if minute is not None:
+            minutes[row] = minute
+            valid[row] = True
+    return minutes, valid
+
+
+def _decode_distinct(values, decode):
+    """
+    Apply a scalar decoder once per distinct value of a column and spread the results over its rows.
+
+    Coordinates barely change within a station-year and WND, TMP and AA1 repeat a few hundred
+    values over thousands of reports, so this does a small fraction of the per-row work while
+    giving exactly the scalar decoder's results.
+
+    Returns:
+    tuple: (codes, decoded) where decoded[codes[i]] is the decoded value of row i.
+    """
+    codes, uniques = pd.factorize(values)
+    return codes, [decode(value) for value in uniques]
+
+
+def _decode_floats(values, decode):
+    codes, decoded = _decode_distinct(values, decode)
+    return _none_to_nan(decoded)[codes] if len(codes) else np.empty(0)
+
+
+def _decode_temperatures(values):
+    """
+    Returns:
+    tuple: (temperatures, quality codes) of a TMP column.
+    """
+    codes, decoded = _decode_distinct(values, decode_temperature)
+    if not len(codes):
+        return np.empty(0), np.empty(0, dtype=QUALITY_DTYPE)
+    temperatures = _none_to_nan([temperature for temperature, _ in decoded])
+    qualities = np.array([quality or "" for _, quality in decoded], dtype=QUALITY_DTYPE)
+    return temperatures[codes], qualities[codes]
+
+
+def _parse_station_file(file_path):
+    station_id = os.path.basename(file_path).split('.')[0]
+    frame = _read_used_columns(file_path)
+    if frame.empty:
+        return StationObservations(station_id, [], [], [], [], [], [], [])
+
+    minutes, valid = _epoch_minutes(frame['DATE'])
+    frame = frame[valid]
+    minutes = minutes[valid]
+    missing = np.full(len(frame), np.nan)
+    has_lat = 'LATITUDE' in frame
+    has_lon = 'LONGITUDE' in frame
+    has_wnd = 'WND' in frame
+    has_tmp = 'TMP' in frame
+    has_aa1 = 'AA1' in frame
+
+    temperatures, temperature_qualities = _decode_temperatures(frame['TMP']) if has_tmp else (missing, np.full(len(frame), ""))
+    return StationObservations(
+        station_id,
+        minutes,
+        _decode_floats(frame['LATITUDE'], decode_coordinate) if has_lat else missing,
+        _decode_floats(frame['LONGITUDE'], decode_coordinate) if has_lon else missing,
+        _decode_floats(frame['WND'], decode_wind) if has_wnd else missing,
+        temperatures,
+        temperature_qualities,
+        _decode_floats(frame['AA1'], decode_precipitation) if has_aa1 else missing,
+    )
@@ -0,0 +1,320 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+except ImportError:
+    PyinstrumentProfiler = None
+
+logger = logging.getLogger(__name__)
+
+# Where StageRun writes <stage>.json, <stage>.prom and profiles (default: ./metrics)
+METRICS_DIRECTORY_ENV = "NOAA_METRICS_DIR"
+DEFAULT_METRICS_DIRECTORY = "metrics"
+
+# Stages to profile, comma-separated ("stage5", "stage2,stage4" or "all"), and the profiler to
+# use: "cprofile" (default) or "pyinstrument"
+PROFILE_ENV = "NOAA_PROFILE"
+PROFILER_ENV = "NOAA_PROFILER"
+
+PROMETHEUS_PREFIX = "noaa_"
+
+# A label with one value per county would make thousands of Prometheus series; such timers are
+# summed over the label in the textfile and kept per value in the JSON summary only
+JSON_ONLY_LABELS = ("fips",)
+
+# Rates in the summary: name -> (counter, timer); the counter is divided by the timer's seconds
+RATES = {
+    "rows_parsed_per_second": ("rows_parsed", "parse"),
+    "bytes_fetched_per_second": ("bytes_fetched", "download"),
+    "rows_written_per_second": ("rows_written", "write"),
+}
+
+# Hit rates in the summary: name -> (hit counter, miss counter)
+HIT_RATES = {
+    "cache_hit_rate": ("cache_hits", "cache_misses"),
+    "distance_memo_hit_rate": ("distance_memo_hits", "distance_memo_misses"),
+    "shared_store_hit_rate": ("shared_store_hits", "shared_store_misses"),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Metrics:
+    """
+    Counters and timers of one process.
+
+    Series are identified by a name and optional labels, e.g. count("http_responses", status=200).
+    A timer keeps the number of timed sections and their total and longest duration. The registry
+    is thread-safe, so the downloader and the writer thread can record into it.
+
+    Worker processes have their own registry; they hand it to the parent with take() and the parent
+    folds it in with merge().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        # key -> [count, total seconds, max seconds]
+        self.timers = {}
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_time(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the enclosed block: with metrics.timer("parse"): ...
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time, **labels)
+
+    def counter_total(self, name):
+        """
+        Sum of a counter over all its labels.
+        """
+        with self._lock:
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def timer_total(self, name):
+        """
+        Seconds of a timer summed over all its labels.
+        """
+        with self._lock:
+            return sum(timer[1] for (timer_name, _), timer in self.timers.items() if timer_name == name)
+
+    def _snapshot(self):
+        return {
+            "counters": [(name, labels, value) for (name, labels), value in self.counters.items()],
+            "timers": [(name, labels, *timer) for (name, labels), timer in self.timers.items()],
+        }
+
+    def snapshot(self):
+        """
+        Picklable copy of the registry, for merge().
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def take(self):
+        """
+        Snapshot the registry and clear it, so a worker reports each task's metrics once.
+        """
+        with self._lock:
+            snapshot = self._snapshot()
+            self.counters = {}
+            self.timers = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        if not snapshot:
+            return
+        with self._lock:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, count, total, longest in snapshot["timers"]:
+                timer = self.timers.setdefault((name, tuple(labels)), [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+
+    def summary(self):
+        """
+        JSON-ready view: every series, plus the rates and hit rates derived from them.
+        """
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            timers = [
+                {"name": name, "labels": dict(labels), "count": count, "seconds": round(total, 6), "max_seconds": round(longest, 6)}
+                for (name, labels), (count, total, longest) in sorted(self.timers.items())
+            ]
+
+        derived = {}
+        for rate, (counter, timer) in RATES.items():
+            seconds = self.timer_total(timer)
+            if seconds:
+                derived[rate] = round(self.counter_total(counter) / seconds, 2)
+        for rate, (hits, misses) in HIT_RATES.items():
+            lookups = self.counter_total(hits) + self.counter_total(misses)
+            if lookups:
+                derived[rate] = round(self.counter_total(hits) / lookups, 4)
+        return {"counters": counters, "timers": timers, "derived": derived}
+
+    def prometheus_text(self, stage):
+        """
+        The registry in the Prometheus text exposition format, every series labelled with the stage.
+        """
+        counters = {}
+        timers = {}
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                key = (name, tuple((label, label_value) for label, label_value in labels if label not in JSON_ONLY_LABELS))
+                counters[key] = counters.get(key, 0) + value
+            for (name, labels), (count, total, longest) in self.timers.items():
+                key = (name, tuple((label, label_value) for label, label_value in labels if label not in JSON_ONLY_LABELS))
+                timer = timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+
+        def series(metric, labels):
+            text = ",".join([f'stage="{stage}"'] + [f'{label}="{value}"' for label, value in labels])
+            return f"{PROMETHEUS_PREFIX}{metric}{{{text}}}"
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_total counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"{series(f'{name}_total', labels)} {value}")
+        for name in sorted({name for name, _ in timers}):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_seconds summary")
+            for (timer_name, labels), (count, total, _) in sorted(timers.items()):
+                if timer_name == name:
+                    lines.append(f"{series(f'{name}_seconds_sum', labels)} {total:.6f}")
+                    lines.append(f"{series(f'{name}_seconds_count', labels)} {count}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_seconds_max gauge")
+            for (timer_name, labels), (_, _, longest) in sorted(timers.items()):
+                if timer_name == name:
+                    lines.append(f"{series(f'{name}_seconds_max', labels)} {longest:.6f}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}last_run_timestamp_seconds gauge")
+        lines.append(f"{series('last_run_timestamp_seconds', ())} {time.time():.0f}")
+        return "\n".join(lines) + "\n"
+
+
+# Registry of this process; library modules record into it
+metrics = Metrics()
+
+
+def _write_atomically(path, text):
+    # The Prometheus textfile collector may read at any time, so never expose a partial file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(temporary_path, path)
+
+
+def _profiled_stages():
+    return {stage.strip() for stage in os.environ.get(PROFILE_ENV, "").split(",") if stage.strip()}
+
+
+class StageRun:
+    """
+    Measures one pipeline stage and exports the process registry when it ends.
+
+    On finish, the stage's wall time is recorded as the "stage" timer and the registry is written to
+    <directory>/<stage>.json (summary) and <directory>/<stage>.prom (Prometheus textfile, for the
+    node_exporter textfile collector). If the stage is listed in NOAA_PROFILE, it also runs under
+    cProfile (<stage>.prof plus a <stage>.profile.txt of the top functions) or, with
+    NOAA_PROFILER=pyinstrument, under pyinstrument (<stage>.profile.html).
+
+    Scripts with a main() use the instrumented_stage decorator; scripts that run at module level
+    call start_stage() at the top and finish() at the end.
+    """
+
+    def __init__(self, stage, directory=None):
+        self.stage = stage
+        self.directory = directory or os.environ.get(METRICS_DIRECTORY_ENV, DEFAULT_METRICS_DIRECTORY)
+        profiled = _profiled_stages()
+        self.profiler_name = os.environ.get(PROFILER_ENV, "cprofile") if stage in profiled or "all" in profiled else None
+        self.profiler = None
+        self.start_time = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(failed=exc_type is not None)
+
+    def start(self):
+        if self.profiler_name == "pyinstrument":
+            if PyinstrumentProfiler is None:
+                raise ImportError("NOAA_PROFILER=pyinstrument requires the pyinstrument package")
+            self.profiler = PyinstrumentProfiler()
+            self.profiler.start()
+        elif self.profiler_name is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start_time = time.perf_counter()
+        return self
+
+    def finish(self, failed=False):
+        """
+        Stop timing and profiling and write the metrics files.
+
+        Returns:
+        str: Path of the JSON summary.
+        """
+        elapsed = time.perf_counter() - self.start_time
+        metrics.add_time("stage", elapsed)
+        if failed:
+            metrics.count("stage_failures")
+        os.makedirs(self.directory, exist_ok=True)
+        base_path = os.path.join(self.directory, self.stage)
+
+        if self.profiler is not None:
+            if self.profiler_name == "pyinstrument":
+                self.profiler.stop()
+                _write_atomically(f"{base_path}.profile.html", self.profiler.output_html())
+            else:
+                self.profiler.disable()
+                self.profiler.dump_stats(f"{base_path}.prof")
+                report = io.StringIO()
+                pstats.Stats(self.profiler, stream=report).sort_stats("cumulative").print_stats(40)
+                _write_atomically(f"{base_path}.profile.txt", report.getvalue())
+            self.profiler = None
+
+        summary = {"stage": self.stage, "wall_seconds": round(elapsed, 3), "finished_at": time.time(), **metrics.summary()}
+        _write_atomically(f"{base_path}.json", json.dumps(summary, indent=2))
+        _write_atomically(f"{base_path}.prom", metrics.prometheus_text(self.stage))
+        logger.info("%s metrics written to %s.json and %s.prom", self.stage, base_path, base_path)
+        return f"{base_path}.json"
+
+
+def start_stage(stage, directory=None):
+    return StageRun(stage, directory).start()
+
+
+def instrumented_stage(stage):
+    """
+    Decorator running a script's main() as a StageRun.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with StageRun(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,202 @@
+import os
+import time
+
+import numpy as np
+
+from isd_observations import StationObservations, load_station_observations
+from metrics import metrics
+
+DEFAULT_CACHE_DIR = "observation_cache"
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+# How long a missing station-year is remembered before it is tried again
+MISSING_TTL_SECONDS = 24 * 60 * 60
+
+
+class DownloadFailedError(Exception):
+    """
+    Station-year files that could not be downloaded, though NOAA may have them.
+    """
+
+    def __init__(self, urls, results):
+        super().__init__(f"{len(urls)} station-year file(s) failed to download, e.g. {urls[0]}")
+        self.urls = urls
+        # What fetch_many would have returned, so the files that did download can be cleaned up
+        self.results = results
+
+
+class ObservationCache:
+    """
+    Persistent cache of parsed station-year observations.
+
+    Each (station, year) is stored as an uncompressed .npz of the decoded columns under
+    `{directory}/{year}/{station}.npz`. A file's modification time records its last use, and the
+    least recently used files are deleted whenever the cache grows past `max_bytes`.
+
+    Station-years NOAA has no file for leave an empty `.missing` marker, so other counties
+    referencing them do not request them again until the marker is older than MISSING_TTL_SECONDS.
+    Downloads that failed for another reason leave no marker and are tried again next time.
+
+    The cache holds only a directory name and a byte budget, so it can be passed to
+    ProcessPoolExecutor workers; entries are written atomically, so workers can share it.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Running estimate of the cache size; the directory is only walked when it exceeds the budget
+        self._known_bytes = None
+
+    def path(self, station_id, year):
+        return os.path.join(self.directory, str(year), f"{station_id}.npz")
+
+    def missing_path(self, station_id, year):
+        return os.path.join(self.directory, str(year), f"{station_id}.missing")
+
+    def is_missing(self, station_id, year):
+        """
+        Whether a recent download found no file for the station-year.
+        """
+        try:
+            return time.time() - os.path.getmtime(self.missing_path(station_id, year)) < MISSING_TTL_SECONDS
+        except OSError:
+            return False
+
+    def mark_missing(self, station_id, year):
+        path = self.missing_path(station_id, year)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w"):
+            pass
+
+    def has(self, station_id, year):
+        """
+        Whether a station-year is in the cache, without loading it.
+        """
+        return os.path.exists(self.path(station_id, year))
+
+    def get(self, station_id, year):
+        """
+        Cached observations of a station-year, or None on a miss.
+        """
+        path = self.path(station_id, year)
+        try:
+            with np.load(path) as arrays:
+                observations = StationObservations.from_arrays(station_id, arrays)
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            metrics.count("cache_misses")
+            return None
+        metrics.count("cache_hits")
+
+        # Mark as recently used for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return observations
+
+    def row_count(self, station_id, year):
+        """
+        Number of rows of a cached station-year, read from a single column, or None on a miss.
+        """
+        try:
+            with np.load(self.path(station_id, year)) as arrays:
+                return len(arrays["minutes"])
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+
+    def put(self, observations, year):
+        """
+        Store observations of a station-year, then evict old entries if the budget is exceeded.
+        """
+        path = self.path(observations.station_id, year)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temporary_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(temporary_path, **observations.to_arrays())
+        os.replace(temporary_path, path)
+
+        if self._known_bytes is None:
+            self._known_bytes = self.evict()
+        else:
+            self._known_bytes += os.path.getsize(path)
+            if self._known_bytes > self.max_bytes:
+                self._known_bytes = self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+        int: Size of the cache in bytes after eviction.
+        """
+        entries = []
+        total_bytes = 0
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if not file_name.endswith(".npz") or file_name.endswith(".tmp.npz"):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        if total_bytes <= self.max_bytes:
+            return total_bytes
+
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+        return total_bytes
+
+    def fetch_many(self, urls, year, download_many):
+        """
+        Observations for station-year URLs, from the cache or by downloading and parsing the files.
+
+        Only cache misses are handed to `download_many`, in a single call, so they can be fetched
+        concurrently.
+
+        Args:
+        urls (list): NOAA global-hourly access URLs of the station-year files.
+        year (str or int): Year of the files.
+        download_many (callable): Function that downloads a list of URLs and returns a
+            URL -> local file name dict, with None for files that do not exist and without the
+            URLs that failed otherwise.
+
+        Returns:
+        list: One (observations, downloaded_file) tuple per URL, in URL order. observations is None
+            if the station-year does not exist; downloaded_file is None if nothing was downloaded.
+
+        Raises:
+        DownloadFailedError: If a download failed for another reason than a missing file, after
+            the other files are cached; the caller must not record the county-year as done.
+        """
+        station_ids = {url: os.path.basename(url).split('.')[0] for url in urls}
+        cached = {url: self.get(station_ids[url], year) for url in urls}
+        misses = [url for url in urls if cached[url] is None and not self.is_missing(station_ids[url], year)]
+        downloaded_files = download_many(misses) if misses else {}
+
+        results = []
+        for url in urls:
+            observations = cached[url]
+            downloaded_file = None
+            if observations is None and url in downloaded_files:
+                downloaded_file = downloaded_files[url]
+                if downloaded_file:
+                    observations = load_station_observations(downloaded_file)
+                    self.put(observations, year)
+                else:
+                    self.mark_missing(station_ids[url], year)
+            results.append((observations, downloaded_file))
+
+        failed = [url for url in misses if url not in downloaded_files]
+        if failed:
+            raise DownloadFailedError(failed, results)
+        return results
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# Console level ("DEBUG", "INFO", "WARNING", ...); NOAA_QUIET=1 shows warnings and errors only
+LOG_LEVEL_ENV = "NOAA_LOG_LEVEL"
+QUIET_ENV = "NOAA_QUIET"
+# Directory of the JSON-lines log files, one per stage (default: ./logs)
+LOG_DIRECTORY_ENV = "NOAA_LOG_DIR"
+DEFAULT_LOG_DIRECTORY = "logs"
+
+# The console shows the first few records of a message, then one per interval
+DEFAULT_BURST = 5
+DEFAULT_INTERVAL = 10.0
+
+# Interval of the overall progress line, in seconds
+DEFAULT_PROGRESS_INTERVAL = 30.0
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through the first `burst` records of each message template, then at most one per
+    `interval` seconds, and notes on the next record shown how many were dropped.
+
+    Records at `exempt_level` and above always pass. Attached to the console handler only, so the
+    log file still receives every record.
+    """
+
+    def __init__(self, burst=DEFAULT_BURST, interval=DEFAULT_INTERVAL, exempt_level=logging.ERROR):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.exempt_level = exempt_level
+        self._lock = threading.Lock()
+        # (logger, template) -> [records shown, time of the last record shown, records dropped]
+        self._state = {}
+
+    def filter(self, record):
+        record.suppressed = 0
+        if record.levelno >= self.exempt_level:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.setdefault((record.name, record.msg), [0, 0.0, 0])
+            if state[0] < self.burst or now - state[1] >= self.interval:
+                state[0] += 1
+                state[1] = now
+                record.suppressed, state[2] = state[2], 0
+                return True
+            state[2] += 1
+            return False
+
+
+class ConsoleFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s: %(message)s", "%H:%M:%S")
+
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, "suppressed", 0):
+            text += f" ({record.suppressed} similar messages suppressed)"
+        return text
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    One JSON object per record; structured values passed as extra={"fields": {...}} become keys.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(stage, level=None, quiet=None, directory=None):
+    """
+    Send log records to the console and to <directory>/<stage>.jsonl.
+
+    The console shows `level` and above (NOAA_LOG_LEVEL, default INFO), or only warnings and errors
+    in quiet mode (NOAA_QUIET), rate-limited by RateLimitFilter. The file receives INFO and above
+    (DEBUG too if that is the console level) without rate limiting, so failed downloads and other
+    warnings are kept even when the console drops them.
+
+    Returns:
+    Logger: The stage's logger.
+    """
+    level = level or os.environ.get(LOG_LEVEL_ENV, "INFO")
+    level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    if quiet is None:
+        quiet = os.environ.get(QUIET_ENV, "") not in ("", "0", "false", "False")
+    console_level = max(level, logging.WARNING) if quiet else level
+    file_level = min(level, logging.INFO)
+
+    directory = directory or os.environ.get(LOG_DIRECTORY_ENV, DEFAULT_LOG_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if getattr(handler, "_pipeline_handler", False)]:
+        root.removeHandler(handler)
+        handler.close()
+
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(console_level)
+    console_handler.addFilter(RateLimitFilter())
+    console_handler.setFormatter(ConsoleFormatter())
+
+    file_handler = logging.FileHandler(os.path.join(directory, f"{stage}.jsonl"), encoding="utf-8")
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(JsonLinesFormatter())
+
+    for handler in (console_handler, file_handler):
+        handler._pipeline_handler = True
+        root.addHandler(handler)
+    root.setLevel(min(console_level, file_level))
+    return logging.getLogger(stage)
+
+
+class ProgressLog:
+    """
+    Progress of a stage over its work units: one INFO summary per unit (FIPS or FIPS-year) and,
+    at most every `interval` seconds, an overall line with the rate and, if `total` is known, the
+    remaining time. Units passed over (already written, no centroid) are counted with skip().
+    """
+
+    def __init__(self, logger, total, unit="counties", interval=DEFAULT_PROGRESS_INTERVAL):
+        self.logger = logger
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.completed = 0
+        self.skipped = 0
+        self.rows = 0
+        self.start_time = time.perf_counter()
+        self._last_report = self.start_time
+
+    def skip(self):
+        """
+        Count a unit that needed no work toward the total, without a summary or a share of the rate.
+        """
+        self.skipped += 1
+        self._report()
+
+    def done(self, fips, rows, seconds, year=None, **fields):
+        """
+        Record a finished unit and log its summary.
+        """
+        self.completed += 1
+        self.rows += rows
+        label = f"FIPS {fips}" if year is None else f"FIPS {fips} {year}"
+        self.logger.info(
+            "%s: %d rows in %.2fs",
+            label,
+            rows,
+            seconds,
+            extra={"fields": {"fips": str(fips), "year": year, "rows": rows, "seconds": round(seconds, 3), **fields}},
+        )
+        self._report()
+
+    def _report(self):
+        now = time.perf_counter()
+        if now - self._last_report >= self.interval or self.completed + self.skipped == self.total:
+            self._last_report = now
+            elapsed = now - self.start_time
+            rate = self.completed / elapsed if elapsed else 0.0
+            fields = {"completed": self.completed, "skipped": self.skipped, "total": self.total, "rows": self.rows, "elapsed_seconds": round(elapsed, 1)}
+            if self.total is None:
+                self.logger.info("Progress: %d %s, %d rows, %.2f %s/s", self.completed, self.unit, self.rows, rate, self.unit, extra={"fields": fields})
+                return
+            left = self.total - self.completed - self.skipped
+            remaining = left / rate if rate else (0.0 if left == 0 else float("nan"))
+            self.logger.info(
+                "Progress: %d/%d %s, %d rows, %.2f %s/s, %.0fs left",
+                self.completed + self.skipped,
+                self.total,
+                self.unit,
+                self.rows,
+                rate,
+                self.unit,
+                remaining,
+                extra={"fields": fields},
+            )
@@ -0,0 +1,174 @@
+import logging
+import os
+import sqlite3
+import time
+
+from county_data import normalize_fips
+
+logger = logging.getLogger(__name__)
+
+
+def journal_path(output_path):
+    """
+    File of the progress journal kept next to a stage-5 output file.
+    """
+    return f"{output_path}.journal.sqlite"
+
+
+def open_journal(output_path, resume=True):
+    """
+    Progress journal of an output file; with resume=False earlier progress is forgotten and the
+    output is rewritten from scratch.
+
+    The journal is reconciled with the output (prepare_output) before it is returned, so what it
+    reports as done is what the file holds, even if the file was deleted or cut short since.
+    """
+    journal = ProgressJournal(journal_path(output_path))
+    if not resume:
+        journal.reset()
+    journal.prepare_output(output_path)
+    return journal
+
+
+class ProgressJournal:
+    """
+    Durable record of the (FIPS, year) units whose rows are safely in an output file.
+
+    A unit is recorded only after its rows have been flushed and fsynced, together with the byte
+    offset the output ended at. Since output is append-only, the largest recorded offset is the last
+    consistent boundary: prepare_output cuts anything written after it (a unit interrupted by a
+    crash) and a rerun skips every recorded unit, so an interrupted run resumes where it stopped.
+
+    The days (day of the year) a unit covered are recorded with it, so produced_days() is a
+    fingerprint of every date in the output; incremental runs (delta_manifest.PendingWork) use it
+    to add only new dates, which may append to a unit recorded earlier.
+
+    The journal is a small SQLite database; only one thread writes to it at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The multiprocess writer records units from its own thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            "fips TEXT NOT NULL, "
+            "year TEXT NOT NULL, "
+            "end_offset INTEGER NOT NULL, "
+            "rows INTEGER NOT NULL, "
+            "committed_at REAL NOT NULL, "
+            "PRIMARY KEY (fips, year))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS days ("
+            "fips TEXT NOT NULL, "
+            "year TEXT NOT NULL, "
+            "day INTEGER NOT NULL, "
+            "PRIMARY KEY (fips, year, day))"
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def completed(self):
+        """
+        Set of (FIPS, year) units already in the output, with normalized FIPS and string years.
+        """
+        return set(self.connection.execute("SELECT fips, year FROM units").fetchall())
+
+    def completed_years(self, fips):
+        """
+        Years of a county already in the output.
+        """
+        rows = self.connection.execute("SELECT year FROM units WHERE fips = ?", (normalize_fips(fips),))
+        return {year for (year,) in rows}
+
+    def is_done(self, fips, year):
+        row = self.connection.execute(
+            "SELECT 1 FROM units WHERE fips = ? AND year = ?",
+            (normalize_fips(fips), str(year)),
+        ).fetchone()
+        return row is not None
+
+    def produced_days(self):
+        """
+        Days in the output per unit: (FIPS, year) -> set of day-of-year numbers, or None for units
+        recorded without their days (by an older version), which count as complete.
+        """
+        produced = {unit: None for unit in self.completed()}
+        for fips, year, day in self.connection.execute("SELECT fips, year, day FROM days"):
+            if produced.get((fips, year)) is None:
+                produced[(fips, year)] = set()
+            produced[(fips, year)].add(day)
+        return produced
+
+    def committed_offset(self):
+        """
+        Byte offset of the end of the last recorded unit (0 if nothing is recorded).
+        """
+        (offset,) = self.connection.execute("SELECT COALESCE(MAX(end_offset), 0) FROM units").fetchone()
+        return offset
+
+    def record(self, fips, year, end_offset, rows, days=()):
+        """
+        Mark a unit (and the days of the year it covered) as complete; call only once its rows are
+        durably in the output.
+        """
+        fips = normalize_fips(fips)
+        year = str(year)
+        # An incremental run appends new days to a unit recorded before, so its rows add up
+        self.connection.execute(
+            "INSERT INTO units (fips, year, end_offset, rows, committed_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (fips, year) DO UPDATE SET "
+            "end_offset = excluded.end_offset, rows = units.rows + excluded.rows, committed_at = excluded.committed_at",
+            (fips, year, end_offset, rows, time.time()),
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO days (fips, year, day) VALUES (?, ?, ?)",
+            [(fips, year, int(day)) for day in days],
+        )
+        self.connection.commit()
+
+    def reset(self):
+        self.connection.execute("DELETE FROM units")
+        self.connection.execute("DELETE FROM days")
+        self.connection.commit()
+
+    def prepare_output(self, file_path):
+        """
+        Cut the output back to the last recorded boundary before appending to it.
+
+        If the output is missing or shorter than the journal says (it was deleted or replaced), the
+        journal no longer describes it and is reset.
+
+        Args:
+        file_path (str): Output file the journal tracks.
+
+        Returns:
+        int: Offset the output now ends at; 0 means start a new file.
+        """
+        offset = self.committed_offset()
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = -1
+
+        if offset == 0 or size < offset:
+            if offset:
+                logger.warning("%s no longer holds the journaled rows; starting over", file_path)
+                self.reset()
+            return 0
+
+        if size > offset:
+            logger.warning("Discarding %d bytes of unfinished output in %s", size - offset, file_path)
+            with open(file_path, 'r+b') as output_file:
+                output_file.truncate(offset)
+        return offset
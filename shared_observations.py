@@ -0,0 +1,154 @@
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from download_plan import station_id_from_url
+from isd_observations import QUALITY_DTYPE, StationObservations
+from metrics import metrics
+from observation_cache import DownloadFailedError
+
+logger = logging.getLogger(__name__)
+
+# Storage type of each StationObservations column; every item size is a multiple of 8, so all
+# columns in the block stay aligned
+COLUMN_DTYPES = {
+    "minutes": np.dtype(np.int64),
+    "latitude": np.dtype(np.float64),
+    "longitude": np.dtype(np.float64),
+    "wind": np.dtype(np.float64),
+    "temperature": np.dtype(np.float64),
+    "temperature_quality": np.dtype(QUALITY_DTYPE),
+    "precipitation": np.dtype(np.float64),
+}
+ROW_BYTES = sum(dtype.itemsize for dtype in COLUMN_DTYPES.values())
+
+
+class SharedObservationStore:
+    """
+    Parsed station-years published once into a single multiprocessing.shared_memory block.
+
+    The parent process builds the block from the observation cache with publish(); the store then
+    pickles as just the block's name and a (station ID, year) -> (offset, rows) directory, so it can
+    be handed to ProcessPoolExecutor workers through the initializer. Workers attach on first use
+    and get StationObservations whose columns are read-only views of the block, so the parsed data
+    is in memory once however many workers run.
+
+    fetch_many has the signature of ObservationCache.fetch_many; station-years not in the block go
+    to the observation cache.
+    """
+
+    def __init__(self, name, directory, observation_cache):
+        self.name = name
+        self.directory = directory
+        self.observation_cache = observation_cache
+        self._memory = None
+        self._owner = False
+
+    @classmethod
+    def publish(cls, observation_cache, urls_by_year):
+        """
+        Copy the cached station-years of the given URLs into a new shared memory block.
+
+        Args:
+        observation_cache (ObservationCache): Cache holding the parsed station-years.
+        urls_by_year (dict): year -> station-year URLs (the plan's "referenced_by_year").
+
+        Returns:
+        SharedObservationStore: The owning store; close() it to free the block.
+
+        Raises:
+        OSError: If the block cannot be created (e.g. /dev/shm is too small).
+        """
+        rows = {}
+        for year, urls in urls_by_year.items():
+            for url in urls:
+                station_id = station_id_from_url(url)
+                count = observation_cache.row_count(station_id, year)
+                if count is not None:
+                    rows[(station_id, str(year))] = count
+
+        # A zero-sized block cannot be created
+        memory = shared_memory.SharedMemory(create=True, size=max(sum(rows.values()) * ROW_BYTES, 1))
+        store = cls(memory.name, {}, observation_cache)
+        store._memory = memory
+        store._owner = True
+
+        offset = 0
+        try:
+            for (station_id, year), count in rows.items():
+                observations = observation_cache.get(station_id, year)
+                # Evicted since it was counted; workers will read it from the cache
+                if observations is None or len(observations) != count:
+                    continue
+                for name, values in store._columns(offset, count, writeable=True).items():
+                    values[:] = getattr(observations, name)
+                store.directory[(station_id, year)] = (offset, count)
+                offset += count * ROW_BYTES
+        except BaseException:
+            # Nobody else knows the block yet; free it rather than leave it in /dev/shm
+            memory.close()
+            memory.unlink()
+            raise
+
+        logger.info("Shared %d station-years (%.1f MiB) with the workers", len(store.directory), offset / 1024 ** 2)
+        return store
+
+    def __getstate__(self):
+        return {"name": self.name, "directory": self.directory, "observation_cache": self.observation_cache}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], state["directory"], state["observation_cache"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _columns(self, offset, count, writeable=False):
+        if self._memory is None:
+            self._memory = shared_memory.SharedMemory(name=self.name)
+        columns = {}
+        for name, dtype in COLUMN_DTYPES.items():
+            values = np.ndarray(count, dtype=dtype, buffer=self._memory.buf, offset=offset)
+            values.flags.writeable = writeable
+            columns[name] = values
+            offset += count * dtype.itemsize
+        return columns
+
+    def get(self, station_id, year):
+        """
+        Observations of a station-year backed by the shared block, or None if it was not published.
+        """
+        entry = self.directory.get((station_id, str(year)))
+        if entry is None:
+            metrics.count("shared_store_misses")
+            return None
+        metrics.count("shared_store_hits")
+        return StationObservations.from_arrays(station_id, self._columns(*entry))
+
+    def fetch_many(self, urls, year, download_many):
+        """
+        Like ObservationCache.fetch_many, reading published station-years from the shared block.
+        """
+        shared = {url: self.get(station_id_from_url(url), year) for url in urls}
+        misses = [url for url in urls if shared[url] is None]
+        try:
+            fetched = dict(zip(misses, self.observation_cache.fetch_many(misses, year, download_many))) if misses else {}
+        except DownloadFailedError as e:
+            fetched = dict(zip(misses, e.results))
+            raise DownloadFailedError(e.urls, [(shared[url], None) if shared[url] is not None else fetched[url] for url in urls]) from e
+        return [(shared[url], None) if shared[url] is not None else fetched[url] for url in urls]
+
+    def close(self):
+        """
+        Detach from the block; the publishing process also frees it. Observations obtained from the
+        store must not be used afterwards.
+        """
+        if self._memory is None:
+            return
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+        self._memory = None
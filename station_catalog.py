@@ -0,0 +1,283 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# USAF and WBAN are kept as the text the station CSV holds (USAF codes can be alphanumeric, e.g.
+# A00008), since stage 2 joins them into the IDs of the NOAA URLs; coordinates keep full precision
+ID_WIDTHS = {"usaf": 6, "wban": 5}
+
+
+def catalog_dtype(usaf_width=ID_WIDTHS["usaf"], wban_width=ID_WIDTHS["wban"]):
+    """
+    One fixed-size record per station; the file is a plain .npy so it can be memory-mapped.
+    """
+    return np.dtype([
+        ("usaf", f"U{usaf_width}"),
+        ("wban", f"U{wban_width}"),
+        ("latitude", np.float64),
+        ("longitude", np.float64),
+        ("elevation", np.float32),
+        ("begin", np.int32),
+        ("end", np.int32),
+    ])
+
+
+CATALOG_DTYPE = catalog_dtype()
+
+# Open-addressing hash table mapping a hash of the station ID (USAF followed by WBAN) to a catalog row
+INDEX_DTYPE = np.dtype([
+    ("key", np.uint64),
+    ("row", np.int32),
+])
+
+EMPTY_ROW = -1
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+FNV_OFFSET = 0xCBF29CE484222325
+FNV_PRIME = 0x100000001B3
+
+
+def catalog_paths(csv_path):
+    """
+    File names of the binary catalog and its hash index, written next to the station CSV.
+
+    Args:
+    csv_path (str): Path of a station_data_*.csv file.
+
+    Returns:
+    tuple: (catalog_path, index_path)
+    """
+    stem, _ = os.path.splitext(csv_path)
+    return f"{stem}.catalog.npy", f"{stem}.catalog_index.npy"
+
+
+def station_key(station_id):
+    # 64-bit FNV-1a of the ID, the same in every process (unlike hash())
+    key = FNV_OFFSET
+    for byte in str(station_id).encode():
+        key = ((key ^ byte) * FNV_PRIME) & 0xFFFFFFFFFFFFFFFF
+    return key
+
+
+def _hash_slot(key, bits):
+    # Fibonacci hashing: multiply and keep the top bits
+    return ((key * HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) >> (64 - bits)
+
+
+def _first_column(station_df, names):
+    for name in names:
+        if name in station_df.columns:
+            return station_df[name]
+    return pd.Series(np.nan, index=station_df.index)
+
+
+def _to_text(values):
+    # The text str() gives the value pandas read, as stage 2 always formatted the IDs
+    return values.astype(str).to_numpy(dtype=np.str_)
+
+
+def _to_yyyymmdd(values):
+    dates = pd.to_datetime(values.astype(str), format="%Y%m%d", errors="coerce")
+    if dates.isna().all():
+        dates = pd.to_datetime(values, errors="coerce")
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).fillna(0).astype(np.int32).to_numpy()
+
+
+def build_hash_index(usaf, wban):
+    """
+    Build the open-addressing hash table for the given station codes.
+
+    Args:
+    usaf (ndarray): USAF codes (text), one per catalog row.
+    wban (ndarray): WBAN codes (text), one per catalog row.
+
+    Returns:
+    ndarray: Table of INDEX_DTYPE records; unused slots have row == -1. A station ID listed twice
+        maps to its first row.
+    """
+    bits = max(4, int(np.ceil(np.log2(max(len(usaf), 1) * 2))))
+    table = np.zeros(1 << bits, dtype=INDEX_DTYPE)
+    table["row"] = EMPTY_ROW
+    mask = (1 << bits) - 1
+
+    for row, (station_usaf, station_wban) in enumerate(zip(usaf.tolist(), wban.tolist())):
+        key = station_key(f"{station_usaf}{station_wban}")
+        slot = _hash_slot(key, bits)
+        while table["row"][slot] != EMPTY_ROW and table["key"][slot] != key:
+            slot = (slot + 1) & mask
+        if table["row"][slot] == EMPTY_ROW:
+            table["key"][slot] = key
+            table["row"][slot] = row
+
+    return table
+
+
+def write_catalog(station_df, csv_path):
+    """
+    Write the binary station catalog and its hash index next to a station CSV.
+
+    Args:
+    station_df (DataFrame): Station data as returned by noaastn.get_stations_info.
+    csv_path (str): Path of the CSV the data was written to; the catalog files share its name.
+
+    Returns:
+    str: Path of the catalog file.
+    """
+    usaf = _to_text(station_df["usaf"])
+    wban = _to_text(station_df["wban"])
+    # Wider codes than usual widen the field instead of being cut
+    catalog = np.zeros(len(station_df), dtype=catalog_dtype(
+        max(ID_WIDTHS["usaf"], usaf.dtype.itemsize // 4),
+        max(ID_WIDTHS["wban"], wban.dtype.itemsize // 4),
+    ))
+    catalog["usaf"] = usaf
+    catalog["wban"] = wban
+    catalog["latitude"] = pd.to_numeric(station_df["latitude"], errors="coerce").to_numpy(dtype=np.float64)
+    catalog["longitude"] = pd.to_numeric(station_df["longitude"], errors="coerce").to_numpy(dtype=np.float64)
+    catalog["elevation"] = pd.to_numeric(_first_column(station_df, ["elevation", "elev(m)"]), errors="coerce").to_numpy(dtype=np.float32)
+    catalog["begin"] = _to_yyyymmdd(_first_column(station_df, ["start", "begin"]))
+    catalog["end"] = _to_yyyymmdd(_first_column(station_df, ["end"]))
+
+    catalog_path, index_path = catalog_paths(csv_path)
+    np.save(catalog_path, catalog)
+    np.save(index_path, build_hash_index(catalog["usaf"], catalog["wban"]))
+    return catalog_path
+
+
+class StationCatalog:
+    """
+    Read-only, memory-mapped view of a station catalog.
+
+    The arrays are backed by the page cache, so every process that opens the same catalog shares
+    one copy of the data.
+    """
+
+    def __init__(self, catalog_path, index_path):
+        self.records = np.load(catalog_path, mmap_mode="r")
+        self.index = np.load(index_path, mmap_mode="r")
+        self._bits = int(np.log2(len(self.index)))
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def usaf(self):
+        return self.records["usaf"]
+
+    @property
+    def wban(self):
+        return self.records["wban"]
+
+    @property
+    def latitude(self):
+        return self.records["latitude"]
+
+    @property
+    def longitude(self):
+        return self.records["longitude"]
+
+    @property
+    def elevation(self):
+        return self.records["elevation"]
+
+    @property
+    def begin(self):
+        return self.records["begin"]
+
+    @property
+    def end(self):
+        return self.records["end"]
+
+    def station_id(self, row):
+        return f"{self.usaf[row]}{self.wban[row]}"
+
+    def row(self, usaf, wban):
+        """
+        Catalog row of a station, or None if the station is not in the catalog.
+        """
+        return self.row_for_id(f"{usaf}{wban}")
+
+    def row_for_id(self, station_id):
+        """
+        Catalog row for a station identifier as used in the NOAA URLs (USAF followed by WBAN).
+        """
+        key = station_key(station_id)
+        mask = len(self.index) - 1
+        slot = _hash_slot(key, self._bits)
+        while self.index["row"][slot] != EMPTY_ROW:
+            # Different IDs can share a key, so the row's own ID decides
+            if self.index["key"][slot] == key and self.station_id(int(self.index["row"][slot])) == station_id:
+                return int(self.index["row"][slot])
+            slot = (slot + 1) & mask
+        return None
+
+    def coordinates(self, station_id):
+        """
+        (latitude, longitude) of a station, or None if it is unknown or has no coordinates.
+        """
+        row = self.row_for_id(station_id)
+        if row is None:
+            return None
+        lat = float(self.latitude[row])
+        lon = float(self.longitude[row])
+        if np.isnan(lat) or np.isnan(lon):
+            return None
+        return lat, lon
+
+    def to_dataframe(self):
+        """
+        Copy the catalog into a DataFrame with the same column names as the station CSV.
+        """
+        return pd.DataFrame({
+            "usaf": np.asarray(self.usaf, dtype=object),
+            "wban": np.asarray(self.wban, dtype=object),
+            "latitude": np.asarray(self.latitude),
+            "longitude": np.asarray(self.longitude),
+            "elevation": np.asarray(self.elevation),
+            "begin": np.asarray(self.begin),
+            "end": np.asarray(self.end),
+        })
+
+
+def _current_format(catalog_path):
+    # Catalogs of older versions stored the codes as numbers and the coordinates as float32
+    fields = np.load(catalog_path, mmap_mode="r").dtype.fields
+    return fields["usaf"][0].kind == "U" and fields["latitude"][0] == np.float64
+
+
+@lru_cache(maxsize=None)
+def load_catalog(csv_path):
+    """
+    Open the catalog written next to a station CSV. Cached, so each process maps it only once.
+
+    Args:
+    csv_path (str): Path of the station_data_*.csv file the catalog was written for.
+
+    Returns:
+    StationCatalog: Memory-mapped catalog.
+    """
+    return StationCatalog(*catalog_paths(csv_path))
+
+
+def open_or_build_catalog(csv_path):
+    """
+    Open the catalog for a station CSV, building it first if it is missing or older than the CSV.
+
+    Args:
+    csv_path (str): Path of a station_data_*.csv file.
+
+    Returns:
+    StationCatalog: Memory-mapped catalog.
+    """
+    catalog_path, index_path = catalog_paths(csv_path)
+    up_to_date = (
+        os.path.exists(catalog_path)
+        and os.path.exists(index_path)
+        and os.path.getmtime(catalog_path) >= os.path.getmtime(csv_path)
+        and _current_format(catalog_path)
+    )
+    if not up_to_date:
+        write_catalog(pd.read_csv(csv_path), csv_path)
+        load_catalog.cache_clear()
+    return load_catalog(csv_path)
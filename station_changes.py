@@ -0,0 +1,160 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from station_catalog import open_or_build_catalog
+
+# Station CSVs written by 1.getting_stationData.py; the timestamp in the name sorts chronologically
+SNAPSHOT_PATTERN = "station_data_*.csv"
+
+CHANGE_COLUMNS = ["station", "change", "latitude", "longitude", "previous_latitude", "previous_longitude"]
+
+
+def snapshot_paths(directory="."):
+    """
+    Station snapshots in a directory, oldest first.
+    """
+    return sorted(glob.glob(os.path.join(directory, SNAPSHOT_PATTERN)), key=os.path.basename)
+
+
+def latest_snapshot(directory="."):
+    """
+    Newest station snapshot in a directory, or None if there is none.
+    """
+    paths = snapshot_paths(directory)
+    return paths[-1] if paths else None
+
+
+def previous_snapshot(csv_path):
+    """
+    Snapshot taken before `csv_path` in the same directory, or None if it is the first.
+    """
+    earlier = [path for path in snapshot_paths(os.path.dirname(csv_path) or ".") if os.path.basename(path) < os.path.basename(csv_path)]
+    return earlier[-1] if earlier else None
+
+
+def station_changes_path(csv_path):
+    """
+    File of the change set written next to a station snapshot.
+    """
+    stem, _ = os.path.splitext(csv_path)
+    return f"{stem}.changes.json"
+
+
+def statistics_source_path(statistics_file_path):
+    """
+    File recording which station snapshot a county_station_statistics*.csv was computed from.
+    """
+    stem, _ = os.path.splitext(statistics_file_path)
+    return f"{stem}.source.json"
+
+
+def _located_stations(csv_path):
+    # Station IDs and positions as stage 2 sees them: from the catalog, stations without coordinates dropped
+    stations = open_or_build_catalog(csv_path).to_dataframe()
+    stations = stations[stations["latitude"].notna() & stations["longitude"].notna()]
+    return pd.DataFrame({
+        "station": stations["usaf"].astype(str) + stations["wban"].astype(str),
+        "latitude": stations["latitude"],
+        "longitude": stations["longitude"],
+    }).drop_duplicates()
+
+
+def diff_snapshots(previous_csv_path, csv_path):
+    """
+    Stations added, removed or moved between two snapshots.
+
+    Stations are matched by ID (USAF followed by WBAN); a station whose position changed is "moved"
+    and keeps its previous position. Only positions matter to stage 2, so changes of names or
+    date ranges are not reported.
+
+    Returns:
+    DataFrame: One row per change, with CHANGE_COLUMNS (positions missing on one side are NaN).
+    """
+    previous = _located_stations(previous_csv_path)
+    current = _located_stations(csv_path)
+    merged = previous.merge(current, on=["station", "latitude", "longitude"], how="outer", indicator=True)
+    disappeared = merged[merged["_merge"] == "left_only"]
+    appeared = merged[merged["_merge"] == "right_only"]
+
+    added = appeared[~appeared["station"].isin(previous["station"])]
+    removed = disappeared[~disappeared["station"].isin(current["station"])]
+    # Pair the old and new positions of a moved station in order (a station ID can be listed twice)
+    moved_to = appeared[appeared["station"].isin(previous["station"])]
+    moved_from = disappeared[disappeared["station"].isin(current["station"])]
+    moved = (
+        moved_to.assign(pair=moved_to.groupby("station").cumcount())[["station", "pair", "latitude", "longitude"]]
+        .merge(
+            moved_from.assign(pair=moved_from.groupby("station").cumcount())[["station", "pair", "latitude", "longitude"]]
+            .rename(columns={"latitude": "previous_latitude", "longitude": "previous_longitude"}),
+            on=["station", "pair"],
+            how="outer",
+        )
+    )
+
+    changes = pd.concat([
+        added.assign(change="added"),
+        removed.rename(columns={"latitude": "previous_latitude", "longitude": "previous_longitude"}).assign(change="removed"),
+        moved.assign(change="moved"),
+    ], ignore_index=True)
+    return changes.reindex(columns=CHANGE_COLUMNS).sort_values(["station", "change"], kind="stable").reset_index(drop=True)
+
+
+def write_station_changes(previous_csv_path, csv_path):
+    """
+    Diff a new snapshot against the previous one and write the change set next to it.
+
+    Returns:
+    DataFrame: The changes, as returned by diff_snapshots.
+    """
+    changes = diff_snapshots(previous_csv_path, csv_path)
+    records = [
+        {column: (None if isinstance(value, float) and np.isnan(value) else value) for column, value in record.items()}
+        for record in changes.to_dict("records")
+    ]
+    document = {"previous": os.path.basename(previous_csv_path), "current": os.path.basename(csv_path), "changes": records}
+    with open(station_changes_path(csv_path), 'w') as changes_file:
+        json.dump(document, changes_file, indent=1)
+    return changes
+
+
+def changes_since(source_csv_path, csv_path):
+    """
+    Every change between an older snapshot and `csv_path`, following the chain of change sets stage 1
+    wrote for the snapshots in between.
+
+    Returns:
+    DataFrame: Changes with CHANGE_COLUMNS, or None if a change set of the chain is missing.
+    """
+    source = os.path.basename(source_csv_path)
+    directory = os.path.dirname(csv_path) or "."
+    current = os.path.basename(csv_path)
+    parts = []
+    while current != source:
+        path = station_changes_path(os.path.join(directory, current))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as changes_file:
+            document = json.load(changes_file)
+        parts.append(pd.DataFrame(document["changes"], columns=CHANGE_COLUMNS))
+        current = document["previous"]
+    if not parts:
+        return pd.DataFrame(columns=CHANGE_COLUMNS)
+    return pd.concat(parts, ignore_index=True)
+
+
+def changed_positions(changes):
+    """
+    Every position a change touches: the new and the previous position of each station.
+
+    Returns:
+    DataFrame: Columns 'latitude' and 'longitude', as StationIndex expects.
+    """
+    positions = pd.concat([
+        changes[["latitude", "longitude"]],
+        changes[["previous_latitude", "previous_longitude"]].set_axis(["latitude", "longitude"], axis=1),
+    ], ignore_index=True).astype(np.float64)
+    return positions.dropna().drop_duplicates().reset_index(drop=True)
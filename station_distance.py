@@ -0,0 +1,216 @@
+import numpy as np
+from geopy.distance import geodesic
+
+# Mean earth radius (IUGG) in miles, used by the haversine mode
+EARTH_RADIUS_MILES = 3958.7613
+
+# WGS-84 ellipsoid, the same one geopy's geodesic uses by default
+WGS84_A_MILES = 6378137.0 / 1609.344
+WGS84_F = 1 / 298.257223563
+WGS84_B_MILES = WGS84_A_MILES * (1 - WGS84_F)
+
+
+def haversine_miles(lat, lon, lats, lons):
+    """
+    Great-circle distance on a sphere from one point (or an array of points) to an array of points.
+
+    The spherical model ignores the flattening of the earth, so the result differs from the
+    ellipsoidal geodesic by up to about 0.5% (roughly 0.25 miles at the 50 mile search radius).
+
+    Args:
+    lat (float or ndarray): Latitude(s) of the origin in degrees.
+    lon (float or ndarray): Longitude(s) of the origin in degrees.
+    lats (ndarray): Latitudes of the destinations in degrees.
+    lons (ndarray): Longitudes of the destinations in degrees.
+
+    Returns:
+    ndarray: Distances in miles, broadcast over the inputs.
+    """
+    lat1 = np.radians(lat)
+    lon1 = np.radians(lon)
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lon2 = np.radians(np.asarray(lons, dtype=np.float64))
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def vincenty_miles(lat, lon, lats, lons, max_iterations=200, tolerance=1e-12):
+    """
+    Ellipsoidal (WGS-84) distance using Vincenty's inverse formula, evaluated for all pairs at once.
+
+    Vincenty agrees with the exact (Karney) geodesic used by geopy to within 0.5 mm. The iteration
+    does not converge for nearly antipodal points; those pairs fall back to geopy's geodesic, so the
+    result is always within that bound.
+
+    Args:
+    lat (float or ndarray): Latitude(s) of the origin in degrees.
+    lon (float or ndarray): Longitude(s) of the origin in degrees.
+    lats (ndarray): Latitudes of the destinations in degrees.
+    lons (ndarray): Longitudes of the destinations in degrees.
+    max_iterations (int): Iteration cap before falling back to geodesic (default: 200).
+    tolerance (float): Convergence threshold on lambda in radians (default: 1e-12).
+
+    Returns:
+    ndarray: Distances in miles, broadcast over the inputs.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        np.asarray(lat, dtype=np.float64),
+        np.asarray(lon, dtype=np.float64),
+        np.asarray(lats, dtype=np.float64),
+        np.asarray(lons, dtype=np.float64),
+    )
+    shape = lat1.shape
+    lat1, lon1, lat2, lon2 = (x.ravel() for x in (lat1, lon1, lat2, lon2))
+
+    a = WGS84_A_MILES
+    b = WGS84_B_MILES
+    f = WGS84_F
+
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    sin_sigma = np.zeros(L.shape)
+    cos_sigma = np.ones(L.shape)
+    sigma = np.zeros(L.shape)
+    cos_sq_alpha = np.ones(L.shape)
+    cos_2sigma_m = np.zeros(L.shape)
+
+    # Only pairs that have not converged yet are iterated again, so a handful of slow
+    # pairs does not keep the whole array in the loop
+    active = np.arange(L.size)
+    for _ in range(max_iterations):
+        if active.size == 0:
+            break
+        s_U1, c_U1, s_U2, c_U2 = sin_U1[active], cos_U1[active], sin_U2[active], cos_U2[active]
+        sin_lam = np.sin(lam[active])
+        cos_lam = np.cos(lam[active])
+        s_sigma = np.sqrt((c_U2 * sin_lam) ** 2 + (c_U1 * s_U2 - s_U1 * c_U2 * cos_lam) ** 2)
+        c_sigma = s_U1 * s_U2 + c_U1 * c_U2 * cos_lam
+        sig = np.arctan2(s_sigma, c_sigma)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(s_sigma == 0, 0.0, c_U1 * c_U2 * sin_lam / s_sigma)
+            c_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha == 0; cos_2sigma_m is then taken as 0
+            c_2sigma_m = np.where(c_sq_alpha == 0, 0.0, c_sigma - 2 * s_U1 * s_U2 / c_sq_alpha)
+
+        C = f / 16 * c_sq_alpha * (4 + f * (4 - 3 * c_sq_alpha))
+        lam_new = L[active] + (1 - C) * f * sin_alpha * (
+            sig + C * s_sigma * (c_2sigma_m + C * c_sigma * (-1 + 2 * c_2sigma_m ** 2))
+        )
+        converged = np.abs(lam_new - lam[active]) <= tolerance
+
+        lam[active] = lam_new
+        sin_sigma[active] = s_sigma
+        cos_sigma[active] = c_sigma
+        sigma[active] = sig
+        cos_sq_alpha[active] = c_sq_alpha
+        cos_2sigma_m[active] = c_2sigma_m
+        active = active[~converged]
+
+    u_sq = cos_sq_alpha * (a ** 2 - b ** 2) / b ** 2
+    A = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    B = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = B * sin_sigma * (
+        cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        )
+    )
+    distances = b * A * (sigma - delta_sigma)
+
+    # Coincident points give sin_sigma == 0, which is exactly 0 miles
+    distances[sin_sigma == 0] = 0.0
+
+    # Nearly antipodal pairs did not converge: compute them exactly
+    for idx in active:
+        distances[idx] = geodesic((lat1[idx], lon1[idx]), (lat2[idx], lon2[idx])).miles
+
+    return distances.reshape(shape)
+
+
+DISTANCE_METHODS = {
+    "haversine": haversine_miles,
+    "vincenty": vincenty_miles,
+}
+
+
+def distances_miles(lat, lon, lats, lons, method="vincenty"):
+    """
+    Distance from one point to every point in an array, in a single vectorized call.
+
+    Args:
+    lat (float): Latitude of the origin in degrees.
+    lon (float): Longitude of the origin in degrees.
+    lats (ndarray): Latitudes of the destinations in degrees.
+    lons (ndarray): Longitudes of the destinations in degrees.
+    method (str): "vincenty" (ellipsoidal, within 0.5 mm of geodesic) or "haversine"
+        (spherical, within about 0.5%) (default: "vincenty").
+
+    Returns:
+    ndarray: Distances in miles, one per destination.
+    """
+    try:
+        distance_function = DISTANCE_METHODS[method]
+    except KeyError:
+        raise ValueError(f"Unknown distance method: {method}")
+    return distance_function(lat, lon, lats, lons)
+
+
+def iter_distance_blocks(lats1, lons1, lats2, lons2, method="vincenty", block_size=256):
+    """
+    Yield the origin x destination distance matrix in blocks of origin rows.
+
+    Keeps memory bounded at block_size x len(lats2) floats regardless of how many origins there are.
+
+    Args:
+    lats1, lons1 (ndarray): Origin coordinates in degrees.
+    lats2, lons2 (ndarray): Destination coordinates in degrees.
+    method (str): Distance method, see distances_miles (default: "vincenty").
+    block_size (int): Number of origin rows per block (default: 256).
+
+    Yields:
+    tuple: (start, block) where block[i, j] is the distance in miles from origin start + i to destination j.
+    """
+    lats1 = np.asarray(lats1, dtype=np.float64)
+    lons1 = np.asarray(lons1, dtype=np.float64)
+    lats2 = np.asarray(lats2, dtype=np.float64)[np.newaxis, :]
+    lons2 = np.asarray(lons2, dtype=np.float64)[np.newaxis, :]
+
+    for start in range(0, len(lats1), block_size):
+        stop = start + block_size
+        block = distances_miles(
+            lats1[start:stop, np.newaxis],
+            lons1[start:stop, np.newaxis],
+            lats2,
+            lons2,
+            method=method,
+        )
+        yield start, block
+
+
+def distance_matrix_miles(lats1, lons1, lats2, lons2, method="vincenty", block_size=256):
+    """
+    Full origin x destination distance matrix, computed block by block.
+
+    Args:
+    lats1, lons1 (ndarray): Origin coordinates in degrees.
+    lats2, lons2 (ndarray): Destination coordinates in degrees.
+    method (str): Distance method, see distances_miles (default: "vincenty").
+    block_size (int): Number of origin rows per block (default: 256).
+
+    Returns:
+    ndarray: Matrix of shape (len(lats1), len(lats2)) with distances in miles.
+    """
+    matrix = np.empty((len(lats1), len(lats2)), dtype=np.float64)
+    for start, block in iter_distance_blocks(lats1, lons1, lats2, lons2, method=method, block_size=block_size):
+        matrix[start:start + len(block)] = block
+    return matrix
+
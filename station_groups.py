@@ -0,0 +1,189 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from download_plan import station_id_from_url
+from metrics import metrics
+from observation_cache import DownloadFailedError
+
+# Stations are co-located if their positions agree to 2 decimals (about 1 km) and they share a real
+# WBAN or USAF code; NOAA lists many sites under both e.g. 722880-23152 and 999999-23152
+COORDINATE_DECIMALS = 2
+MISSING_USAF = "999999"
+MISSING_WBAN = "99999"
+
+GROUP_COLUMNS = ["station", "group", "begin", "end"]
+
+
+def station_groups_path(statistics_file_path):
+    """
+    File of the co-located station groups written next to a county_station_statistics*.csv file.
+    """
+    stem, _ = os.path.splitext(statistics_file_path)
+    return f"{stem}.groups.csv"
+
+
+def resolve_station_groups(stations):
+    """
+    Group the stations that are one physical site listed under several identifiers.
+
+    Args:
+    stations (DataFrame): Station catalog (StationCatalog.to_dataframe()).
+
+    Returns:
+    DataFrame: One row per station of a group of two or more, with GROUP_COLUMNS; "group" is the
+        member with the latest end date, which names the group.
+    """
+    stations = stations[stations["latitude"].notna() & stations["longitude"].notna()]
+    frame = pd.DataFrame({
+        "station": stations["usaf"].astype(str) + stations["wban"].astype(str),
+        "usaf": stations["usaf"].astype(str),
+        "wban": stations["wban"].astype(str),
+        "latitude": np.round(stations["latitude"].to_numpy(dtype=np.float64), COORDINATE_DECIMALS),
+        "longitude": np.round(stations["longitude"].to_numpy(dtype=np.float64), COORDINATE_DECIMALS),
+        "begin": stations["begin"],
+        "end": stations["end"],
+    })
+    # A station listed twice is one station, covering the union of its date ranges
+    frame = frame.groupby(["station", "usaf", "wban", "latitude", "longitude"], as_index=False).agg(begin=("begin", "min"), end=("end", "max"))
+
+    station_names = frame["station"].unique()
+    codes = pd.Index(station_names).get_indexer(frame["station"])
+    parent = np.arange(len(station_names))
+
+    def find(code):
+        while parent[code] != code:
+            parent[code] = parent[parent[code]]
+            code = parent[code]
+        return code
+
+    for column, missing in (("wban", MISSING_WBAN), ("usaf", MISSING_USAF)):
+        shared = frame[~frame[column].isin([missing, "nan", ""])]
+        for positions in shared.groupby(["latitude", "longitude", column]).indices.values():
+            roots = {find(codes[shared.index[position]]) for position in positions.tolist()}
+            first = roots.pop()
+            for root in roots:
+                parent[root] = first
+
+    dates = frame.groupby("station").agg(begin=("begin", "min"), end=("end", "max")).reindex(station_names)
+    groups = pd.DataFrame({
+        "station": station_names,
+        "root": [find(code) for code in range(len(station_names))],
+        "begin": dates["begin"].to_numpy(),
+        "end": dates["end"].to_numpy(),
+    })
+    groups = groups[groups.groupby("root")["station"].transform("size") > 1]
+    names = groups.sort_values(["end", "station"], ascending=[False, True]).drop_duplicates("root").set_index("root")["station"]
+    groups = groups.assign(group=groups["root"].map(names))
+    return groups.sort_values(["group", "station"])[GROUP_COLUMNS].reset_index(drop=True)
+
+
+def write_station_groups(groups, path):
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    groups.to_csv(temporary_path, index=False)
+    os.replace(temporary_path, path)
+
+
+class StationGroups:
+    """
+    Co-located station groups, and which member to use for a year.
+
+    Members whose date range covers the year come first, latest end date first; the others follow
+    in case the metadata is out of date. A station outside every group is its own group, so an
+    empty StationGroups (no groups file, or deduplication turned off) changes nothing.
+    """
+
+    def __init__(self, members=None):
+        # Station ID -> (group, begin, end), begin and end as YYYYMMDD
+        self.members = dict(members or {})
+
+    def __len__(self):
+        return len(self.members)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read groups written by write_station_groups; a missing file gives no groups.
+        """
+        if not os.path.exists(path):
+            return cls()
+        groups = pd.read_csv(path, dtype={"station": str, "group": str})
+        return cls({
+            station: (group, int(begin), int(end))
+            for station, group, begin, end in groups[GROUP_COLUMNS].itertuples(index=False)
+        })
+
+    def group_of(self, station_id):
+        member = self.members.get(station_id)
+        return member[0] if member is not None else station_id
+
+    def _rank(self, station_id, year):
+        _, begin, end = self.members[station_id]
+        covers = begin // 10000 <= int(year) <= end // 10000
+        return not covers, -end, station_id
+
+    def ranked(self, station_ids, year):
+        """
+        The given stations by group, in order of each group's first appearance.
+
+        Returns:
+        list: One list per group of its members among `station_ids`, preferred member first.
+        """
+        groups = {}
+        for station_id in station_ids:
+            groups.setdefault(self.group_of(station_id), []).append(station_id)
+        return [
+            sorted(members, key=lambda station_id: self._rank(station_id, year)) if len(members) > 1 else members
+            for members in groups.values()
+        ]
+
+    def preferred_urls(self, urls, year):
+        """
+        Of each group's URLs, only the preferred member's.
+        """
+        by_station = {station_id_from_url(url): url for url in urls}
+        return [by_station[members[0]] for members in self.ranked(list(by_station), year)]
+
+    def source(self, source):
+        """
+        `source` (ObservationCache or SharedObservationStore) fetching one member per group.
+        """
+        return DeduplicatedSource(source, self) if self.members else source
+
+
+class DeduplicatedSource:
+    """
+    fetch_many of an observation source that fetches only one member of each co-located group.
+
+    The preferred members of all groups are fetched together; a group whose member has no data for
+    the year moves on to its next member in another round. The members passed over give
+    (None, None) like a station-year NOAA does not have, so callers skip them as before.
+    """
+
+    def __init__(self, source, station_groups):
+        self.source = source
+        self.station_groups = station_groups
+
+    def fetch_many(self, urls, year, download_many):
+        by_station = {station_id_from_url(url): url for url in urls}
+        results = {}
+        pending = [list(members) for members in self.station_groups.ranked(list(by_station), year)]
+        while pending:
+            batch = [by_station[members.pop(0)] for members in pending]
+            try:
+                fetched = self.source.fetch_many(batch, year, download_many)
+            except DownloadFailedError as e:
+                # Report every file of every round, so the caller can remove them all
+                results.update(zip(batch, e.results))
+                raise DownloadFailedError(e.urls, [results.get(url, (None, None)) for url in urls]) from e
+            for url, result in zip(batch, fetched):
+                results[url] = result
+            pending = [
+                members for url, members in zip(batch, pending)
+                if members and results[url][0] is None
+            ]
+        skipped = len(by_station) - len(results)
+        if skipped:
+            metrics.count("colocated_skipped", skipped)
+        return [results.get(url, (None, None)) for url in urls]
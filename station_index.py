@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from station_distance import EARTH_RADIUS_MILES, distances_miles
+
+# Spherical and ellipsoidal distances differ by up to about 0.5%; tree searches are widened
+# by this factor and the candidates are then filtered with the exact distance
+RADIUS_PADDING = 1.01
+
+
+def to_unit_vectors(lats, lons):
+    """
+    Convert latitude/longitude pairs to 3-D unit vectors on the sphere.
+
+    Args:
+    lats (ndarray): Latitudes in degrees.
+    lons (ndarray): Longitudes in degrees.
+
+    Returns:
+    ndarray: Array of shape (n, 3) with x, y, z coordinates.
+    """
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def miles_to_chord(miles):
+    """
+    Convert a great-circle distance in miles to the straight-line distance between unit vectors.
+    """
+    angle = np.minimum(np.asarray(miles, dtype=np.float64) / EARTH_RADIUS_MILES, np.pi)
+    return 2 * np.sin(angle / 2)
+
+
+def chord_to_miles(chord):
+    """
+    Convert a straight-line distance between unit vectors to a great-circle distance in miles.
+    """
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.clip(np.asarray(chord, dtype=np.float64) / 2, 0.0, 1.0))
+
+
+class StationIndex:
+    """
+    Spatial index over weather stations for radius and k-nearest queries.
+
+    Stations are stored as 3-D unit vectors in a KD-tree, so each query costs O(log n) instead of
+    a scan over every station. The tree only proposes candidates; reported distances are always
+    recomputed with station_distance, so results match a brute-force scan with the same method.
+
+    Positions returned by the queries are row positions in `stations`, which keeps the row order
+    of the station CSV (stations without coordinates are dropped).
+    """
+
+    def __init__(self, station_informations_df, distance_method="vincenty"):
+        """
+        Args:
+        station_informations_df (DataFrame): Station data with 'latitude' and 'longitude' columns.
+        distance_method (str): Method used for reported distances, see station_distance.distances_miles
+            (default: "vincenty").
+        """
+        located = station_informations_df['latitude'].notna() & station_informations_df['longitude'].notna()
+        self.stations = station_informations_df[located].reset_index(drop=True)
+        self.latitudes = self.stations['latitude'].to_numpy(dtype=np.float64)
+        self.longitudes = self.stations['longitude'].to_numpy(dtype=np.float64)
+        self.distance_method = distance_method
+        self.tree = cKDTree(to_unit_vectors(self.latitudes, self.longitudes))
+
+    @classmethod
+    def from_csv(cls, file_path, distance_method="vincenty"):
+        """
+        Build the index from a station_data_*.csv written by 1.getting_stationData.py.
+        """
+        return cls(pd.read_csv(file_path), distance_method=distance_method)
+
+    @classmethod
+    def from_catalog(cls, catalog, distance_method="vincenty"):
+        """
+        Build the index from a memory-mapped StationCatalog (see station_catalog).
+        """
+        return cls(catalog.to_dataframe(), distance_method=distance_method)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _exact_distances(self, lat, lon, positions):
+        return distances_miles(lat, lon, self.latitudes[positions], self.longitudes[positions], method=self.distance_method)
+
+    def within_radius(self, lat, lon, miles):
+        """
+        Find every station strictly closer than `miles` to a point.
+
+        Args:
+        lat (float): Latitude of the query point in degrees.
+        lon (float): Longitude of the query point in degrees.
+        miles (float): Search radius in miles.
+
+        Returns:
+        ndarray: Positions of the matching stations, in station CSV order.
+        ndarray: Distances in miles to those stations.
+        """
+        query = to_unit_vectors([lat], [lon])[0]
+        candidates = self.tree.query_ball_point(query, miles_to_chord(miles * RADIUS_PADDING))
+        positions = np.sort(np.asarray(candidates, dtype=np.intp))
+        distances = self._exact_distances(lat, lon, positions)
+        within = distances < miles
+        return positions[within], distances[within]
+
+    def within_radius_batch(self, lats, lons, miles):
+        """
+        Run within_radius for many query points with a single tree traversal.
+
+        Args:
+        lats (ndarray): Latitudes of the query points in degrees.
+        lons (ndarray): Longitudes of the query points in degrees.
+        miles (float): Search radius in miles.
+
+        Returns:
+        list: One (positions, distances) tuple per query point, as returned by within_radius.
+        """
+        queries = to_unit_vectors(lats, lons)
+        candidate_lists = self.tree.query_ball_point(queries, miles_to_chord(miles * RADIUS_PADDING))
+
+        results = []
+        for lat, lon, candidates in zip(lats, lons, candidate_lists):
+            positions = np.sort(np.asarray(candidates, dtype=np.intp))
+            distances = self._exact_distances(lat, lon, positions)
+            within = distances < miles
+            results.append((positions[within], distances[within]))
+        return results
+
+    def k_nearest(self, lat, lon, k):
+        """
+        Find the k stations closest to a point.
+
+        Args:
+        lat (float): Latitude of the query point in degrees.
+        lon (float): Longitude of the query point in degrees.
+        k (int): Number of stations to return.
+
+        Returns:
+        ndarray: Positions of the nearest stations, closest first.
+        ndarray: Distances in miles to those stations.
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+
+        query = to_unit_vectors([lat], [lon])[0]
+        chords, _ = self.tree.query(query, k=k)
+        farthest = chord_to_miles(np.max(chords))
+
+        # Re-rank everything the spherical search could have ordered differently
+        candidates = self.tree.query_ball_point(query, miles_to_chord(farthest * RADIUS_PADDING) + 1e-12)
+        positions = np.asarray(candidates, dtype=np.intp)
+        distances = self._exact_distances(lat, lon, positions)
+        order = np.lexsort((positions, distances))[:k]
+        return positions[order], distances[order]
+
+    def station_ids(self, positions):
+        """
+        Station identifiers (USAF followed by WBAN) for the given positions.
+
+        Args:
+        positions (ndarray): Positions returned by a query.
+
+        Returns:
+        list: Station identifier strings, as used in the NOAA access URLs.
+        """
+        stations = self.stations.iloc[positions]
+        return (stations['usaf'].astype(str) + stations['wban'].astype(str)).tolist()
@@ -0,0 +1,170 @@
+import csv
+import logging
+import os
+from collections import defaultdict
+
+from downloader import download_all
+from download_plan import station_year_url, station_id_from_url
+from county_data import normalize_fips
+from isd_observations import epoch_hour
+from hourly_aggregation import window_hours
+from metrics import metrics
+from observation_cache import DownloadFailedError
+from station_groups import StationGroups
+
+logger = logging.getLogger(__name__)
+
+STATION_COLUMNS = ("Station_Identifiers_(USAF_WBAN)", "Nearby_Station_Identifiers_(USAF_WBAN)")
+
+
+def build_inverted_index(statistics_file_path, centroids, fips_keys):
+    """
+    Map each station to the selected counties whose nearby list contains it.
+
+    Args:
+    statistics_file_path (str): Path of county_station_statistics.csv (or the _v2 variant).
+    centroids (dict): Output of load_county_centroids.
+    fips_keys (iterable): FIPS codes selected for this run.
+
+    Returns:
+    dict: Station ID -> list of (FIPS, position, centroid), where position is the station's place
+        in the county's nearby list and centroid is (latitude, longitude).
+    """
+    selected = {normalize_fips(fips) for fips in fips_keys}
+    inverted_index = defaultdict(list)
+
+    # Only the ASCII columns are used; latin-1 accepts both cp1252 and UTF-8 statistics files
+    with open(statistics_file_path, mode='r', newline='', encoding='latin-1') as file:
+        reader = csv.DictReader(file)
+        station_column = next(column for column in STATION_COLUMNS if column in reader.fieldnames)
+        for row in reader:
+            fips = normalize_fips(row["County_FIPS"])
+            if fips not in selected or fips not in centroids or not row[station_column]:
+                continue
+            _, _, latitude, longitude = centroids[fips]
+            for position, station_id in enumerate(row[station_column].split("|")):
+                inverted_index[station_id].append((fips, position, (latitude, longitude)))
+
+    return inverted_index
+
+
+def run_station_major(
+    json_data,
+    fips_keys,
+    statistics_file_path,
+    centroids,
+    observation_cache,
+    finalize,
+    download_many=download_all,
+    batch_size=256,
+    match_window=None,
+    station_groups=None,
+):
+    """
+    Station-major execution of stage 5: every station-year file is parsed once and its rows are
+    scattered to all counties that reference it.
+
+    Each county keeps only the rows of the hours it asked for, per station. Once every station has
+    been scattered, `finalize` runs per (FIPS, year) with the county's stations in the order of its
+    nearby list, which is the same input the county-by-county loop builds, so the results match.
+
+    Args:
+    json_data (dict): Contents of formatted_data.json (used for the years and month-days per county).
+    fips_keys (iterable): FIPS codes selected for this run, in output order.
+    statistics_file_path (str): Path of county_station_statistics.csv.
+    centroids (dict): Output of load_county_centroids.
+    observation_cache (ObservationCache): Cache used to read or store the parsed station-years.
+    finalize (callable): Called as finalize(fips, year, stations) for every county-year.
+    download_many (callable): Function that downloads a list of URLs (default: download_all).
+    batch_size (int): Number of station files fetched per batch (default: 256).
+    match_window (int): The match_window finalize aggregates with; the hours it reaches into are kept
+        as well (default: None).
+    station_groups (StationGroups): If given, each county-year uses one member of each co-located
+        group in its own nearby list, chosen as in the county-by-county loop; the members other
+        counties use are not fetched.
+
+    County-years that reference a station-year which failed to download (other than a missing file)
+    are not finalized, so they stay unrecorded and the next run tries them again.
+    """
+    fips_keys = list(fips_keys)
+    station_groups = station_groups if station_groups is not None else StationGroups()
+    inverted_index = build_inverted_index(statistics_file_path, centroids, fips_keys)
+
+    # Hours each county-year needs
+    hours_needed = {}
+    for fips in fips_keys:
+        for year, year_data in json_data[f"{fips}"].items():
+            hours_needed[(normalize_fips(fips), year)] = window_hours({
+                epoch_hour(year, month, day, hour)
+                for month, day in year_data["month-day"]
+                for hour in range(24)
+            }, match_window)
+
+    # (FIPS, year) -> {position: observations restricted to the needed hours}
+    accumulators = defaultdict(dict)
+    # (FIPS, year) units left out because a station-year they need failed to download
+    failed_units = set()
+    years = sorted({year for _, year in hours_needed})
+    for year in years:
+        # Stations each county lists, for the counties that need the year: station ID -> positions
+        listed = defaultdict(dict)
+        for station_id, counties in inverted_index.items():
+            for fips, position, _ in counties:
+                if (fips, year) in hours_needed:
+                    listed[fips].setdefault(station_id, []).append(position)
+        # Per county, the members of each co-located group in its list still to try, preferred first
+        pending = [
+            (fips, members)
+            for fips, stations in listed.items()
+            for members in station_groups.ranked(sorted(stations, key=lambda station_id: stations[station_id][0]), year)
+        ]
+        listed_count = len({station_id for stations in listed.values() for station_id in stations})
+        fetched = set()
+
+        while pending:
+            # Counties choosing each station this round; every station is fetched once for all of them
+            claims = defaultdict(list)
+            for fips, members in pending:
+                claims[members[0]].append(fips)
+            station_ids = sorted(claims)
+            fetched.update(station_ids)
+            has_data = set()
+            for start in range(0, len(station_ids), batch_size):
+                urls = [station_year_url(station_id, year) for station_id in station_ids[start:start + batch_size]]
+                try:
+                    results = observation_cache.fetch_many(urls, year, download_many)
+                except DownloadFailedError as e:
+                    logger.warning("%s: %s", year, e)
+                    failed_units.update((fips, year) for url in e.urls for fips in claims[station_id_from_url(url)])
+                    results = e.results
+                for url, (observations, downloaded_file) in zip(urls, results):
+                    if downloaded_file:
+                        try:
+                            os.remove(downloaded_file)
+                        except OSError as e:
+                            logger.warning("Could not remove %s: %s", downloaded_file, e)
+                    if observations is None:
+                        continue
+                    station_id = station_id_from_url(url)
+                    has_data.add(station_id)
+                    for fips in claims[station_id]:
+                        for position in listed[fips][station_id]:
+                            accumulators[(fips, year)][position] = observations.select_hours(hours_needed[(fips, year)])
+            # A county whose choice has no data for the year moves on to the next member of the group
+            pending = [
+                (fips, members[1:]) for fips, members in pending
+                if members[0] not in has_data and len(members) > 1 and (fips, year) not in failed_units
+            ]
+
+        if listed_count > len(fetched):
+            metrics.count("colocated_skipped", listed_count - len(fetched))
+
+    for fips in fips_keys:
+        for year in json_data[f"{fips}"]:
+            if (normalize_fips(fips), year) in failed_units:
+                logger.warning("FIPS %s %s left for the next run: a station-year failed to download", fips, year)
+                accumulators.pop((normalize_fips(fips), year), None)
+                continue
+            scattered = accumulators.pop((normalize_fips(fips), year), {})
+            stations = [scattered[position] for position in sorted(scattered)]
+            finalize(fips, year, stations)
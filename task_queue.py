@@ -0,0 +1,283 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from county_data import normalize_fips
+
+DEFAULT_LEASE_SECONDS = 15 * 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+TASK_STATES = ("pending", "leased", "done", "failed")
+
+# A leased (FIPS, year); `attempt` tells a lease apart from a later one of the same task
+Task = namedtuple("Task", ["fips", "year", "cost", "attempt"])
+
+
+def task_cost(year_data):
+    """
+    Expected work of one county-year: its nearby station files times the days it asks for.
+    """
+    return len(year_data["nearby_stations"]) * len(year_data["month-day"])
+
+
+class TaskQueue:
+    """
+    Shared queue of stage-5 (FIPS, year) tasks that workers on several hosts lease from.
+
+    The queue is one SQLite database; every worker opens the same file, so it must live on storage
+    with working POSIX locks (a local disk, or a network file system that supports them). The
+    database uses the rollback journal rather than WAL, which needs shared memory on one host.
+
+    Tasks are handed out most expensive first (task_cost), so the counties with the most nearby
+    stations start early and the run ends on small counties instead of on Los Angeles. A lease
+    lasts `lease_seconds`; a worker keeps long tasks alive with heartbeat(), and a worker that finds
+    no pending task takes over tasks whose lease ran out because their holder died or hung. A task
+    that fails is retried up to `max_attempts` times before it is marked failed.
+    """
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = self._connect()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "fips TEXT NOT NULL, "
+            "year TEXT NOT NULL, "
+            "cost INTEGER NOT NULL, "
+            "state TEXT NOT NULL DEFAULT 'pending', "
+            "worker TEXT, "
+            "lease_expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT, "
+            "finished_at REAL, "
+            "PRIMARY KEY (fips, year))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS tasks_by_cost ON tasks (state, cost DESC)")
+
+    def _connect(self):
+        # Autocommit mode; writes that must be atomic open their own IMMEDIATE transaction
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=DELETE")
+        return connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add_tasks(self, json_data, fips_keys):
+        """
+        Queue every county-year of the selected counties; tasks already queued are kept as they are,
+        so every worker can call this at start-up.
+
+        Returns:
+        int: Number of tasks added.
+        """
+        tasks = [
+            (str(fips), str(year), task_cost(year_data))
+            for fips in fips_keys
+            for year, year_data in json_data[f"{fips}"].items()
+        ]
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            before = self.connection.total_changes
+            self.connection.executemany("INSERT OR IGNORE INTO tasks (fips, year, cost) VALUES (?, ?, ?)", tasks)
+            added = self.connection.total_changes - before
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return added
+
+    def lease(self, worker):
+        """
+        Take the most expensive pending task, or else one whose lease has expired.
+
+        Args:
+        worker (str): Name of the leasing worker, e.g. "<host>-<pid>".
+
+        Returns:
+        Task: The leased task, or None if nothing is left to lease right now.
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            # A task whose holders keep dying (e.g. killed for memory) is not handed out forever
+            self.connection.execute(
+                "UPDATE tasks SET state = 'failed', error = 'lease expired' "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = self.connection.execute(
+                "SELECT fips, year, cost, attempts FROM tasks "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY state = 'leased', cost DESC, fips, year LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                self.connection.execute("COMMIT")
+                return None
+            fips, year, cost, attempts = row
+            self.connection.execute(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?, attempts = ? WHERE fips = ? AND year = ?",
+                (worker, now + self.lease_seconds, attempts + 1, fips, year),
+            )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return Task(fips, year, cost, attempts + 1)
+
+    def renew(self, task, worker, connection=None):
+        """
+        Extend a lease the worker still holds.
+
+        Returns:
+        bool: False if the lease was lost (it expired and another worker took the task).
+        """
+        cursor = (connection or self.connection).execute(
+            "UPDATE tasks SET lease_expires = ? "
+            "WHERE fips = ? AND year = ? AND state = 'leased' AND worker = ? AND attempts = ?",
+            (time.time() + self.lease_seconds, task.fips, task.year, worker, task.attempt),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, task, worker):
+        """
+        Mark a task done. Outputs of a task are written whole and atomically, so a worker whose lease
+        was taken over may still complete it; the second completion changes nothing.
+
+        Returns:
+        bool: True if this call marked the task done.
+        """
+        cursor = self.connection.execute(
+            "UPDATE tasks SET state = 'done', worker = ?, lease_expires = NULL, error = NULL, finished_at = ? "
+            "WHERE fips = ? AND year = ? AND state != 'done'",
+            (worker, time.time(), task.fips, task.year),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, task, worker, error):
+        """
+        Give a task back after an error: pending again, or failed once it used up its attempts.
+        """
+        self.connection.execute(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "lease_expires = NULL, error = ? "
+            "WHERE fips = ? AND year = ? AND state = 'leased' AND worker = ? AND attempts = ?",
+            (self.max_attempts, str(error), task.fips, task.year, worker, task.attempt),
+        )
+
+    def reset_failed(self):
+        """
+        Give failed tasks a new set of attempts.
+        """
+        self.connection.execute("UPDATE tasks SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+
+    def counts(self):
+        """
+        Number of tasks and their summed cost per state.
+
+        Returns:
+        dict: State -> (tasks, cost), for every state in TASK_STATES.
+        """
+        counts = {state: (0, 0) for state in TASK_STATES}
+        for state, tasks, cost in self.connection.execute("SELECT state, COUNT(*), SUM(cost) FROM tasks GROUP BY state"):
+            counts[state] = (tasks, cost or 0)
+        return counts
+
+    def is_finished(self):
+        counts = self.counts()
+        return counts["pending"][0] == 0 and counts["leased"][0] == 0
+
+    def heartbeat(self, task, worker):
+        """
+        Keep a lease alive while a long task runs:
+
+            with task_queue.heartbeat(task, worker):
+                ...
+
+        A background thread renews the lease every third of the lease time, on its own connection.
+        """
+        return _Heartbeat(self, task, worker)
+
+
+class _Heartbeat:
+    def __init__(self, task_queue, task, worker):
+        self.task_queue = task_queue
+        self.task = task
+        self.worker = worker
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        connection = self.task_queue._connect()
+        try:
+            while not self._stop.wait(self.task_queue.lease_seconds / 3):
+                if not self.task_queue.renew(self.task, self.worker, connection):
+                    self.lost = True
+                    return
+        finally:
+            connection.close()
+
+
+def unit_output_path(directory, fips, year):
+    """
+    File holding the rows of one task, in the directory the queue workers share.
+    """
+    return os.path.join(directory, f"{normalize_fips(fips)}_{year}.csv")
+
+
+def write_unit_rows(directory, fips, year, fieldnames, rows):
+    """
+    Write the rows of one task (without header) to its unit file, atomically, so a crashed worker
+    never leaves a partial unit and a task done twice leaves one copy.
+    """
+    path = unit_output_path(directory, fips, year)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, mode='w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',')
+        writer.writerows(rows)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.replace(temporary_path, path)
+    return path
+
+
+def merge_unit_outputs(directory, json_data, fips_keys, output_path, fieldnames):
+    """
+    Concatenate the unit files of a finished queue into one CSV, in manifest order.
+
+    Returns:
+    list: (FIPS, year) units that have no unit file (failed tasks or counties without data).
+    """
+    missing = []
+    temporary_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(temporary_path, mode='w', newline='', encoding='utf-8') as output_file:
+        csv.writer(output_file, delimiter=',').writerow(fieldnames)
+        for fips in fips_keys:
+            for year in json_data[f"{fips}"]:
+                try:
+                    with open(unit_output_path(directory, fips, year), mode='r', newline='', encoding='utf-8') as unit_file:
+                        output_file.write(unit_file.read())
+                except FileNotFoundError:
+                    missing.append((str(fips), str(year)))
+    os.replace(temporary_path, output_path)
+    return missing
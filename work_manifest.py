@@ -0,0 +1,236 @@
+import json
+import os
+from collections.abc import Mapping
+from datetime import date
+
+import numpy as np
+
+from county_data import normalize_fips
+from download_plan import ACCESS_URL_TEMPLATE, station_id_from_url
+
+MANIFEST_VERSION = 1
+
+# One record per (FIPS, year); the offsets are half-open ranges into station_refs.npy and days.npy
+ENTRY_DTYPE = np.dtype([
+    ("fips", np.int32),
+    ("year", np.int16),
+    ("nearest", np.int32),
+    ("station_start", np.int64),
+    ("station_stop", np.int64),
+    ("day_start", np.int64),
+    ("day_stop", np.int64),
+])
+
+META_FILE = "manifest.json"
+ENTRIES_FILE = "entries.npy"
+STATIONS_FILE = "stations.npy"
+STATION_REFS_FILE = "station_refs.npy"
+DAYS_FILE = "days.npy"
+
+
+def day_of_year(year, month, day):
+    return date(int(year), int(month), int(day)).toordinal() - date(int(year), 1, 1).toordinal() + 1
+
+
+def month_day_of(year, day_number):
+    """
+    (month, day) of the given day of the year, as strings like the JSON manifest stored them.
+    """
+    day_date = date.fromordinal(date(int(year), 1, 1).toordinal() + int(day_number) - 1)
+    return str(day_date.month), str(day_date.day)
+
+
+def write_work_manifest(json_data, directory, url_template=ACCESS_URL_TEMPLATE):
+    """
+    Write the stage-4 work list in the compact binary manifest format.
+
+    Station IDs are stored once in a string table and referenced by integer index, dates are packed
+    as day-of-year integers, and the URL template is kept once in manifest.json. All arrays are plain
+    .npy files, so readers memory-map them and only touch the counties they ask for.
+
+    Args:
+    json_data (dict): Work list shaped like formatted_data.json
+        (FIPS -> year -> {"nearby_stations", "nearest_station", "month-day"}).
+    directory (str): Directory to write the manifest to; created if needed.
+    url_template (str): Template the station URLs were built from.
+
+    Returns:
+    int: Number of (FIPS, year) entries written.
+    """
+    station_numbers = {}
+
+    def station_number(url, year):
+        station_id = station_id_from_url(url)
+        if url != url_template.format(year=year, station_id=station_id):
+            raise ValueError(f"URL does not match the manifest template: {url}")
+        return station_numbers.setdefault(station_id, len(station_numbers))
+
+    entries = []
+    station_refs = []
+    days = []
+    written_fips = set()
+    for fips, years in json_data.items():
+        # Entries of a county must stay contiguous for the per-FIPS lookup
+        if normalize_fips(fips) in written_fips:
+            raise ValueError(f"FIPS listed twice in the work list: {fips}")
+        written_fips.add(normalize_fips(fips))
+        for year, year_data in years.items():
+            station_start = len(station_refs)
+            day_start = len(days)
+            station_refs.extend(station_number(url, year) for url in year_data["nearby_stations"])
+            days.extend(day_of_year(year, month, day) for month, day in year_data["month-day"])
+            entries.append((
+                int(normalize_fips(fips)),
+                int(year),
+                station_number(year_data["nearest_station"], year),
+                station_start,
+                len(station_refs),
+                day_start,
+                len(days),
+            ))
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, ENTRIES_FILE), np.array(entries, dtype=ENTRY_DTYPE))
+    np.save(os.path.join(directory, STATIONS_FILE), np.array(list(station_numbers), dtype=np.bytes_))
+    np.save(os.path.join(directory, STATION_REFS_FILE), np.array(station_refs, dtype=np.int32))
+    np.save(os.path.join(directory, DAYS_FILE), np.array(days, dtype=np.int16))
+
+    # Written last, so a manifest with a meta file is complete
+    with open(os.path.join(directory, META_FILE), 'w') as meta_file:
+        json.dump({"version": MANIFEST_VERSION, "url_template": url_template}, meta_file)
+
+    return len(entries)
+
+
+def _load_array(path):
+    # Empty arrays cannot be memory-mapped
+    array = np.load(path, mmap_mode='r')
+    return array if array.size else np.load(path)
+
+
+class CountyWork(Mapping):
+    """
+    Work of one county, read from a WorkManifest.
+
+    Maps each year to the same dict formatted_data.json held ({"nearby_stations": URLs,
+    "nearest_station": URL, "month-day": (month, day) pairs}), built on access from small integer
+    arrays. Only the county's own stations are kept, so the object pickles to a few hundred bytes
+    and is what ProcessPoolExecutor workers should be sent.
+    """
+
+    def __init__(self, fips, entries, station_ids, station_refs, days, url_template):
+        self.fips = fips
+        self.entries = entries
+        self.station_ids = station_ids
+        self.station_refs = station_refs
+        self.days = days
+        self.url_template = url_template
+        self._rows = {str(year): row for row, year in enumerate(entries["year"].tolist())}
+
+    def __getitem__(self, year):
+        entry = self.entries[self._rows[str(year)]]
+        return {
+            "nearby_stations": [self.station_url(station_id, year) for station_id in self.year_station_ids(year)],
+            "nearest_station": self.station_url(self.station_ids[entry["nearest"]].decode(), year),
+            "month-day": [month_day_of(year, day_number) for day_number in self.days[entry["day_start"]:entry["day_stop"]].tolist()],
+        }
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return f"CountyWork(fips={self.fips!r}, years={list(self._rows)})"
+
+    def station_url(self, station_id, year):
+        return self.url_template.format(year=year, station_id=station_id)
+
+    def year_station_ids(self, year):
+        """
+        IDs of the county's nearby stations for a year, in manifest order.
+        """
+        entry = self.entries[self._rows[str(year)]]
+        refs = self.station_refs[entry["station_start"]:entry["station_stop"]]
+        return [station_id.decode() for station_id in self.station_ids[refs].tolist()]
+
+
+class WorkManifest(Mapping):
+    """
+    Read-only view of a manifest written by write_work_manifest.
+
+    Behaves like the dict loaded from formatted_data.json: it maps FIPS codes (as strings, in the
+    order they were written) to CountyWork objects. Arrays are memory-mapped and a county is only
+    decoded when it is looked up, so opening a manifest costs the same whatever its size.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE), 'r') as meta_file:
+            meta = json.load(meta_file)
+        if meta.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version in {directory}: {meta.get('version')}")
+
+        self.directory = directory
+        self.url_template = meta["url_template"]
+        self.entries = _load_array(os.path.join(directory, ENTRIES_FILE))
+        self.stations = _load_array(os.path.join(directory, STATIONS_FILE))
+        self.station_refs = _load_array(os.path.join(directory, STATION_REFS_FILE))
+        self.days = _load_array(os.path.join(directory, DAYS_FILE))
+
+        # FIPS -> (start, stop) range of its entries, which the writer keeps contiguous
+        self._ranges = {}
+        fips_codes = np.asarray(self.entries["fips"])
+        if len(fips_codes):
+            boundaries = np.flatnonzero(np.diff(fips_codes)) + 1
+            starts = np.concatenate(([0], boundaries))
+            stops = np.concatenate((boundaries, [len(fips_codes)]))
+            for start, stop in zip(starts.tolist(), stops.tolist()):
+                self._ranges[str(int(fips_codes[start]))] = (start, stop)
+
+    def __getitem__(self, fips):
+        return self.county(fips)
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __contains__(self, fips):
+        try:
+            return normalize_fips(fips) in self._ranges
+        except (TypeError, ValueError):
+            return False
+
+    def county(self, fips):
+        """
+        Self-contained work of one county.
+
+        Args:
+        fips (str or int): County FIPS code, with or without zero padding.
+
+        Returns:
+        CountyWork: The county's years, stations and dates.
+        """
+        start, stop = self._ranges[normalize_fips(fips)]
+        entries = np.array(self.entries[start:stop])
+
+        # Copy the county's slices and renumber its stations into a local table
+        station_refs = np.array(self.station_refs[entries["station_start"][0]:entries["station_stop"][-1]])
+        days = np.array(self.days[entries["day_start"][0]:entries["day_stop"][-1]])
+        used, local_refs = np.unique(np.concatenate((station_refs, entries["nearest"])), return_inverse=True)
+
+        entries["nearest"] = local_refs[len(station_refs):]
+        for offset_column, base in (("station", entries["station_start"][0]), ("day", entries["day_start"][0])):
+            entries[f"{offset_column}_start"] -= base
+            entries[f"{offset_column}_stop"] -= base
+
+        return CountyWork(
+            str(int(entries["fips"][0])),
+            entries,
+            np.array(self.stations[used]),
+            local_refs[:len(station_refs)].astype(np.int32),
+            days,
+            self.url_template,
+        )